@@ -0,0 +1,72 @@
+import os
+import json
+import shutil
+import tempfile
+import numpy as np
+
+from pipe21cm.foreground.removal import pca_removal
+from .common import SIZES, DTYPES, bubble_cube
+
+try:
+    import healpy as hp
+    from pipe21cm.foreground.galatic import generate_GSM_cube
+except ImportError:
+    generate_GSM_cube = None
+
+# frequency channels of the foreground benchmarks, 151-196 MHz at 0.1 MHz as in the SDC data
+FREQS = np.arange(151, 196, 0.1)[:256]
+
+
+class PCARemoval:
+    '''
+    pca_removal of a bubble lightcone plus power-law foregrounds, (n_cells, n_cells, 256) channels
+    '''
+    params = (SIZES, DTYPES)
+    param_names = ['n_cells', 'dtype']
+    timeout = 600
+
+    def setup(self, n_cells, dtype):
+        cube = bubble_cube(n_cells, dtype=dtype)
+        signal = np.tile(cube, (1, 1, -(-len(FREQS)//n_cells)))[..., :len(FREQS)]
+        amplitude = 1e3*np.exp(bubble_cube(n_cells, dtype=dtype, seed=1)[..., :1]/27)
+        self.data = (signal + amplitude*(FREQS/150)**-2.5).astype(dtype)
+
+    def time_pca_removal(self, n_cells, dtype):
+        pca_removal(self.data, n_components=5, dtype=dtype)
+
+    def peakmem_pca_removal(self, n_cells, dtype):
+        pca_removal(self.data, n_components=5, dtype=dtype)
+
+
+class GSMCube:
+    '''
+    generate_GSM_cube of a 4 degree patch from a synthetic power-law GSM cache (nside 256), no download of the GSM
+    '''
+    params = (SIZES,)
+    param_names = ['box_dim']
+    timeout = 600
+
+    def setup(self, box_dim):
+        if generate_GSM_cube is None:
+            raise NotImplementedError('healpy/pygdsm are not installed')
+
+        nside = 256
+        cache_freqs = np.geomspace(50., 350., 61)
+        rng = np.random.default_rng(0)
+        sky = np.exp(rng.standard_normal(hp.nside2npix(nside)))
+        index = -2.5 + 0.1*rng.standard_normal(hp.nside2npix(nside))
+
+        self.cache_dir = tempfile.mkdtemp()
+        maps = (1e3*sky*(cache_freqs[:, None]/150)**index).astype(np.float32)
+        np.save(os.path.join(self.cache_dir, 'gsm16_maps.npy'), maps)
+        with open(os.path.join(self.cache_dir, 'gsm16_meta.json'), 'w') as f:
+            json.dump({'model': 'synthetic', 'freq_unit': 'MHz', 'freqs': cache_freqs.tolist(), 'nside': nside}, f)
+
+    def teardown(self, box_dim):
+        shutil.rmtree(self.cache_dir)
+
+    def time_generate_GSM_cube(self, box_dim):
+        generate_GSM_cube(4., box_dim, freqs=FREQS, seed=0, cache_dir=self.cache_dir)
+
+    def peakmem_generate_GSM_cube(self, box_dim):
+        generate_GSM_cube(4., box_dim, freqs=FREQS, seed=0, cache_dir=self.cache_dir)
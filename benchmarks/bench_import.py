@@ -0,0 +1,24 @@
+import sys
+import subprocess
+
+# modules of the lightweight core, tests/test_import.py checks that they import with NumPy and SciPy only
+CORE_MODULES = ['pipe21cm.signal.lightcone', 'pipe21cm.summary.power_spectrum', 'pipe21cm.summary.bispectrum',
+                'pipe21cm.summary.sdc_power_spectrum', 'pipe21cm.foreground.removal', 'pipe21cm.telescope', 'pipe21cm.pipeline',
+                'pipe21cm.batch']
+
+
+def _run_import(modules):
+    '''
+    import the modules in a fresh interpreter
+    '''
+    subprocess.run([sys.executable, '-c', f"import {', '.join(modules)}"], check=True)
+
+
+class ImportCore:
+    '''
+    Startup of a worker: a fresh interpreter importing the core modules (lightcones, power spectra, foreground removal...).
+    '''
+    timeout = 120
+
+    def time_import_core(self):
+        _run_import(CORE_MODULES)
@@ -0,0 +1,86 @@
+import os
+import shutil
+import tempfile
+import numpy as np
+
+from pipe21cm.signal.lightcone import build_physical_lightcone, build_observational_lightcone, physical_lightcone_redshifts
+from pipe21cm.telescope import Telescope
+from .common import SIZES, DTYPES, bubble_cube
+
+# redshifts of the synthetic coeval boxes
+REDSHIFTS = [7.0, 7.2, 7.4]
+
+
+class PhysicalLightcone:
+    '''
+    build_physical_lightcone from three synthetic coeval boxes saved as npy files (2 Mpc cells)
+    '''
+    params = (SIZES,)
+    param_names = ['n_cells']
+    timeout = 600
+
+    def setup(self, n_cells):
+        self.save_dir = tempfile.mkdtemp()
+        self.file_list = []
+        for i, z in enumerate(REDSHIFTS):
+            self.file_list.append(os.path.join(self.save_dir, f'brightness_temp_{z:.2f}.npy'))
+            np.save(self.file_list[-1], bubble_cube(n_cells, dtype=np.float32, seed=i))
+        self.box_size = 2.*n_cells
+
+    def teardown(self, n_cells):
+        shutil.rmtree(self.save_dir)
+
+    def time_build_physical_lightcone(self, n_cells):
+        build_physical_lightcone(self.file_list, REDSHIFTS, self.box_size)
+
+    def peakmem_build_physical_lightcone(self, n_cells):
+        build_physical_lightcone(self.file_list, REDSHIFTS, self.box_size)
+
+
+class ObservationalLightcone:
+    '''
+    build_observational_lightcone of a (n_cells, n_cells, n_cells) physical lightcone from z=7, with the regridder already cached
+    '''
+    params = (SIZES, DTYPES)
+    param_names = ['n_cells', 'dtype']
+    timeout = 600
+
+    def setup(self, n_cells, dtype):
+        self.box_size = 2.*n_cells
+        self.lc = bubble_cube(n_cells, dtype=np.float32)
+        self.redshifts = physical_lightcone_redshifts([7.0, 9.0], self.box_size, n_cells)[:n_cells]
+        self.dtype = np.dtype(dtype)
+        build_observational_lightcone(None, self.redshifts, self.box_size, physical_lightcone=self.lc, dtype=self.dtype)
+
+    def time_build_observational_lightcone(self, n_cells, dtype):
+        build_observational_lightcone(None, self.redshifts, self.box_size, physical_lightcone=self.lc, dtype=self.dtype)
+
+    def peakmem_build_observational_lightcone(self, n_cells, dtype):
+        build_observational_lightcone(None, self.redshifts, self.box_size, physical_lightcone=self.lc, dtype=self.dtype)
+
+
+class UVResponse:
+    '''
+    Telescope.apply_uv_response_on_lightcone of a (n_cells, n_cells, 64) lightcone with a synthetic radial UV coverage
+    '''
+    params = (SIZES, DTYPES)
+    param_names = ['n_cells', 'dtype']
+    timeout = 600
+
+    def setup(self, n_cells, dtype):
+        n_los = 64
+        self.lc = np.ascontiguousarray(bubble_cube(n_cells, dtype=dtype)[..., :n_los])
+        self.telescope = Telescope(n_cells, 2.*n_cells, np.linspace(7., 8., n_los))
+
+        # number of baselines falling with the uv distance, zero outside the core
+        u = np.fft.fftfreq(n_cells)
+        uv_distance = np.sqrt(u[:, None]**2 + u[None, :]**2)
+        uv_map = np.where(uv_distance < 0.3, 1e3*np.exp(-uv_distance/0.05), 0.)
+        self.telescope.uv_map = np.repeat(uv_map[..., None], n_los, axis=-1)
+        self.telescope.uv_mask = self.telescope.uv_map != 0
+
+    def time_apply_uv_response_on_lightcone(self, n_cells, dtype):
+        self.telescope.apply_uv_response_on_lightcone(self.lc, dtype=dtype)
+
+    def peakmem_apply_uv_response_on_lightcone(self, n_cells, dtype):
+        self.telescope.apply_uv_response_on_lightcone(self.lc, dtype=dtype)
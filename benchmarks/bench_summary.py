@@ -0,0 +1,84 @@
+import numpy as np
+
+from pipe21cm.summary.power_spectrum import calculate_1dpk, calculate_2dpk
+from pipe21cm.summary.bispectrum import caculate_icoBk
+from .common import SIZES, DTYPES, bubble_cube
+
+try:
+    # kymatio is only imported when a kernel is built
+    import kymatio.numpy
+    from pipe21cm.summary.scattering_transform import ScatteringTransformKernel
+except ImportError:
+    ScatteringTransformKernel = None
+
+
+class PowerSpectrum:
+    '''
+    calculate_1dpk and calculate_2dpk of a bubble cube, with the k binning plan already cached
+    '''
+    params = (SIZES, DTYPES)
+    param_names = ['n_cells', 'dtype']
+    timeout = 600
+
+    def setup(self, n_cells, dtype):
+        self.cube = bubble_cube(n_cells, dtype=dtype)
+        self.box_size = 2.*n_cells
+        self.dtype = np.dtype(dtype)
+        calculate_1dpk(self.cube, self.box_size, 15, dtype=self.dtype)
+        calculate_2dpk(self.cube, self.box_size, 15, dtype=self.dtype)
+
+    def time_calculate_1dpk(self, n_cells, dtype):
+        calculate_1dpk(self.cube, self.box_size, 15, dtype=self.dtype)
+
+    def peakmem_calculate_1dpk(self, n_cells, dtype):
+        calculate_1dpk(self.cube, self.box_size, 15, dtype=self.dtype)
+
+    def time_calculate_2dpk(self, n_cells, dtype):
+        calculate_2dpk(self.cube, self.box_size, 15, dtype=self.dtype)
+
+    def peakmem_calculate_2dpk(self, n_cells, dtype):
+        calculate_2dpk(self.cube, self.box_size, 15, dtype=self.dtype)
+
+
+class Bispectrum:
+    '''
+    caculate_icoBk of a bubble cube with the default triangles, with the plan already cached
+    '''
+    params = (SIZES, DTYPES)
+    param_names = ['n_cells', 'dtype']
+    timeout = 1800
+
+    def setup(self, n_cells, dtype):
+        self.cube = bubble_cube(n_cells, dtype=dtype)
+        self.box_size = 2.*n_cells
+        self.dtype = np.dtype(dtype)
+        caculate_icoBk(self.cube, self.box_size, dtype=self.dtype)
+
+    def time_caculate_icoBk(self, n_cells, dtype):
+        caculate_icoBk(self.cube, self.box_size, dtype=self.dtype)
+
+    def peakmem_caculate_icoBk(self, n_cells, dtype):
+        caculate_icoBk(self.cube, self.box_size, dtype=self.dtype)
+
+
+class ScatteringTransform:
+    '''
+    ScatteringTransformKernel.get_compact_coef (numpy backend, J=5, L=5 as in example.ipynb) of a bubble cube,
+    the 3D filter bank limits the grid to small boxes
+    '''
+    params = ([32, 64], DTYPES)
+    param_names = ['n_cells', 'dtype']
+    timeout = 1800
+
+    def setup(self, n_cells, dtype):
+        if ScatteringTransformKernel is None:
+            raise NotImplementedError('kymatio/torch are not installed')
+
+        self.kernel = ScatteringTransformKernel(J=5, L=5, shape=(n_cells,)*3, dtype=dtype)
+        self.cube = bubble_cube(n_cells, dtype=dtype)
+
+    def time_get_compact_coef(self, n_cells, dtype):
+        self.kernel.get_compact_coef(self.cube)
+
+    def peakmem_get_compact_coef(self, n_cells, dtype):
+        self.kernel.get_compact_coef(self.cube)
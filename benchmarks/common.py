@@ -0,0 +1,53 @@
+import numpy as np
+
+# box sizes (cells per side) and float precisions of the benchmark grid
+SIZES = [64, 128, 256, 512]
+DTYPES = ['float32', 'float64']
+
+
+def gaussian_cube(n, dtype='float64', seed=0, slope=-2.):
+    '''
+    Gaussian random field with a power-law power spectrum P(k) ~ k^slope, unit variance.
+
+    Args:
+        :n: int. The number of cells along one dimension.
+        :dtype: str. The float precision of the cube.
+        :seed: int. The seed of the field.
+        :slope: float. The slope of the power spectrum.
+
+    Returns:
+        :cube: np.ndarray. The (n, n, n) field.
+    '''
+
+    rng = np.random.default_rng(seed)
+    white = rng.standard_normal((n, n, n), dtype=np.float32)
+
+    k = np.sqrt(np.fft.fftfreq(n)[:, None, None]**2 + np.fft.fftfreq(n)[None, :, None]**2 + np.fft.rfftfreq(n)[None, None, :]**2)
+    k[0, 0, 0] = np.inf
+    cube = np.fft.irfftn(np.fft.rfftn(white)*k**(slope/2), s=(n, n, n))
+    cube /= cube.std()
+
+    return cube.astype(dtype)
+
+
+def bubble_cube(n, dtype='float64', seed=0, x_ion=0.5):
+    '''
+    Brightness temperature cube in mK with ionised bubbles: the regions where a smooth Gaussian field is above its x_ion
+    quantile are neutral and emit 27(1+0.1 delta) mK, the others are ionised.
+
+    Args:
+        :n: int. The number of cells along one dimension.
+        :dtype: str. The float precision of the cube.
+        :seed: int. The seed of the field.
+        :x_ion: float. The ionised volume fraction.
+
+    Returns:
+        :cube: np.ndarray. The (n, n, n) brightness temperature.
+    '''
+
+    delta = gaussian_cube(n, dtype=np.float32, seed=seed)
+    bubbles = gaussian_cube(n, dtype=np.float32, seed=seed+1, slope=-4.)
+    x_neutral = bubbles > np.quantile(bubbles, x_ion)
+
+    return (27*(1+0.1*delta)*x_neutral).astype(dtype)
+
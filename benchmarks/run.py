@@ -0,0 +1,185 @@
+'''
+Run the benchmarks without asv and compare them with a stored baseline.
+
+The benchmark classes follow the asv conventions (params/param_names, setup/teardown, time_* and peakmem_* methods),
+so `asv run` also works on this directory. This runner runs each benchmark in a forked process, reports the best of
+--repeat timings and the peak resident memory above the interpreter (setup included), and flags the benchmarks slower
+or larger than the baseline by more than --tolerance.
+
+    python -m benchmarks.run --filter PowerSpectrum --max-size 128          # print the results
+    python -m benchmarks.run --save                                          # store them as the baseline of this machine
+    python -m benchmarks.run --compare                                       # exit with 1 on a regression
+
+Baselines are machine specific and are stored in benchmarks/baselines/{hostname}.json by default. Without a baseline
+for this machine, --compare uses benchmarks/baselines/reference.json, the small boxes (--max-size 64) of the reference
+machine recorded in the file, and exits with 2 if the baseline file does not exist.
+
+    python -m benchmarks.run --max-size 64 --save --baseline benchmarks/baselines/reference.json  # update the reference
+'''
+import os
+import re
+import sys
+import json
+import time
+import inspect
+import argparse
+import platform
+import resource
+import itertools
+import importlib
+import multiprocessing
+
+BENCHMARK_MODULES = ['bench_import', 'bench_summary', 'bench_foreground', 'bench_lightcone']
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+def default_baseline():
+    '''
+    The baseline of this machine if it was saved, otherwise the committed reference baseline.
+    '''
+    path = os.path.join(BASELINE_DIR, f'{platform.node()}.json')
+    if os.path.isfile(path):
+        return path
+    return os.path.join(BASELINE_DIR, 'reference.json')
+
+
+def collect_benchmarks(pattern=None, max_size=None):
+    '''
+    List the benchmarks as (name, class, method name, params) with name '{module}.{class}.{method}({params})'.
+    '''
+    benchmarks = []
+    for module_name in BENCHMARK_MODULES:
+        module = importlib.import_module(f'benchmarks.{module_name}')
+        for class_name, cls in inspect.getmembers(module, inspect.isclass):
+            if cls.__module__ != module.__name__:
+                continue
+            for params in itertools.product(*getattr(cls, 'params', ((),))) if hasattr(cls, 'params') else [()]:
+                if max_size is not None and params and params[0] > max_size:
+                    continue
+                for method in sorted(name for name in vars(cls) if name.startswith(('time_', 'peakmem_'))):
+                    name = f"{module_name}.{class_name}.{method}({', '.join(str(p) for p in params)})"
+                    if pattern is None or re.search(pattern, name):
+                        benchmarks.append((name, cls, method, params))
+
+    return benchmarks
+
+
+def run_benchmark(cls, method, params, repeat):
+    '''
+    Run one benchmark in a forked process.
+
+    Returns:
+        :result: dict. {'value': seconds or bytes, 'unit': 's' or 'bytes'}, or {'skipped': reason}.
+    '''
+    receiver, sender = multiprocessing.get_context('fork').Pipe(duplex=False)
+    process = multiprocessing.get_context('fork').Process(target=_child, args=(sender, cls, method, params, repeat))
+    process.start()
+    result = receiver.recv()
+    process.join()
+
+    return result
+
+
+def _child(sender, cls, method, params, repeat):
+    try:
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        bench = cls()
+        try:
+            if hasattr(bench, 'setup'):
+                bench.setup(*params)
+        except NotImplementedError as e:
+            sender.send({'skipped': str(e)})
+            return
+
+        func = getattr(bench, method)
+        if method.startswith('time_'):
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                func(*params)
+                timings.append(time.perf_counter() - start)
+            result = {'value': min(timings), 'unit': 's'}
+        else:
+            func(*params)
+            # ru_maxrss is in kB on Linux
+            result = {'value': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss)*1024, 'unit': 'bytes'}
+
+        if hasattr(bench, 'teardown'):
+            bench.teardown(*params)
+        sender.send(result)
+    except Exception as e:
+        sender.send({'skipped': f'{type(e).__name__}: {e}'})
+
+
+def _format(result):
+    if 'skipped' in result:
+        return f"skipped ({result['skipped']})"
+    if result['unit'] == 's':
+        return f"{result['value']*1e3:.2f} ms"
+    return f"{result['value']/2**20:.1f} MB"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--filter', default=None, help='regular expression selecting the benchmarks by name')
+    parser.add_argument('--max-size', type=int, default=None, help='skip the parameter sets whose first parameter (box size) is larger')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timings, the best is kept')
+    parser.add_argument('--baseline', default=None, help='baseline file, default is the one of this machine or the reference one with --compare')
+    parser.add_argument('--save', action='store_true', help='store the results in the baseline file')
+    parser.add_argument('--compare', action='store_true', help='compare with the baseline file and exit with 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='ratio to the baseline above which a benchmark regressed')
+    args = parser.parse_args(argv)
+
+    if args.baseline is None:
+        args.baseline = os.path.join(BASELINE_DIR, f'{platform.node()}.json') if args.save else default_baseline()
+
+    baseline = {}
+    if args.compare:
+        if not os.path.isfile(args.baseline):
+            print(f'no baseline {args.baseline}, store one with --save first')
+            return 2
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+        print(f'comparing with {args.baseline}')
+
+    results = {}
+    regressions = []
+    for name, cls, method, params in collect_benchmarks(args.filter, args.max_size):
+        result = run_benchmark(cls, method, params, args.repeat)
+        results[name] = result
+
+        line = f'{name:<90} {_format(result):>16}'
+        if name in baseline and 'value' in result and 'value' in baseline[name]:
+            ratio = result['value']/max(baseline[name]['value'], 1e-12)
+            line += f'  x{ratio:.2f} of baseline'
+            if ratio > args.tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        elif name in baseline and 'value' in baseline[name]:
+            # a benchmark of the baseline that fails or is skipped now
+            line += '  REGRESSION'
+            regressions.append(name)
+        print(line, flush=True)
+
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.baseline)), exist_ok=True)
+        stored = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                stored = json.load(f)['results']
+        stored.update({name: result for name, result in results.items() if 'value' in result})
+        machine = {'hostname': platform.node(), 'processor': platform.processor(), 'cpu_count': os.cpu_count(),
+                   'python': platform.python_version()}
+        with open(args.baseline, 'w') as f:
+            json.dump({'machine': machine, 'results': stored}, f, indent=1, sort_keys=True)
+
+    if regressions:
+        print(f'{len(regressions)} regression(s) with respect to the baseline (tolerance x{args.tolerance})')
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import uuid
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+class BatchExecutor:
+    def __init__(self, scratch_dir, workers=1, cores_per_worker=None, rank=None, size=None):
+        '''
+        Run a per-sample function (e.g. signal lightcone + noise + foreground + removal + summaries) over many samples,
+        with the large read-only inputs (UV maps, GSM cache, regridding operators...) shared by all workers.
+        Shared inputs are npy files memory mapped read-only by every worker, so they are loaded from disk once and
+        kept once in RAM (page cache) whatever the number of workers, also across the ranks of a node.
+
+        The samples are split into contiguous blocks between ranks (one rank per node or per MPI process, see get_rank_size)
+        and the block of this rank is run in a pool of processes, each pinned to its own set of cores.
+
+        Args:
+            :scratch_dir: str. Directory of the shared inputs and of the timings, on a shared file system for multi-node runs.
+            :workers: int. The number of processes of this rank. If 1, the samples run in this process.
+            :cores_per_worker: int. The number of cores each worker is pinned to. If None, the workers are not pinned.
+            :rank: int. The rank of this process. If None, read from the environment with get_rank_size.
+            :size: int. The number of ranks.
+        '''
+
+        if rank is None or size is None:
+            rank, size = get_rank_size()
+        assert 0 <= rank < size, f'rank must be in [0, {size}), got {rank}'
+
+        self.scratch_dir = scratch_dir
+        self.workers = workers
+        self.cores_per_worker = cores_per_worker
+        self.rank = rank
+        self.size = size
+        self.shared = {}
+
+        os.makedirs(scratch_dir, exist_ok=True)
+
+    def share(self, name, value):
+        '''
+        Add a read-only input passed to every sample.
+
+        Args:
+            :name: str. The name of the input in the shared dict.
+            :value: str or np.ndarray. The path of an npy file (e.g. a UV map or GSM cache), used in place, or an array,
+                    written once to scratch_dir.
+
+        Returns:
+            :path: str. The npy file of the input.
+        '''
+
+        if isinstance(value, str):
+            path = value
+        else:
+            path = os.path.join(self.scratch_dir, f'shared_{name}.npy')
+            # every rank writes the same content, write to a temporary file first so that no rank reads a partial file
+            tmp_path = f'{path}.tmp{uuid.uuid4().hex}.npy'
+            np.save(tmp_path, np.asarray(value))
+            os.replace(tmp_path, path)
+
+        self.shared[name] = path
+
+        return path
+
+    def indices(self, n_samples):
+        '''
+        The samples of this rank, a contiguous block of range(n_samples).
+
+        Args:
+            :n_samples: int. The total number of samples.
+
+        Returns:
+            :indices: np.ndarray. The sample indices of this rank.
+        '''
+
+        return np.array_split(np.arange(n_samples), self.size)[self.rank]
+
+    def run(self, func, n_samples, store=None, **kwargs):
+        '''
+        Run func(index, shared, **kwargs) for the samples of this rank, where shared is a dict of the memory mapped inputs.
+        func must be a module level function returning a dict of arrays (or None when it writes its own outputs).
+
+        Args:
+            :func: callable. The per-sample function.
+            :n_samples: int. The total number of samples, over all ranks.
+            :store: DatasetStore. If provided, each output is written to the dataset of the same name at the sample index
+                    (create the datasets with n_samples samples first), otherwise the outputs are returned.
+            :kwargs: keyword arguments of func.
+
+        Returns:
+            :results: dict. The outputs of the samples by index, empty if store is provided.
+            :timings: list of dict. The index, rank, pid, cores and duration in seconds of each sample,
+                      also written to scratch_dir/timings_rank{rank}.json.
+        '''
+
+        indices = self.indices(n_samples)
+        results = {}
+        timings = []
+
+        def collect(index, outputs, timing):
+            if store is not None and outputs is not None:
+                for name, value in outputs.items():
+                    store.write(name, index, value)
+            elif outputs is not None:
+                results[index] = outputs
+            timings.append(timing)
+
+        if self.workers == 1:
+            # the samples run in this process, which is not pinned
+            _init_worker(self.shared, self.rank, None, None)
+            for index in indices:
+                collect(*_run_sample(func, int(index), kwargs))
+        else:
+            counter = multiprocessing.Value('i', 0)
+            with ProcessPoolExecutor(self.workers, initializer=_init_worker,
+                                     initargs=(self.shared, self.rank, self._core_sets(), counter)) as executor:
+                futures = [executor.submit(_run_sample, func, int(index), kwargs) for index in indices]
+                for future in as_completed(futures):
+                    collect(*future.result())
+
+        timings.sort(key=lambda timing: timing['index'])
+        with open(os.path.join(self.scratch_dir, f'timings_rank{self.rank}.json'), 'w') as f:
+            json.dump(timings, f)
+
+        return results, timings
+
+    def _core_sets(self):
+        '''
+        disjoint sets of cores_per_worker cores of this process affinity, one per worker
+        '''
+        if self.cores_per_worker is None or not hasattr(os, 'sched_getaffinity'):
+            return None
+
+        cores = sorted(os.sched_getaffinity(0))
+        n_sets = max(len(cores)//self.cores_per_worker, 1)
+        return [cores[i*self.cores_per_worker:(i+1)*self.cores_per_worker] or cores for i in range(n_sets)]
+
+
+def get_rank_size():
+    '''
+    Rank and number of ranks of this process from the environment of the launcher (mpirun/mpiexec, srun),
+    or PIPE21CM_RANK and PIPE21CM_SIZE. A single rank if none is set.
+
+    Returns:
+        :rank: int. The rank of this process.
+        :size: int. The number of ranks.
+    '''
+
+    for rank_var, size_var in [('PIPE21CM_RANK', 'PIPE21CM_SIZE'),
+                               ('OMPI_COMM_WORLD_RANK', 'OMPI_COMM_WORLD_SIZE'),
+                               ('PMI_RANK', 'PMI_SIZE'),
+                               ('SLURM_PROCID', 'SLURM_NTASKS')]:
+        if rank_var in os.environ and size_var in os.environ:
+            return int(os.environ[rank_var]), int(os.environ[size_var])
+
+    return 0, 1
+
+
+# state of each worker process of BatchExecutor.run
+_worker_shared = None
+_worker_rank = 0
+_worker_cores = None
+
+def _init_worker(shared_paths, rank, core_sets, counter):
+    global _worker_shared, _worker_rank, _worker_cores
+    _worker_shared = {name: np.load(path, mmap_mode='r') for name, path in shared_paths.items()}
+    _worker_rank = rank
+
+    if core_sets is not None:
+        with counter.get_lock():
+            slot = counter.value
+            counter.value += 1
+        _worker_cores = core_sets[slot % len(core_sets)]
+        os.sched_setaffinity(0, _worker_cores)
+
+def _run_sample(func, index, kwargs):
+    start = time.perf_counter()
+    outputs = func(index, _worker_shared, **kwargs)
+    timing = {'index': index, 'rank': _worker_rank, 'pid': os.getpid(), 'cores': _worker_cores,
+              'seconds': time.perf_counter() - start}
+    return index, outputs, timing
@@ -0,0 +1,76 @@
+'''
+Global float precision of pipe21cm.
+
+The lightcones, noise, foregrounds, FFTs and summaries are computed and returned in config.dtype whenever no dtype is
+passed explicitly (complex64 FFTs in float32). Set it once for the whole pipeline:
+
+    import pipe21cm.config
+    pipe21cm.config.dtype = np.float32
+
+or with the PIPE21CM_DTYPE=float32 environment variable, or for a block of code with precision(np.float32).
+Small reductions (k binning sums, frequency covariances, bispectrum triangle sums) are still accumulated in float64.
+
+Largest difference of the float32 path with respect to the float64 path on 128^3 bubble cubes, relative to the largest
+value of the float64 output:
+    calculate_1dpk, calculate_2dpk, caculate_icoBk, fft_bispectrum, calculate_sdc3a_ps   < 5e-7
+    build_physical_lightcone, build_observational_lightcone, apply_uv_response_on_lightcone  < 5e-7
+    pca_removal, PCARemover, FastICARemover, GPRRemover, PolynomialRemover               < 1e-6 of the foregrounds
+    PolynomialRemover(log_data=True)                                                     < 1e-4 of the foregrounds
+With foregrounds 1e4 times brighter than the signal, 1e-6 of the foregrounds is about 1e-2 of the residual.
+noise_realizations draws a different random stream in float32, with the same statistics.
+tests/test_precision.py checks these tolerances on 32^3 cubes and that the float32 outputs are not upcast.
+'''
+import os
+import contextlib
+import numpy as np
+
+# float precision of the arrays computed by pipe21cm when no dtype is given
+dtype = np.dtype(os.environ.get('PIPE21CM_DTYPE', 'float64'))
+
+_FLOAT_DTYPES = [np.dtype(np.float32), np.dtype(np.float64)]
+
+
+def resolve_dtype(value=None):
+    '''
+    Float precision of a computation: value if given, otherwise the global config.dtype.
+
+    Args:
+        :value: np.dtype. The precision requested by the caller, or None.
+
+    Returns:
+        :dtype: np.dtype. np.float32 or np.float64.
+    '''
+
+    value = np.dtype(dtype if value is None else value)
+    assert value in _FLOAT_DTYPES, f'dtype must be float32 or float64, got {value}'
+
+    return value
+
+
+def complex_dtype(value=None):
+    '''
+    Complex precision of the FFTs of a computation in resolve_dtype(value), complex64 or complex128.
+    '''
+
+    return np.result_type(resolve_dtype(value), np.complex64)
+
+
+@contextlib.contextmanager
+def precision(value):
+    '''
+    Set config.dtype within the context.
+
+        with precision(np.float32):
+            pk = calculate_2dpk(lc, box_size, kbins)
+
+    Args:
+        :value: np.dtype. np.float32 or np.float64.
+    '''
+
+    global dtype
+    previous = dtype
+    dtype = resolve_dtype(value)
+    try:
+        yield
+    finally:
+        dtype = previous
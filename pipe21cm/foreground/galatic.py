@@ -1,66 +1,250 @@
+import os
+import json
+import uuid
+import shutil
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from scipy import interpolate as interp
-import healpy as hp
-from pygdsm import GlobalSkyModel16
+from scipy.spatial import Delaunay
+from pipe21cm.profiling import instrument
+from pipe21cm.config import resolve_dtype
 
-def generate_GSM_cube(degree, box_dim, freqs=None, existing_map_dir=None):
+@instrument
+def generate_GSM_cube(degree, box_dim, freqs=None, existing_map_dir=None, seed=None, cache_dir=None, dtype=None):
     '''
     Generate a cube of diffuse galactic radio emission using the GlobalSkyModel16.
-    Codes modified from Shifan Zuo's(https://github.com/zuoshifan) 
+    Codes modified from Shifan Zuo's(https://github.com/zuoshifan)
 
     Note:
     Generating maps from GSM2016 can be time-consuming. If you plan to create multiple cubes
-    from the same base map, consider generating and saving the map first, then loading it 
-    for subsequent operations to improve efficiency.
+    from the same base map, consider building a GSM cache once with build_GSM_cache and passing
+    its cache_dir, or use generate_GSM_cubes.
 
     Args:
         :degree: float. The FOV of the cube in degrees.(should consider using differnt values for each frequency)
         :box_dim: int. The number of pixels along one dimension of the cube.
         :freqs: np.array. The frequencies at which to generate the GSM cube in MHz.
         :existing_map_dir: str. The directory of an existing GSM map. If provided, the map is loaded from this directory.
-    
+        :seed: int. Seed of the patch center. If None, the global numpy random state is used.
+        :cache_dir: str. The directory of a GSM cache built by build_GSM_cache. If provided, the maps at freqs are interpolated from it
+                    (the cached frequencies if freqs is None).
+        :dtype: np.dtype. Float precision of the cube. Default is pipe21cm.config.dtype.
+
     Returns:
         :output_cube: np.ndarray. The diffuse galactic radio emission cube.
     '''
 
+    get_pixels, nside = _load_GSM_maps(freqs, existing_map_dir, cache_dir)
+    rng = np.random if seed is None else np.random.default_rng(seed)
+
+    return _interpolate_patch(*_get_patch(get_pixels, nside, degree, rng), degree, box_dim, resolve_dtype(dtype))
+
+
+@instrument
+def generate_GSM_cubes(n_patches, degree, box_dim, freqs=None, existing_map_dir=None, seed=None, workers=1, cache_dir=None, dtype=None):
+    '''
+    Generate cubes of diffuse galactic radio emission from random patches of one GlobalSkyModel16 map.
+    The sky map is generated or loaded once, the patches are cut from it in this process and interpolated
+    to the (ra, dec) grid in a pool of workers.
+
+    Args:
+        :n_patches: int. The number of cubes.
+        :degree: float. The FOV of the cubes in degrees.
+        :box_dim: int. The number of pixels along one dimension of the cubes.
+        :freqs: np.array. The frequencies at which to generate the GSM cubes in MHz.
+        :existing_map_dir: str. The directory of an existing GSM map. If provided, the map is loaded from this directory.
+        :seed: int. Seed of the patch centers. If None, the global numpy random state is used.
+        :workers: int. The number of processes interpolating the patches.
+        :cache_dir: str. The directory of a GSM cache built by build_GSM_cache, see generate_GSM_cube.
+        :dtype: np.dtype. Float precision of the cubes. Default is pipe21cm.config.dtype.
+
+    Returns:
+        :output_cubes: np.ndarray. The diffuse galactic radio emission cubes with shape (n_patches, box_dim, box_dim, nfreq).
+    '''
+
+    get_pixels, nside = _load_GSM_maps(freqs, existing_map_dir, cache_dir)
+    rng = np.random if seed is None else np.random.default_rng(seed)
+
+    # the precision is passed to the workers, which may not share the config of this process
+    dtype = resolve_dtype(dtype)
+    patches = (_get_patch(get_pixels, nside, degree, rng)+(degree, box_dim, dtype) for _ in range(n_patches))
+
+    if workers == 1:
+        cubes = [_interpolate_patch(*patch) for patch in patches]
+    else:
+        with ProcessPoolExecutor(workers) as executor:
+            cubes = list(executor.map(_interpolate_patch_args, patches))
+
+    return np.stack(cubes)
+
+
+@instrument
+def build_GSM_cache(cache_dir, freq_min=50., freq_max=350., n_freqs=61, dtype=np.float32):
+    '''
+    Generate the GlobalSkyModel16 maps once on a coarse log-spaced frequency grid and store them in cache_dir as a
+    (nfreq, npix) npy array with a json file of metadata. The cache is memory mapped by generate_GSM_cube(s),
+    which interpolate it to any frequency and only read the pixels of the patches.
+
+    Args:
+        :cache_dir: str. The directory of the cache.
+        :freq_min: float. The lowest cached frequency in MHz.
+        :freq_max: float. The highest cached frequency in MHz.
+        :n_freqs: int. The number of cached frequencies.
+        :dtype: np.dtype. The float precision of the cached maps.
+
+    Returns:
+        :cache_dir: str. The directory of the cache.
+    '''
+    meta_path = os.path.join(cache_dir, 'gsm16_meta.json')
+    if os.path.isfile(meta_path):
+        return cache_dir
+    assert not (os.path.isdir(cache_dir) and os.listdir(cache_dir)), \
+        f'{cache_dir} is not empty and is not a GSM cache, use an empty or new directory (e.g. a subdirectory of it)'
+
+    import healpy as hp
+    from pygdsm import GlobalSkyModel16
+
+    freqs = np.geomspace(freq_min, freq_max, n_freqs)
+    gsm_2016 = GlobalSkyModel16(freq_unit='MHz', interpolation='cubic')
+
+    # write to a temporary directory first so that concurrent workers never read a partial cache
+    tmp_dir = f'{cache_dir.rstrip(os.sep)}.tmp{uuid.uuid4().hex}'
+    os.makedirs(tmp_dir)
+    maps = None
+    for i, freq in enumerate(freqs):
+        fg = gsm_2016.generate(freq)
+        if maps is None:
+            maps = np.lib.format.open_memmap(os.path.join(tmp_dir, 'gsm16_maps.npy'), mode='w+', dtype=dtype, shape=(n_freqs, len(fg)))
+        maps[i] = fg
+    maps.flush()
+    del maps
+
+    meta = {'model': 'GSM16', 'freq_unit': 'MHz', 'freqs': freqs.tolist(), 'nside': int(hp.npix2nside(len(fg)))}
+    with open(os.path.join(tmp_dir, 'gsm16_meta.json'), 'w') as f:
+        json.dump(meta, f)
+
+    try:
+        os.rename(tmp_dir, cache_dir)
+    except OSError as e:
+        shutil.rmtree(tmp_dir)
+        # another worker wrote the cache in the meantime, any other failure leaves no cache
+        if not os.path.isfile(meta_path):
+            raise OSError(f'could not write the GSM cache to {cache_dir}: {e}') from e
+
+    return cache_dir
+
+
+@instrument
+def interpolate_GSM_cache(maps, cache_freqs, pixels, freqs=None):
+    '''
+    Interpolate cached GSM maps to the given frequencies, linearly in log-temperature and log-frequency
+    (power law between the cached frequencies). Only the requested pixels are read from the maps.
+
+    Args:
+        :maps: np.ndarray. The cached maps with shape (ncache, npix), usually a memmap.
+        :cache_freqs: np.ndarray. The increasing cached frequencies in MHz.
+        :pixels: np.ndarray. The HEALPix pixels to read.
+        :freqs: np.ndarray. The frequencies in MHz, within the cached range. If None, the cached frequencies are returned.
+
+    Returns:
+        :values: np.ndarray. The maps at the pixels with shape (nfreq, len(pixels)).
+    '''
+    if freqs is None:
+        return np.asarray(maps[:, pixels], dtype=np.float64)
+
+    freqs = np.atleast_1d(np.asarray(freqs, dtype=np.float64))
+    assert freqs.min() >= cache_freqs[0] and freqs.max() <= cache_freqs[-1], \
+        f'freqs must be within the cached range [{cache_freqs[0]}, {cache_freqs[-1]}] MHz.'
+
+    log_freqs = np.log(cache_freqs)
+    low = np.clip(np.searchsorted(log_freqs, np.log(freqs), side='right') - 1, 0, len(cache_freqs)-2)
+    weight = (np.log(freqs) - log_freqs[low])/(log_freqs[low+1] - log_freqs[low])
+
+    # only the cached frequencies bracketing some requested frequency are read
+    used = np.unique(np.concatenate([low, low+1]))
+    log_values = np.log(np.asarray(maps[np.ix_(used, pixels)], dtype=np.float64))
+    idx_low = np.searchsorted(used, low)
+    idx_high = np.searchsorted(used, low+1)
+
+    return np.exp((1-weight[:, np.newaxis])*log_values[idx_low] + weight[:, np.newaxis]*log_values[idx_high])
+
+
+def _load_GSM_maps(freqs, existing_map_dir, cache_dir=None):
+    '''
+    function reading the (nfreq, npix) values of some pixels of the GSM maps, and the nside of the maps.
+    The maps are generated at freqs, memory mapped from existing_map_dir or interpolated from the cache in cache_dir.
+    '''
+    if cache_dir is not None:
+        with open(os.path.join(cache_dir, 'gsm16_meta.json')) as f:
+            meta = json.load(f)
+        maps = np.load(os.path.join(cache_dir, 'gsm16_maps.npy'), mmap_mode='r')
+        cache_freqs = np.array(meta['freqs'])
+        return (lambda pixels: interpolate_GSM_cache(maps, cache_freqs, pixels, freqs)), meta['nside']
+
+    import healpy as hp
+
     if existing_map_dir is None:
         if freqs is None:
             raise ValueError("If existing_map_dir is None, freqs must be provided.")
-        
+
+        from pygdsm import GlobalSkyModel16
         gsm_2016 = GlobalSkyModel16(freq_unit='MHz', interpolation='cubic')
-        fg = gsm_2016.generate(freqs)
+        fg = np.atleast_2d(gsm_2016.generate(freqs))
 
     else:
-        fg = np.load(existing_map_dir)
+        # memory mapped, only the pixels of the patches are read
+        fg = np.load(existing_map_dir, mmap_mode='r')
+
+    return (lambda pixels: np.asarray(fg[:, pixels])), hp.npix2nside(fg.shape[-1])
+
+
+def _get_patch(get_pixels, nside, degree, rng):
+    '''
+    draw a random patch center and get the (ra, dec) and the values of the pixels within degree of it
+    get_pixels reads the (nfreq, npix) values of the given pixels
+
+    Returns:
+        :ra, dec: np.ndarray. Coordinates of the patch pixels in degrees.
+        :values: np.ndarray. Values of the patch pixels with shape (npix, nfreq).
+        :ra0, dec0: float. Coordinates of the patch center in degrees.
+    '''
+    import healpy as hp
 
     # get the center of the patch(should check the reason for the range, probably SKA1-Low region)
-    theta0 = np.pi/12 + np.random.rand() * (5*np.pi/6) # [pi/12, 11*pi/12]
-    phi0 = np.random.rand() * 2*np.pi # [0, 2*pi]
+    theta0 = np.pi/12 + rng.random() * (5*np.pi/6) # [pi/12, 11*pi/12]
+    phi0 = rng.random() * 2*np.pi # [0, 2*pi]
     vec0 = hp.ang2vec(theta0, phi0)
     ra0 = np.degrees(phi0 - np.pi) # degree
     dec0 = np.degrees(np.pi/2 - theta0) # degree
 
     # select a circular patch with radius degree, and get the ra, dec
-    nside = hp.npix2nside(len(fg[0]))
     pis = hp.query_disc(nside, vec0, np.radians(degree), inclusive=True)
     theta, phi = hp.pix2ang(nside, pis)
     ra = np.degrees(phi - np.pi)
     dec = np.degrees(np.pi/2 - theta)
 
-    # define the output cube
-    output_cube = np.zeros((box_dim, box_dim, len(freqs)), dtype=np.float64) 
+    return ra, dec, get_pixels(pis).T, ra0, dec0
+
+
+@instrument
+def _interpolate_patch(ra, dec, values, ra0, dec0, degree, box_dim, dtype):
+    '''
+    interpolate the circular patch to the target (ra, dec) grid of all frequencies at once, same as
+    scipy.interpolate.griddata(..., method='cubic') per frequency but the triangulation is only built once.
+    The interpolation runs in float64 (the only real precision of CloughTocher2DInterpolator), the cube is returned in dtype.
+    '''
+    ra_low = ra0 - degree/2
+    ra_high = ra0 + degree/2
+    dec_low = dec0 - degree/2
+    dec_high = dec0 + degree/2
+    grid_ra, grid_dec = np.mgrid[ra_low:ra_high:box_dim*1j, dec_low:dec_high:box_dim*1j]
+
+    tri = Delaunay(np.array([ra, dec]).T)
+    interpolator = interp.CloughTocher2DInterpolator(tri, values)
+    output_cube = interpolator(grid_ra, grid_dec)
 
-    # interpolate the circular patch to the target (ra, dec) grid
-    for i in range(len(freqs)):
-        #get target grid
-        points = np.array([ra, dec]).T
-        ra_low = ra0 - degree/2
-        ra_high = ra0 + degree/2
-        dec_low = dec0 - degree/2
-        dec_high = dec0 + degree/2
-        grid_ra, grid_dec = np.mgrid[ra_low:ra_high:box_dim*1j, dec_low:dec_high:box_dim*1j]
+    return (output_cube*1e3).astype(dtype, copy=False)
 
-        # interpolate
-        output_cube[:,:,i] = interp.griddata(points, fg[i,pis], (grid_ra, grid_dec), method='cubic')
 
-    return output_cube*1e3
+def _interpolate_patch_args(args):
+    return _interpolate_patch(*args)
@@ -1,26 +1,348 @@
-from sklearn.decomposition import PCA
+import numpy as np
+from pipe21cm.profiling import instrument
+from pipe21cm.config import resolve_dtype
 
+# number of pixels (lines of sight) processed at once
+_CHUNK_PIXELS = 65536
 
-def pca_removal(data, n_components=5):
+
+@instrument
+def frequency_covariance(data, chunk_size=_CHUNK_PIXELS):
+    """
+    Compute the frequency-frequency covariance of the pixels of a cube, streaming over chunks of pixels.
+
+    Args:
+        :data: np.ndarray. The data cube, can be a memmap. Assuing the last dimension is frequency, all the other
+               dimensions are pixels, so a batch of cubes with shape (n_cubes, ..., nfreq) shares one covariance.
+        :chunk_size: int. The number of pixels read at once.
+
+    Returns:
+        :mean: np.ndarray. The mean spectrum with shape (nfreq,).
+        :cov: np.ndarray. The covariance with shape (nfreq, nfreq), normalised by npix-1 as in sklearn.
+    """
+
+    d_flat = data.reshape(-1, data.shape[-1])
+    n_pix = len(d_flat)
+
+    # sums are taken relative to the mean of the first chunk to avoid cancellation
+    shift = np.mean(d_flat[:chunk_size], axis=0, dtype=np.float64)
+    d_sum = np.zeros(data.shape[-1])
+    d_cov = np.zeros((data.shape[-1], data.shape[-1]))
+    for start in range(0, n_pix, chunk_size):
+        chunk = np.asarray(d_flat[start:start+chunk_size], dtype=np.float64) - shift
+        d_sum += chunk.sum(axis=0)
+        d_cov += chunk.T @ chunk
+
+    d_mean = d_sum/n_pix
+    cov = (d_cov - n_pix*np.outer(d_mean, d_mean))/(n_pix-1)
+
+    return shift + d_mean, cov
+
+
+@instrument
+def fit_pca(data, chunk_size=_CHUNK_PIXELS):
+    """
+    Fit the principal components along frequency of a cube from its streamed frequency covariance.
+
+    Args:
+        :data: np.ndarray. The data cube, can be a memmap. Assuing the last dimension is frequency.
+        :chunk_size: int. The number of pixels read at once.
+
+    Returns:
+        :mean: np.ndarray. The mean spectrum with shape (nfreq,).
+        :eigenvalues: np.ndarray. The variance of each component in decreasing order, with shape (nfreq,).
+        :components: np.ndarray. The components with shape (nfreq, nfreq), components[:, i] is the i-th component.
+    """
+
+    mean, cov = frequency_covariance(data, chunk_size=chunk_size)
+    eigenvalues, components = np.linalg.eigh(cov)
+
+    return mean, eigenvalues[::-1], components[:, ::-1]
+
+
+@instrument
+def project_out(data, mean, components, out=None, chunk_size=_CHUNK_PIXELS, dtype=None):
+    """
+    Remove the projection of the mean subtracted spectra on the given components, chunk by chunk.
+
+    Args:
+        :data: np.ndarray. The data cube, can be a memmap. Assuing the last dimension is frequency.
+        :mean: np.ndarray. The mean spectrum with shape (nfreq,).
+        :components: np.ndarray. The components to remove with shape (nfreq, n_components).
+        :out: np.ndarray. Preallocated output with the shape of data, can be data itself to clean in place.
+              The projection is computed in the precision of out.
+        :chunk_size: int. The number of pixels processed at once.
+        :dtype: np.dtype. Float precision of the residual when out is None. Default is pipe21cm.config.dtype.
+
+    Returns:
+        :res: np.ndarray. The residual after removal of the components.
+    """
+
+    if out is None:
+        out = np.empty(data.shape, dtype=resolve_dtype(dtype))
+    assert out.shape == data.shape, f'out must have shape {data.shape}, got {out.shape}'
+
+    mean = mean.astype(out.dtype, copy=False)
+    components = components.astype(out.dtype, copy=False)
+    d_flat = data.reshape(-1, data.shape[-1])
+    o_flat = out.reshape(-1, out.shape[-1])
+    for start in range(0, len(d_flat), chunk_size):
+        chunk = np.asarray(d_flat[start:start+chunk_size], dtype=out.dtype) - mean
+        chunk -= (chunk @ components) @ components.T
+        o_flat[start:start+chunk_size] = chunk
+
+    return out
+
+
+@instrument
+def pca_removal(data, n_components=5, out=None, chunk_size=_CHUNK_PIXELS, return_eigenvalues=False, dtype=None):
     """
     Remove foregrounds using PCA.
+    The frequency covariance is accumulated over chunks of pixels and the top components are projected out chunk by chunk,
+    so the peak memory is about one cube (none with out=data), and the data can be streamed from a memmap.
+    The residual is the same as with sklearn PCA (fit_transform then inverse_transform).
 
     Args:
         :data: np.ndarray. The data cube. Assuing the last dimension is frequency.
+               A batch of cubes with shape (n_cubes, ..., nfreq) is cleaned with one shared covariance.
         :n_components: int. The number of components to remove in the PCA.
+        :out: np.ndarray. Preallocated output with the shape of data, can be data itself to clean in place.
+        :chunk_size: int. The number of pixels processed at once.
+        :return_eigenvalues: bool. Also return the variance of all the components, to choose n_components.
+        :dtype: np.dtype. Float precision of the residual when out is None. Default is pipe21cm.config.dtype.
+                The frequency covariance is always accumulated in float64.
 
     Returns:
         :res: np.ndarray. The residual after foreground removal.
+        :eigenvalues: np.ndarray. The variance of each component in decreasing order, only if return_eigenvalues is True.
     """
 
-    # assume last dimension is frequency
-    d_flat = data.reshape(-1, data.shape[-1])
+    mean, eigenvalues, components = fit_pca(data, chunk_size=chunk_size)
+    res = project_out(data, mean, components[:, :n_components], out=out, chunk_size=chunk_size, dtype=dtype)
+
+    if return_eigenvalues:
+        return res, eigenvalues
+
+    return res
+
+
+class ForegroundRemover:
+    """
+    Base class of the foreground removal engines.
+    fit estimates a linear filter along frequency from some data, apply removes the fitted foregrounds from any number of cubes,
+    so one fit can be reused across many cubes. Both work on (..., nfreq) arrays (or memmaps) chunk by chunk.
+
+    Args:
+        :chunk_size: int. The number of pixels processed at once.
+    """
+
+    def __init__(self, chunk_size=_CHUNK_PIXELS):
+        self.chunk_size = chunk_size
+        self.mean = None
+        self.residual_operator = None
+
+    def fit(self, data):
+        """
+        Fit the foreground filter.
+
+        Args:
+            :data: np.ndarray. The data cube(s). Assuing the last dimension is frequency.
+
+        Returns:
+            :self: ForegroundRemover.
+        """
+        raise NotImplementedError
+
+    @instrument
+    def apply(self, data, out=None, dtype=None):
+        """
+        Remove the fitted foregrounds.
+
+        Args:
+            :data: np.ndarray. The data cube(s), can be a memmap. Assuing the last dimension is frequency.
+            :out: np.ndarray. Preallocated output with the shape of data, can be data itself to clean in place.
+                  The filter is applied in the precision of out.
+            :dtype: np.dtype. Float precision of the residual when out is None. Default is pipe21cm.config.dtype.
+
+        Returns:
+            :res: np.ndarray. The residual after foreground removal.
+        """
+        assert self.residual_operator is not None, 'the remover is not fitted. Call fit() first.'
+        assert data.shape[-1] == len(self.residual_operator), f'data must have {len(self.residual_operator)} frequencies, got {data.shape[-1]}'
+
+        if out is None:
+            out = np.empty(data.shape, dtype=resolve_dtype(dtype))
+        assert out.shape == data.shape, f'out must have shape {data.shape}, got {out.shape}'
+
+        mean = self.mean.astype(out.dtype, copy=False)
+        residual_operator = self.residual_operator.astype(out.dtype, copy=False)
+        d_flat = data.reshape(-1, data.shape[-1])
+        o_flat = out.reshape(-1, out.shape[-1])
+        for start in range(0, len(d_flat), self.chunk_size):
+            chunk = np.asarray(d_flat[start:start+self.chunk_size], dtype=out.dtype)
+            o_flat[start:start+self.chunk_size] = self._apply_chunk(chunk, mean, residual_operator)
+
+        return out
+
+    def fit_apply(self, data, out=None, dtype=None):
+        """
+        Fit the foreground filter on data and remove the foregrounds from it.
+
+        Args:
+            :data: np.ndarray. The data cube(s). Assuing the last dimension is frequency.
+            :out: np.ndarray. Preallocated output with the shape of data, can be data itself to clean in place.
+            :dtype: np.dtype. Float precision of the residual when out is None. Default is pipe21cm.config.dtype.
+
+        Returns:
+            :res: np.ndarray. The residual after foreground removal.
+        """
+        return self.fit(data).apply(data, out=out, dtype=dtype)
+
+    def _apply_chunk(self, chunk, mean, residual_operator):
+        return (chunk - mean) @ residual_operator
+
+
+class PolynomialRemover(ForegroundRemover):
+    """
+    Remove a polynomial in log-frequency from every line of sight, with one least-squares projection for all pixels.
+    The fit only depends on the frequencies, fit(data) is not needed.
+
+    Args:
+        :freqs: np.ndarray. The frequencies of the cubes.
+        :n_poly: int. The order of the polynomial.
+        :log_data: bool. Fit the polynomial to the log of the data (log-log fit), the data must be positive.
+        :chunk_size: int. The number of pixels processed at once.
+    """
+
+    def __init__(self, freqs, n_poly=3, log_data=False, chunk_size=_CHUNK_PIXELS):
+        super().__init__(chunk_size=chunk_size)
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        self.n_poly = n_poly
+        self.log_data = log_data
+
+        log_freqs = np.log(self.freqs/np.sqrt(self.freqs.min()*self.freqs.max()))
+        design = np.vander(log_freqs, n_poly+1, increasing=True)
+        self.projection = design @ np.linalg.pinv(design)
+        self.mean = np.zeros(len(self.freqs))
+        self.residual_operator = np.eye(len(self.freqs)) - self.projection
+
+    def fit(self, data=None):
+        return self
+
+    def _apply_chunk(self, chunk, mean, residual_operator):
+        if self.log_data:
+            return chunk - np.exp(np.log(chunk) @ self.projection.astype(chunk.dtype, copy=False))
+        return chunk @ residual_operator
+
+
+class PCARemover(ForegroundRemover):
+    """
+    Remove the leading principal components along frequency, same as pca_removal but the fit can be reused.
+
+    Args:
+        :n_components: int. The number of components to remove.
+        :chunk_size: int. The number of pixels processed at once.
+    """
+
+    def __init__(self, n_components=5, chunk_size=_CHUNK_PIXELS):
+        super().__init__(chunk_size=chunk_size)
+        self.n_components = n_components
+
+    @instrument
+    def fit(self, data):
+        self.mean, self.eigenvalues, components = fit_pca(data, chunk_size=self.chunk_size)
+        components = components[:, :self.n_components]
+        self.residual_operator = np.eye(len(self.mean)) - components @ components.T
+        return self
+
+
+class FastICARemover(ForegroundRemover):
+    """
+    Remove the foregrounds modelled as independent components along frequency (FastICA, Chapman et al 2012).
+    The mixing matrix is fitted on a random subset of pixels and the foregrounds are its least-squares fit to every line of sight.
+
+    Args:
+        :n_components: int. The number of independent components.
+        :max_fit_pixels: int. The maximum number of pixels used by the FastICA fit.
+        :seed: int. Seed of the pixel subset and of FastICA.
+        :chunk_size: int. The number of pixels processed at once.
+    """
+
+    def __init__(self, n_components=5, max_fit_pixels=_CHUNK_PIXELS, seed=0, chunk_size=_CHUNK_PIXELS):
+        super().__init__(chunk_size=chunk_size)
+        self.n_components = n_components
+        self.max_fit_pixels = max_fit_pixels
+        self.seed = seed
+
+    @instrument
+    def fit(self, data):
+        d_flat = data.reshape(-1, data.shape[-1])
+        rng = np.random.default_rng(self.seed)
+        pixels = np.sort(rng.choice(len(d_flat), min(len(d_flat), self.max_fit_pixels), replace=False))
+        sample = np.asarray(d_flat[pixels], dtype=np.float64)
+
+        from sklearn.decomposition import FastICA
+
+        ica = FastICA(n_components=self.n_components, whiten='unit-variance', random_state=self.seed)
+        ica.fit(sample)
+
+        self.mean = ica.mean_
+        self.mixing = ica.mixing_
+        self.residual_operator = np.eye(len(self.mean)) - (self.mixing @ np.linalg.pinv(self.mixing)).T
+        return self
+
+
+class GPRRemover(ForegroundRemover):
+    """
+    Gaussian process regression filter along frequency (GPR-lite, after Mertens et al 2018).
+    The data covariance is modelled as a smooth foreground kernel, a short coherence 21cm kernel and white noise.
+    The kernel amplitudes and coherence scales maximise the gaussian marginal likelihood of the streamed frequency covariance,
+    the foregrounds are then the posterior mean of the foreground process, a fixed (nfreq, nfreq) filter.
+
+    Args:
+        :freqs: np.ndarray. The frequencies of the cubes in MHz.
+        :fg_scale: float. Initial coherence scale of the (squared exponential) foreground kernel in MHz.
+        :signal_scale: float. Initial coherence scale of the (exponential) 21cm kernel in MHz.
+        :chunk_size: int. The number of pixels processed at once.
+    """
+
+    def __init__(self, freqs, fg_scale=20., signal_scale=1., chunk_size=_CHUNK_PIXELS):
+        super().__init__(chunk_size=chunk_size)
+        self.freqs = np.asarray(freqs, dtype=np.float64)
+        self.fg_scale = fg_scale
+        self.signal_scale = signal_scale
+
+    def _kernels(self, params):
+        fg_var, fg_scale, signal_var, signal_scale, noise_var = np.exp(params)
+        dnu = self.freqs[:, np.newaxis] - self.freqs[np.newaxis, :]
+        k_fg = fg_var*np.exp(-dnu**2/(2*fg_scale**2))
+        k_signal = signal_var*np.exp(-np.abs(dnu)/signal_scale) + noise_var*np.eye(len(self.freqs))
+        return k_fg, k_signal
+
+    def _neg_log_likelihood(self, params, cov):
+        k_fg, k_signal = self._kernels(params)
+        try:
+            chol = np.linalg.cholesky(k_fg + k_signal)
+        except np.linalg.LinAlgError:
+            return np.inf
+        chol_inv = np.linalg.inv(chol)
+        return 2*np.sum(np.log(np.diag(chol))) + np.sum((chol_inv @ cov) * chol_inv)
+
+    @instrument
+    def fit(self, data):
+        from scipy.optimize import minimize
 
-    pca = PCA(n_components=n_components)
-    fg_est=pca.fit_transform(d_flat)
-    fg_est=pca.inverse_transform(fg_est)
+        self.mean, cov = frequency_covariance(data, chunk_size=self.chunk_size)
 
-    fg_est=fg_est.reshape(data.shape)
-    res=data-(fg_est)
+        # the foregrounds start with the total variance, the 21cm signal and the noise with the variance of the frequency differences
+        total_var = np.trace(cov)/len(cov)
+        diff_var = max(np.mean(np.diag(cov)[1:] + np.diag(cov)[:-1] - 2*np.diag(cov, 1))/2, 1e-12*total_var)
+        init = np.log([total_var, self.fg_scale, diff_var/2, self.signal_scale, diff_var/2])
+        result = minimize(self._neg_log_likelihood, init, args=(cov,), method='Nelder-Mead',
+                          options={'maxiter': 2000, 'xatol': 1e-4, 'fatol': 1e-8})
+        self.hyperparameters = np.exp(result.x)
 
-    return res
\ No newline at end of file
+        k_fg, k_signal = self._kernels(result.x)
+        fg_filter = k_fg @ np.linalg.inv(k_fg + k_signal)
+        self.residual_operator = np.eye(len(self.freqs)) - fg_filter.T
+        return self
@@ -0,0 +1,482 @@
+import os
+import json
+import fcntl
+import contextlib
+import uuid
+import queue
+import shutil
+import threading
+import numpy as np
+
+# target size of one chunk of a dataset in bytes
+_CHUNK_BYTES = 16*2**20
+
+
+class DatasetStore:
+    def __init__(self, path, mode='a'):
+        '''
+        Chunked, compressed store of the pipeline products (zarr group on disk).
+        Each quantity (coeval fields, physical/observational lightcones, noise, summaries) is one dataset with the samples
+        along the first axis, and the parameters and the redshift/frequency axes are kept as attributes of the dataset.
+        Datasets are read lazily: store[name][i] or store[name][:, ..., j] only reads the chunks it needs,
+        and a whole training set is loaded with one store.load(name).
+
+        Workers can write samples of the same dataset in parallel with write() as long as each chunk along the first axis
+        (chunk_samples samples, 1 by default) is written by one worker. Workers can also append() to the same dataset
+        in parallel, the growth of the dataset is serialised by a file lock so each call gets its own range of samples.
+
+        Args:
+            :path: str. The directory of the store.
+            :mode: str. 'r' to read, 'a' to read and write (created if needed), 'w' to overwrite.
+        '''
+        import zarr
+
+        self.path = path
+        self.mode = mode
+        self.group = zarr.open_group(path, mode=mode)
+
+    def __contains__(self, name):
+        return name in self.group
+
+    def __getitem__(self, name):
+        return self.group[name]
+
+    def create(self, name, sample_shape, n_samples=0, dtype=np.float32, chunk_samples=1, attrs=None, overwrite=False):
+        '''
+        Create a dataset of n_samples samples with shape sample_shape.
+
+        Args:
+            :name: str. The name of the dataset, e.g. 'brightness_temp' or 'ps2d'.
+            :sample_shape: tuple. The shape of one sample.
+            :n_samples: int. The number of samples, can grow later with append().
+            :dtype: np.dtype. The storage precision, float32 by default, float16 halves it again.
+            :chunk_samples: int. The number of samples per chunk along the first axis.
+            :attrs: dict. Attributes of the dataset, e.g. the parameters and the redshift/frequency axes.
+            :overwrite: bool. Replace an existing dataset.
+
+        Returns:
+            :dataset: zarr.Array. The dataset.
+        '''
+
+        sample_shape = tuple(int(n) for n in sample_shape)
+        chunks = (chunk_samples,) + _sample_chunks(sample_shape, chunk_samples*np.dtype(dtype).itemsize)
+        dataset = self.group.create_array(name, shape=(n_samples,)+sample_shape, chunks=chunks, dtype=dtype, overwrite=overwrite)
+        if attrs is not None:
+            self.set_attrs(name, **attrs)
+
+        return dataset
+
+    def set_attrs(self, name, **attrs):
+        '''
+        Set attributes of a dataset, arrays (e.g. redshifts or frequencies) are stored as lists.
+
+        Args:
+            :name: str. The name of the dataset.
+            :attrs: attributes to set.
+        '''
+
+        self.group[name].attrs.update({key: _to_json(value) for key, value in attrs.items()})
+
+    def attrs(self, name):
+        '''
+        Get the attributes of a dataset.
+
+        Args:
+            :name: str. The name of the dataset.
+
+        Returns:
+            :attrs: dict. The attributes.
+        '''
+
+        return dict(self.group[name].attrs)
+
+    def write(self, name, index, data):
+        '''
+        Write samples at the given index, the dataset must already be large enough.
+
+        Args:
+            :name: str. The name of the dataset.
+            :index: int or slice. The index of the sample(s).
+            :data: np.ndarray. The sample(s), cast to the storage precision.
+        '''
+
+        self.group[name][index] = data
+
+    def append(self, name, data):
+        '''
+        Append samples at the end of a dataset, the dataset is created with the shape of the samples if needed.
+        Safe from several processes: the samples of each call are contiguous, in the order the calls get the lock.
+
+        Args:
+            :name: str. The name of the dataset.
+            :data: np.ndarray. The samples with shape (n,)+sample_shape.
+
+        Returns:
+            :start: int. The index of the first appended sample.
+        '''
+
+        data = np.asarray(data)
+        with self._lock():
+            if name not in self.group:
+                self.create(name, data.shape[1:])
+
+            # the dataset is opened again under the lock to see the resizes of the other processes
+            dataset = self.group[name]
+            start = dataset.shape[0]
+            dataset.resize((start+len(data),)+dataset.shape[1:])
+            if dataset.chunks[0] > 1:
+                # chunks shared with the samples of other calls are written under the lock
+                dataset[start:] = data
+                return start
+
+        dataset[start:start+len(data)] = data
+
+        return start
+
+    @contextlib.contextmanager
+    def _lock(self):
+        '''
+        exclusive lock of the store between processes, the lock file is next to the store as zarr lists every file in it
+        '''
+        with open(f'{self.path.rstrip(os.sep)}.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self, name, index=slice(None), dtype=None):
+        '''
+        Read (a selection of) a dataset into memory.
+
+        Args:
+            :name: str. The name of the dataset.
+            :index: int, slice or tuple. The selection, everything by default.
+            :dtype: np.dtype. The precision of the returned array. If None, the storage precision.
+
+        Returns:
+            :data: np.ndarray. The selected data.
+        '''
+
+        data = self.group[name][index]
+        if dtype is not None:
+            data = data.astype(dtype, copy=False)
+
+        return data
+
+
+def import_npy_files(store, name, file_list, dtype=np.float32, attrs=None):
+    '''
+    Collect loose npy files with the same shape (e.g. ps_{i}.npy of a training set or brightness_temp_{z}.npy of a run)
+    into one dataset of a DatasetStore, in the order of file_list.
+
+    Args:
+        :store: DatasetStore or str. The store or its path.
+        :name: str. The name of the dataset.
+        :file_list: list of str. The npy files.
+        :dtype: np.dtype. The storage precision.
+        :attrs: dict. Attributes of the dataset, e.g. the parameters and the redshift/frequency axes.
+
+    Returns:
+        :dataset: zarr.Array. The dataset.
+    '''
+
+    if isinstance(store, str):
+        store = DatasetStore(store)
+
+    first = np.load(file_list[0], mmap_mode='r')
+    dataset = store.create(name, first.shape, n_samples=len(file_list), dtype=dtype, attrs=attrs, overwrite=True)
+    for idx, file in enumerate(file_list):
+        dataset[idx] = np.load(file)
+
+    return dataset
+
+
+def build_training_set(path, summaries, params=None, dtype=np.float32, attrs=None, overwrite=False):
+    '''
+    Consolidate the summaries of a training set (e.g. the ps_{i}.npy power spectra) and their parameters (e.g. xH_z678.npy
+    or the table of hii_eff_factor, ion_tvir_min) into one contiguous file, data.bin, with an index, index.json,
+    read by TrainingSet. The files are copied one at a time, so the memory does not grow with the number of samples.
+
+    Args:
+        :path: str. The directory of the training set.
+        :summaries: list of str or np.ndarray. The npy file of each sample, in order, or an array with the samples along the first axis.
+        :params: dict. The parameters of the samples by name, arrays or npy files with the samples along the first axis.
+        :dtype: np.dtype. The storage precision of the summaries, the parameters keep their own.
+        :attrs: dict. Attributes stored in the index, e.g. the k bins or the frequency bands.
+        :overwrite: bool. Replace an existing training set.
+
+    Returns:
+        :path: str. The directory of the training set.
+    '''
+    if os.path.isfile(os.path.join(path, 'index.json')):
+        assert overwrite, f'a training set already exists in {path}, use overwrite=True to replace it'
+
+    if isinstance(summaries, (list, tuple)):
+        first = np.load(summaries[0], mmap_mode='r')
+        summary_shape = (len(summaries),) + first.shape
+    else:
+        summary_shape = np.shape(summaries)
+    params = {name: np.load(value, mmap_mode='r') if isinstance(value, str) else np.asarray(value)
+              for name, value in (params or {}).items()}
+    for name, value in params.items():
+        assert len(value) == summary_shape[0], f'{name} has {len(value)} samples, the summaries have {summary_shape[0]}'
+
+    # each array is one block of data.bin, aligned to 4096 bytes
+    index = {'n_samples': int(summary_shape[0]), 'arrays': {}, 'attrs': _to_json(attrs or {})}
+    offset = 0
+    for name, shape, array_dtype in [('summaries', summary_shape, np.dtype(dtype))] + [(name, value.shape, value.dtype) for name, value in params.items()]:
+        index['arrays'][name] = {'offset': offset, 'shape': [int(n) for n in shape], 'dtype': array_dtype.str}
+        offset += -(-int(np.prod(shape))*array_dtype.itemsize//4096)*4096
+
+    # write to a temporary directory first so that no reader sees a partial training set
+    tmp_dir = f'{path.rstrip(os.sep)}.tmp{uuid.uuid4().hex}'
+    os.makedirs(tmp_dir)
+    with open(os.path.join(tmp_dir, 'data.bin'), 'wb') as f:
+        f.truncate(offset)
+
+    blocks = _map_blocks(os.path.join(tmp_dir, 'data.bin'), index, mode='r+')
+    if isinstance(summaries, (list, tuple)):
+        for idx, file in enumerate(summaries):
+            blocks['summaries'][idx] = np.load(file)
+    else:
+        blocks['summaries'][:] = summaries
+    for name, value in params.items():
+        blocks[name][:] = value
+    for block in blocks.values():
+        block.flush()
+    del blocks
+
+    with open(os.path.join(tmp_dir, 'index.json'), 'w') as f:
+        json.dump(index, f, indent=1)
+
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    os.rename(tmp_dir, path)
+
+    return path
+
+
+class TrainingSet:
+    def __init__(self, path, target=None, transforms=(), target_transforms=()):
+        '''
+        Training set written by build_training_set, memory mapped so that opening it is instant and the memory stays flat
+        whatever the number of samples: only the samples of the batches are read.
+        The transforms are applied to whole batches (e.g. [swap_k_axes, normalize_at_min_k, flatten_samples] gives the
+        normalised power spectra of sdc/02_data_preprocessing_and_simulation_based_inference.ipynb).
+
+        It can be iterated in shuffled batches read by a background thread with batches(), loaded in memory with arrays()
+        (e.g. for the NumpyLoader of ltu-ili), or given to torch.utils.data.DataLoader as a map-style dataset
+        (__getitems__ reads a whole batch at once).
+
+        Args:
+            :path: str. The directory of the training set.
+            :target: str. The name of the parameters returned with the summaries. Default is the first one.
+            :transforms: list of callable. Functions of a batch of summaries with shape (n,)+sample_shape, applied in order.
+            :target_transforms: list of callable. Functions of a batch of parameters, applied in order.
+        '''
+
+        with open(os.path.join(path, 'index.json')) as f:
+            self.index = json.load(f)
+
+        self.path = path
+        self.attrs = self.index['attrs']
+        self.blocks = _map_blocks(os.path.join(path, 'data.bin'), self.index, mode='r')
+        self.summaries = self.blocks['summaries']
+        self.params = {name: block for name, block in self.blocks.items() if name != 'summaries'}
+        if target is None and len(self.params) > 0:
+            target = next(iter(self.params))
+        assert target is None or target in self.params, f'target must be one of {list(self.params)}, got {target}'
+        self.target = target
+        self.transforms = list(transforms)
+        self.target_transforms = list(target_transforms)
+
+    def __len__(self):
+        return self.index['n_samples']
+
+    def __getitem__(self, index):
+        if np.ndim(index) == 0 and not isinstance(index, slice):
+            x, theta = self.get_batch([index])
+            return x[0], None if theta is None else theta[0]
+        return self.get_batch(np.arange(len(self))[index])
+
+    def __getitems__(self, indices):
+        x, theta = self.get_batch(indices)
+        return list(zip(x, theta)) if theta is not None else list(x)
+
+    def get_batch(self, indices):
+        '''
+        Read and transform a batch of samples.
+
+        Args:
+            :indices: np.ndarray. The indices of the samples.
+
+        Returns:
+            :x: np.ndarray. The transformed summaries of the samples.
+            :theta: np.ndarray. The transformed target parameters of the samples, None without target.
+        '''
+        indices = np.asarray(indices, dtype=np.int64)
+        # the samples are read in file order, then put back in the order of indices
+        order = np.argsort(indices, kind='stable')
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+
+        x = self.summaries[indices[order]][inverse]
+        for transform in self.transforms:
+            x = transform(x)
+
+        theta = None
+        if self.target is not None:
+            theta = self.params[self.target][indices[order]][inverse]
+            for transform in self.target_transforms:
+                theta = transform(theta)
+
+        return x, theta
+
+    def batches(self, batch_size=256, shuffle=True, seed=None, indices=None, prefetch=2, drop_last=False):
+        '''
+        Iterate over the samples in batches, the next batches are read and transformed by a background thread while the
+        current one is used.
+
+        Args:
+            :batch_size: int. The number of samples per batch.
+            :shuffle: bool. Shuffle the samples, with a new order at each call.
+            :seed: int. The seed of the shuffling.
+            :indices: np.ndarray. The samples to iterate over, e.g. the training or validation split. Default is all.
+            :prefetch: int. The number of batches read in advance.
+            :drop_last: bool. Skip the last batch if it is smaller than batch_size.
+
+        Returns:
+            :batches: iterator of (x, theta) batches.
+        '''
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        if shuffle:
+            indices = np.random.default_rng(seed).permutation(indices)
+        stop = len(indices) - len(indices) % batch_size if drop_last else len(indices)
+        starts = range(0, stop, batch_size)
+
+        if prefetch == 0:
+            return (self.get_batch(indices[start:start+batch_size]) for start in starts)
+
+        return _prefetch([(self.get_batch, indices[start:start+batch_size]) for start in starts], prefetch)
+
+    def arrays(self, indices=None, batch_size=1024):
+        '''
+        Read and transform the samples into memory, in batches of batch_size samples.
+
+        Args:
+            :indices: np.ndarray. The samples to read. Default is all.
+            :batch_size: int. The number of samples transformed at once.
+
+        Returns:
+            :x: np.ndarray. The transformed summaries.
+            :theta: np.ndarray. The transformed target parameters, None without target.
+        '''
+        indices = np.arange(len(self)) if indices is None else np.asarray(indices)
+        x, theta = None, None
+        for start in range(0, len(indices), batch_size):
+            x_batch, theta_batch = self.get_batch(indices[start:start+batch_size])
+            if x is None:
+                x = np.empty((len(indices),)+x_batch.shape[1:], dtype=x_batch.dtype)
+                if theta_batch is not None:
+                    theta = np.empty((len(indices),)+theta_batch.shape[1:], dtype=theta_batch.dtype)
+            x[start:start+len(x_batch)] = x_batch
+            if theta is not None:
+                theta[start:start+len(theta_batch)] = theta_batch
+
+        return x, theta
+
+
+def swap_k_axes(batch):
+    '''
+    swap the two last axes of a batch of 2D power spectra, e.g. (n, n_bands, kpar, kper) to (n, n_bands, kper, kpar)
+    '''
+    return np.swapaxes(batch, -1, -2)
+
+
+def normalize_at_min_k(batch):
+    '''
+    divide each 2D power spectrum of a batch by its value at the lowest (kper, kpar), i.e. ps/ps[:, :, :1, :1]
+    '''
+    return batch/batch[..., :1, :1]
+
+
+def flatten_samples(batch):
+    '''
+    flatten each sample of a batch
+    '''
+    return batch.reshape(len(batch), -1)
+
+
+def _map_blocks(data_path, index, mode):
+    '''
+    memory map the arrays of a training set file
+    '''
+    return {name: np.memmap(data_path, mode=mode, dtype=np.dtype(block['dtype']), offset=block['offset'], shape=tuple(block['shape']))
+            for name, block in index['arrays'].items()}
+
+
+def _prefetch(tasks, prefetch):
+    '''
+    run the (func, arg) tasks in order in a background thread, at most prefetch results ahead of the consumer
+    '''
+    results = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for func, arg in tasks:
+                if stop.is_set():
+                    return
+                results.put((True, func(arg)))
+        except Exception as e:
+            results.put((False, e))
+        results.put((True, done))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            ok, result = results.get()
+            if not ok:
+                raise result
+            if result is done:
+                return
+            yield result
+    finally:
+        # the consumer stopped early, let the producer finish its current batch and exit
+        stop.set()
+        while thread.is_alive():
+            try:
+                results.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def _sample_chunks(sample_shape, itemsize):
+    '''
+    chunk shape of a sample, the largest axis is halved until a chunk is below _CHUNK_BYTES
+    '''
+    chunks = list(sample_shape)
+    while len(chunks) > 0 and np.prod(chunks)*itemsize > _CHUNK_BYTES:
+        axis = int(np.argmax(chunks))
+        chunks[axis] = (chunks[axis]+1)//2
+
+    return tuple(chunks)
+
+
+def _to_json(value):
+    '''
+    convert numpy values of attributes to json types
+    '''
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+
+    return value
@@ -0,0 +1,335 @@
+import os
+import uuid
+import pickle
+import hashlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from scipy.ndimage import zoom
+
+from pipe21cm.signal.run_21cm import run_coeval_bt
+from pipe21cm.signal.lightcone import build_physical_lightcone, build_observational_lightcone, build_image_cube, physical_lightcone_redshifts
+from pipe21cm.telescope import Telescope
+from pipe21cm.config import resolve_dtype
+
+
+class Pipeline:
+    def __init__(self, cache_dir=None, workers=1):
+        '''
+        DAG of pipeline stages with stage-level caching.
+        A stage is a function of the outputs of its input stages and of its parameters. Its output is cached in cache_dir under
+        a hash of its function, parameters and the hashes of its input stages, so when the pipeline is run again only the stages
+        whose parameters (or upstream stages) changed are executed, and the stages upstream of a cached output are not even loaded.
+        Independent stages (e.g. the noise and the signal lightcone) run concurrently in a pool of threads.
+
+        The hash identifies a function by its module and name, pass a new version to add_stage when its code changes.
+
+        Args:
+            :cache_dir: str. The directory of the stage outputs. If None, nothing is cached.
+            :workers: int. The number of stages run at once.
+        '''
+
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.stages = {}
+
+    def add_stage(self, name, func, inputs=(), version=0, **params):
+        '''
+        Add a stage computing func(*[outputs of inputs], **params).
+
+        Args:
+            :name: str. The name of the stage.
+            :func: callable. The function of the stage.
+            :inputs: list of str. The names of the stages whose outputs are the positional arguments of func.
+            :version: int. The version of func, change it to invalidate the cached outputs.
+            :params: keyword arguments of func.
+
+        Returns:
+            :self: Pipeline.
+        '''
+
+        for input_name in inputs:
+            assert input_name in self.stages, f'unknown input stage {input_name} of {name}, add it first.'
+        self.stages[name] = {'func': func, 'inputs': tuple(inputs), 'version': version, 'params': params}
+
+        return self
+
+    def set_params(self, name, **params):
+        '''
+        Update parameters of a stage, the stage and the stages downstream are executed again at the next run.
+
+        Args:
+            :name: str. The name of the stage.
+            :params: keyword arguments of the function of the stage.
+
+        Returns:
+            :self: Pipeline.
+        '''
+
+        self.stages[name]['params'].update(params)
+
+        return self
+
+    def stage_key(self, name):
+        '''
+        Hash of a stage, from its function, version, parameters, the precision of pipe21cm.config and the hashes of its input stages.
+
+        Args:
+            :name: str. The name of the stage.
+
+        Returns:
+            :key: str. sha1 hex digest.
+        '''
+
+        stage = self.stages[name]
+        digest = hashlib.sha1()
+        _update_hash(digest, (name, stage['func'], stage['version'], stage['params'], resolve_dtype().str))
+        for input_name in stage['inputs']:
+            digest.update(self.stage_key(input_name).encode())
+
+        return digest.hexdigest()
+
+    def run(self, targets=None):
+        '''
+        Run the stages needed for the targets.
+
+        Args:
+            :targets: list of str. The stages whose outputs are returned. If None, the stages no other stage depends on.
+
+        Returns:
+            :outputs: dict. The outputs of the targets.
+        '''
+
+        if targets is None:
+            used = {input_name for stage in self.stages.values() for input_name in stage['inputs']}
+            targets = [name for name in self.stages if name not in used]
+
+        # stages to execute or load, walking upstream until a cached output is found. Whether a stage is loaded is decided
+        # here once, a cached output that disappears before it is loaded (e.g. a cleaned cache) is computed again instead
+        keys = {}
+        needed = []
+        cached = set()
+
+        def walk(names):
+            to_visit = list(names)
+            while to_visit:
+                name = to_visit.pop()
+                if name in keys:
+                    continue
+                keys[name] = self.stage_key(name)
+                needed.append(name)
+                if self._is_cached(name, keys[name]):
+                    cached.add(name)
+                else:
+                    to_visit.extend(self.stages[name]['inputs'])
+
+        walk(targets)
+
+        outputs = {}
+        pending = {}
+        with ThreadPoolExecutor(self.workers) as executor:
+            while len(outputs) < len(needed):
+                for name in needed:
+                    if name in outputs or name in pending.values():
+                        continue
+                    if name in cached:
+                        pending[executor.submit(self._load, name, keys[name])] = name
+                    elif all(input_name in outputs for input_name in self.stages[name]['inputs']):
+                        args = [outputs[input_name] for input_name in self.stages[name]['inputs']]
+                        pending[executor.submit(self._execute, name, keys[name], args)] = name
+
+                assert pending, f'no stage can run among {[name for name in needed if name not in outputs]}'
+                done, _ = wait(list(pending), return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = pending.pop(future)
+                    if name in cached and isinstance(future.exception(), FileNotFoundError):
+                        # the stage is computed, its inputs skipped by the first walk are walked now
+                        cached.discard(name)
+                        walk(self.stages[name]['inputs'])
+                        continue
+                    outputs[name] = future.result()
+
+        return {name: outputs[name] for name in targets}
+
+    def _path(self, name, key):
+        return os.path.join(self.cache_dir, f'{name}_{key}.pkl')
+
+    def _is_cached(self, name, key):
+        return self.cache_dir is not None and os.path.isfile(self._path(name, key))
+
+    def _load(self, name, key):
+        with open(self._path(name, key), 'rb') as f:
+            return pickle.load(f)
+
+    def _execute(self, name, key, args):
+        stage = self.stages[name]
+        output = stage['func'](*args, **stage['params'])
+
+        if self.cache_dir is not None:
+            # write to a temporary file first so that an interrupted run never leaves a partial output
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f'{self._path(name, key)}.tmp{uuid.uuid4().hex}'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(output, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._path(name, key))
+
+        return output
+
+
+def build_sdc_pipeline(zs,
+                       box_size,
+                       cell_dim,
+                       coeval_dir,
+                       hii_eff_factor=30,
+                       ion_tvir_min=4.7,
+                       random_seed=42,
+                       N_THREADS=4,
+                       noise_seed=0,
+                       obs_time=100.0,
+                       total_int_time=4.0,
+                       int_time=10.0,
+                       declination=-30.0,
+                       subarray_type="SKA1_Low_Sept2016",
+                       uv_cache_dir=None,
+                       pad_width=120,
+                       n_output_cell=512,
+                       zoom_factor=4,
+                       freq_range=(151, 196),
+                       image_path=None,
+                       image_header=None,
+                       summary=None,
+                       summary_params=None,
+                       cache_dir=None,
+                       workers=2):
+    '''
+    Forward model of sdc/01_forward_modeling.ipynb as a Pipeline:
+    coeval -> physical lightcone -> (+ noise, mean subtracted) -> reflect padding -> observational lightcone -> zoom -> frequency cut -> summary.
+    The noise only depends on the redshifts of the lightcone, so it runs concurrently with the simulation.
+    With image_path, the 'image_cube' stage writes the SDC image cube of the observed lightcone with the fused build_image_cube,
+    run it with pipeline.run(['image_cube']) to skip the full size intermediate stages.
+
+    Args:
+        :zs: list of float. The redshifts of the coeval boxes.
+        :box_size: float. The size of the box in Mpc.
+        :cell_dim: int. The number of cells along one dimension.
+        :coeval_dir: str. The directory the coeval boxes are saved to.
+        :hii_eff_factor, ion_tvir_min, random_seed, N_THREADS: parameters of run_coeval_bt.
+        :noise_seed: int. The seed of the noise realisation.
+        :obs_time, total_int_time, int_time, declination, subarray_type: parameters of the Telescope.
+        :uv_cache_dir: str. The UV map cache directory of the Telescope.
+        :pad_width: int. The number of cells reflected on each side of the field of view.
+        :n_output_cell: int. The number of cells of the observational lightcone.
+        :zoom_factor: int. The angular upsampling of the observational lightcone.
+        :freq_range: tuple. The frequencies in MHz kept (exclusive).
+        :image_path: str. The FITS (or npy) file of the image cube. If None, no image cube stage.
+        :image_header: str. The FITS file the header of the image cube is copied from, e.g. the SDC header_only.fits.
+        :summary: callable. Function of the cut lightcone and the frequencies (e.g. a power spectrum). If None, no summary stage.
+        :summary_params: dict. Keyword arguments of summary.
+        :cache_dir: str. The directory of the stage outputs.
+        :workers: int. The number of stages run at once.
+
+    Returns:
+        :pipeline: Pipeline. Run it with pipeline.run(), the stages are 'coeval', 'lightcone_redshifts', 'physical_lightcone',
+                   'noise', 'observed_lightcone', 'padded_lightcone', 'observational_lightcone', 'zoomed_lightcone', 'cut_lightcone',
+                   'image_cube' and 'summary'.
+    '''
+
+    zs = [float(z) for z in zs]
+    padded_box_size = box_size/cell_dim*(cell_dim+2*pad_width)
+
+    pipeline = Pipeline(cache_dir=cache_dir, workers=workers)
+    pipeline.add_stage('coeval', _coeval_files, redshift=zs, box_size=box_size, cell_dim=cell_dim, hii_eff_factor=hii_eff_factor,
+                       ion_tvir_min=ion_tvir_min, random_seed=random_seed, save_dir=coeval_dir, N_THREADS=N_THREADS)
+    pipeline.add_stage('lightcone_redshifts', physical_lightcone_redshifts, redshifts=zs, box_size=box_size, n_cells=cell_dim)
+    pipeline.add_stage('physical_lightcone', _physical_lightcone, inputs=['coeval'], redshifts=zs, box_size=box_size)
+    pipeline.add_stage('noise', _noise_lightcone, inputs=['lightcone_redshifts'], ncells=cell_dim, boxsize=box_size,
+                       subarray_type=subarray_type, obs_time=obs_time, total_int_time=total_int_time, int_time=int_time,
+                       declination=declination, uv_cache_dir=uv_cache_dir, seed=noise_seed)
+    pipeline.add_stage('observed_lightcone', _add_noise, inputs=['physical_lightcone', 'noise'])
+    pipeline.add_stage('padded_lightcone', np.pad, inputs=['observed_lightcone'], pad_width=((pad_width, pad_width), (pad_width, pad_width), (0, 0)), mode='reflect')
+    pipeline.add_stage('observational_lightcone', _observational_lightcone, inputs=['padded_lightcone'], redshifts=zs,
+                       box_size=padded_box_size, n_output_cell=n_output_cell)
+    pipeline.add_stage('zoomed_lightcone', _zoom_lightcone, inputs=['observational_lightcone'], zoom_factor=zoom_factor)
+    pipeline.add_stage('cut_lightcone', _cut_frequencies, inputs=['zoomed_lightcone'], freq_range=tuple(freq_range))
+    if image_path is not None:
+        pipeline.add_stage('image_cube', _image_cube, inputs=['observed_lightcone'], redshifts=zs, box_size=box_size, path=image_path,
+                           header=image_header, pad_width=pad_width, n_output_cell=n_output_cell, zoom_factor=zoom_factor,
+                           freq_range=tuple(freq_range))
+    if summary is not None:
+        pipeline.add_stage('summary', _summary, inputs=['cut_lightcone'], summary=summary, **(summary_params or {}))
+
+    return pipeline
+
+
+def _coeval_files(save_dir, redshift, **kwargs):
+    '''
+    run the coeval boxes and return the paths of the saved brightness temperature files
+    '''
+    os.makedirs(save_dir, exist_ok=True)
+    run_coeval_bt(redshift=redshift, save_dir=save_dir, **kwargs)
+    return [os.path.join(save_dir, f"brightness_temp_{z:.2f}.npy") for z in redshift]
+
+
+def _physical_lightcone(file_list, redshifts, box_size):
+    lc, _ = build_physical_lightcone(file_list, redshifts, box_size)
+    return lc
+
+
+def _noise_lightcone(zs_lc, ncells, boxsize, subarray_type, obs_time, total_int_time, int_time, declination, uv_cache_dir, seed):
+    telescope = Telescope(ncells, boxsize, zs_lc, subarray_type=subarray_type, obs_time=obs_time, total_int_time=total_int_time,
+                          int_time=int_time, declination=declination)
+    telescope.build_lightcone_uv_map(cache_dir=uv_cache_dir)
+    return telescope.noise_realizations(1, seed=seed)[0]
+
+
+def _add_noise(lc, noise):
+    return lc - np.mean(lc, axis=(0, 1)) + noise
+
+
+def _observational_lightcone(lc, redshifts, box_size, n_output_cell):
+    return build_observational_lightcone(None, np.array(redshifts), box_size, n_output_cell=n_output_cell, physical_lightcone=lc)
+
+
+def _zoom_lightcone(obs, zoom_factor):
+    obs_lc, obs_freq = obs
+    return zoom(obs_lc, (zoom_factor, zoom_factor, 1), order=1), obs_freq
+
+
+def _cut_frequencies(obs, freq_range):
+    obs_lc, obs_freq = obs
+    selection = (obs_freq > freq_range[0]) & (obs_freq < freq_range[1])
+    return obs_lc[..., selection], obs_freq[selection]
+
+
+def _image_cube(lc, redshifts, box_size, path, **params):
+    '''
+    write the image cube and return its path and frequencies, the cube itself stays on disk
+    '''
+    _, freqs = build_image_cube(lc, redshifts, box_size, out=path, **params)
+    return path, freqs
+
+
+def _summary(obs, summary, **params):
+    obs_lc, obs_freq = obs
+    return summary(obs_lc, obs_freq, **params)
+
+
+def _update_hash(digest, value):
+    '''
+    feed a stage description to a hash, arrays by content and functions by module and name
+    '''
+    if isinstance(value, np.ndarray):
+        digest.update(f'ndarray{value.dtype}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, dict):
+        digest.update(b'dict')
+        for key in sorted(value):
+            _update_hash(digest, key)
+            _update_hash(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        digest.update(f'{type(value).__name__}{len(value)}'.encode())
+        for item in value:
+            _update_hash(digest, item)
+    elif callable(value):
+        digest.update(f'{getattr(value, "__module__", "")}.{getattr(value, "__qualname__", repr(value))}'.encode())
+    else:
+        digest.update(repr(value).encode())
@@ -0,0 +1,210 @@
+import os
+import sys
+import json
+import time
+import atexit
+import resource
+import threading
+import functools
+import contextlib
+import numpy as np
+
+# profiler recording the instrumented calls, None when profiling is disabled
+_active = None
+
+
+class Profiler:
+    def __init__(self):
+        '''
+        Records of the instrumented calls of pipe21cm: wall time, CPU time, growth of the peak RSS,
+        and the shapes and dtypes of the array arguments. Use profile() or the PIPE21CM_PROFILE environment variable to record.
+        '''
+
+        self.records = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _call(self, name, func, args, kwargs):
+        # names of the instrumented calls being executed in this thread
+        if not hasattr(self._local, 'stack'):
+            self._local.stack = []
+        stack = self._local.stack
+        parent = stack[-1] if stack else None
+        stack.append(name)
+
+        rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        cpu_start = time.process_time()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            wall = time.perf_counter() - start
+            cpu = time.process_time() - cpu_start
+            rss_delta = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start
+            stack.pop()
+
+            arrays = [value for value in list(args) + list(kwargs.values()) if isinstance(value, np.ndarray)]
+            record = {'name': name,
+                      'stage': name.split('.')[0],
+                      'start': start,
+                      'wall': wall,
+                      'cpu': cpu,
+                      # ru_maxrss is in kB on Linux and in bytes on macOS
+                      'peak_rss_delta': rss_delta*(1 if sys.platform == 'darwin' else 1024),
+                      'shapes': [list(value.shape) for value in arrays],
+                      'dtypes': [str(value.dtype) for value in arrays],
+                      'parent': parent,
+                      'depth': len(stack),
+                      'pid': os.getpid(),
+                      'tid': threading.get_ident()}
+            with self._lock:
+                self.records.append(record)
+
+    def summary(self, by='name'):
+        '''
+        Aggregate the records per function or per stage (signal, telescope, foreground, summary).
+        Per stage, the calls made from a function of the same stage are only counted in their caller.
+
+        Args:
+            :by: str. 'name' or 'stage'.
+
+        Returns:
+            :summary: dict. For each function or stage, the number of calls, the total and mean wall time, the total CPU time
+                      in seconds and the largest peak RSS growth in bytes, sorted by decreasing total wall time.
+        '''
+
+        assert by in ['name', 'stage'], f'by must be name or stage, got {by}'
+
+        summary = {}
+        for record in self.records:
+            if by == 'stage' and record['parent'] is not None and record['parent'].split('.')[0] == record['stage']:
+                continue
+            entry = summary.setdefault(record[by], {'calls': 0, 'wall': 0., 'cpu': 0., 'peak_rss_delta': 0})
+            entry['calls'] += 1
+            entry['wall'] += record['wall']
+            entry['cpu'] += record['cpu']
+            entry['peak_rss_delta'] = max(entry['peak_rss_delta'], record['peak_rss_delta'])
+        for entry in summary.values():
+            entry['mean_wall'] = entry['wall']/entry['calls']
+
+        return dict(sorted(summary.items(), key=lambda item: -item[1]['wall']))
+
+    def to_json(self, path):
+        '''
+        Write the records and the summaries per function and per stage to a json file.
+
+        Args:
+            :path: str. The json file.
+        '''
+
+        with open(path, 'w') as f:
+            json.dump({'records': self.records, 'summary': self.summary('name'), 'stages': self.summary('stage')}, f, indent=1)
+
+    def to_chrome_trace(self, path):
+        '''
+        Write the records in the Chrome trace event format, to open in chrome://tracing or https://ui.perfetto.dev.
+
+        Args:
+            :path: str. The json file.
+        '''
+
+        t0 = min((record['start'] for record in self.records), default=0.)
+        events = [{'name': record['name'], 'cat': record['stage'], 'ph': 'X',
+                   'ts': (record['start']-t0)*1e6, 'dur': record['wall']*1e6,
+                   'pid': record['pid'], 'tid': record['tid'],
+                   'args': {'cpu': record['cpu'], 'peak_rss_delta': record['peak_rss_delta'],
+                            'shapes': record['shapes'], 'dtypes': record['dtypes']}}
+                  for record in self.records]
+
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def instrument(func=None, name=None):
+    '''
+    Decorator recording the calls of a function when profiling is enabled, it only adds one check when disabled.
+
+    Args:
+        :func: callable. The function, the decorator can also be used as @instrument(name=...).
+        :name: str. The name of the records. Default is the module (without pipe21cm.) and the qualified name of the function,
+               e.g. summary.power_spectrum.calculate_1dpk, its first part is the stage.
+
+    Returns:
+        :wrapper: callable. The instrumented function.
+    '''
+
+    if func is None:
+        return functools.partial(instrument, name=name)
+
+    if name is None:
+        name = f"{func.__module__.replace('pipe21cm.', '', 1)}.{func.__qualname__}"
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        profiler = _active
+        if profiler is None:
+            return func(*args, **kwargs)
+        return profiler._call(name, func, args, kwargs)
+
+    return wrapper
+
+
+@contextlib.contextmanager
+def profile(path=None, format='chrome'):
+    '''
+    Record the instrumented calls within the context.
+
+        with profile('trace.json') as profiler:
+            run_the_pipeline()
+        print(profiler.summary('stage'))
+
+    Args:
+        :path: str. If provided, the records are written to this file at the end of the context.
+        :format: str. 'chrome' for the Chrome trace event format or 'json' for the records and summaries.
+
+    Returns:
+        :profiler: Profiler. The records of the context.
+    '''
+
+    global _active
+    assert format in ['chrome', 'json'], f'format must be chrome or json, got {format}'
+
+    previous = _active
+    profiler = Profiler()
+    _active = profiler
+    try:
+        yield profiler
+    finally:
+        _active = previous
+        if previous is not None:
+            # the enclosing profiler also sees the calls of the context
+            with previous._lock:
+                previous.records.extend(profiler.records)
+        if path is not None:
+            _write(profiler, path, format)
+
+
+def get_profiler():
+    '''
+    Get the profiler recording the instrumented calls, e.g. the one of the whole process with PIPE21CM_PROFILE=1.
+
+    Returns:
+        :profiler: Profiler. The active profiler, None when profiling is disabled.
+    '''
+
+    return _active
+
+
+def _write(profiler, path, format):
+    if format == 'chrome':
+        profiler.to_chrome_trace(path)
+    else:
+        profiler.to_json(path)
+
+
+# PIPE21CM_PROFILE=1 records the whole process (see get_profiler),
+# PIPE21CM_PROFILE=path.json also writes the Chrome trace at exit (the records and summaries with PIPE21CM_PROFILE_FORMAT=json)
+if os.environ.get('PIPE21CM_PROFILE', '') not in ['', '0']:
+    _active = Profiler()
+    if os.environ['PIPE21CM_PROFILE'] != '1':
+        atexit.register(_write, _active, os.environ['PIPE21CM_PROFILE'], os.environ.get('PIPE21CM_PROFILE_FORMAT', 'chrome'))
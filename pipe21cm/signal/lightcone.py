@@ -1,54 +1,301 @@
 
 import os
+import uuid
+import functools
 import numpy as np
-import tools21cm as t2c
+from scipy import ndimage
+from pipe21cm.profiling import instrument
+from pipe21cm.config import resolve_dtype
 
 
+@instrument
 def build_physical_lightcone(file_list, 
                              redshifts, 
-                             box_size):
+                             box_size,
+                             out=None,
+                             dtype=None):
     """
-    Build a lightcone from a list of 21cm brightness temperature boxs using tools21cm.
+    Build a lightcone from a list of 21cm brightness temperature boxs.
     Slices along the line of sight are constructed wit uniform comoving distance intervals.(Default setting in tools21cm)
+    The result is identical to tools21cm.make_lightcone with linear interpolation, but the boxes are memory mapped and only
+    the slabs of the two bracketing boxes needed for each redshift interval are read, so the memory stays bounded by the output.
 
     Args:
         :file_list: list of str. The list of file paths to the brightness temperature maps in npy files.
                     Note that the files should have consistent name formats and should be sorted in the order of redshifts.
         :redshifts: list of float. The redshifts of the brightness temperature maps. Should be in the same order as the file_list.
         :box_size: float. The size of the box in Mpc.
+        :out: np.ndarray or str. Preallocated output array, or the path of a npy file the lightcone is memory mapped to.
+              If None, the lightcone is allocated in memory.
+        :dtype: np.dtype. Float precision of the lightcone (when out is not an array). Default is pipe21cm.config.dtype.
 
     Returns:
         :lightcone: np.ndarray. The lightcone.
         :zs_lc: list of float. The redshifts of the slices in the lightcone.
     """
 
-    z_low = redshifts[0]
-    z_high = redshifts[-1]
-
-    # use tools21cm to make the lightcone, output is the lightcone and the redshifts of the slices
-    lc, zs_lc = t2c.make_lightcone(
-                            file_list,
-                            z_low=z_low,
-                            z_high=z_high,
-                            file_redshifts=redshifts,
-                            los_axis=2,
-                            interpolation='linear',
-                            reading_function=np.load,
-                            box_length_mpc=box_size,
-                        )
-    
+    redshifts = np.asarray(redshifts, dtype=np.float64)
+
+    boxes = [np.load(file, mmap_mode='r') for file in file_list]
+    mesh_size = boxes[0].shape
+
+    zs_lc = physical_lightcone_redshifts(redshifts, box_size, mesh_size[0])
+
+    lc_shape = (mesh_size[0], mesh_size[1], len(zs_lc))
+    dtype = resolve_dtype(dtype)
+    if out is None:
+        lc = np.zeros(lc_shape, dtype=dtype)
+    elif isinstance(out, str):
+        lc = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=lc_shape)
+    else:
+        assert out.shape == lc_shape, f'out must have shape {lc_shape}, got {out.shape}'
+        lc = out
+
+    # index of the box bracketing each slice from below, the box above is the next one
+    low_idx = np.searchsorted(redshifts, zs_lc, side='right') - 1
+    slice_idx = np.arange(len(zs_lc)) % mesh_size[2]
+
+    for idx in np.unique(low_idx):
+        pos = np.flatnonzero(low_idx == idx)
+        z_bracket_low, z_bracket_high = redshifts[idx], redshifts[idx+1]
+        z = zs_lc[pos]
+
+        # read only the slabs of the bracketing boxes used in this redshift interval
+        slab_low = np.take(boxes[idx], slice_idx[pos], axis=2).astype(lc.dtype, copy=False)
+        slab_high = np.take(boxes[idx+1], slice_idx[pos], axis=2).astype(lc.dtype, copy=False)
+
+        # interpolation weights in the precision of the lightcone, so float32 slabs are not promoted by the float64 redshifts
+        weight = ((z-z_bracket_low)/(z_bracket_high-z_bracket_low)).astype(lc.dtype)
+        lc[:, :, pos] = weight*slab_high + (1-weight)*slab_low
+
     return lc, zs_lc
 
 
+@instrument
+def physical_lightcone_redshifts(redshifts, box_size, n_cells):
+    """
+    Redshifts of the slices of the lightcone built by build_physical_lightcone, same as tools21cm.make_lightcone.
+    They only depend on the geometry, so they are known before the boxes are read.
+
+    Args:
+        :redshifts: list of float. The redshifts of the brightness temperature maps, in increasing order.
+        :box_size: float. The size of the box in Mpc.
+        :n_cells: int. The number of cells along one dimension of the boxes.
+
+    Returns:
+        :zs_lc: np.ndarray. The redshifts of the slices in the lightcone.
+    """
+    import tools21cm as t2c
+
+    redshifts = np.asarray(redshifts, dtype=np.float64)
+    zs_lc = t2c.redshifts_at_equal_comoving_distance(redshifts[0], redshifts[-1], box_grid_n=n_cells, box_length_mpc=box_size)
+
+    return zs_lc[(zs_lc >= redshifts.min()) & (zs_lc <= redshifts.max())]
+
+
+class ObservationalRegridder:
+    """
+    Precomputed mapping from physical lightcones of a given geometry to observational (angle-frequency) lightcones.
+    The result is the same as tools21cm.physical_lightcone_to_observational (mode='pad', order=2), but the comoving distances,
+    the frequency grid and the interpolation weights are computed once and reused for every lightcone of a training set.
+
+    Each frequency slice is the average of a few consecutive physical slices (index/weight table of the line of sight
+    tophat smoothing). The tophat smoothing, spline interpolation and periodic padding of tools21cm are separable, so the
+    angular regridding of a slice X is A @ X @ A.T with one (n_theta, n_cells) matrix A per resampled size.
+
+    Args:
+        :freqs: np.ndarray. The frequencies of the output slices in MHz, with shape (n_nu,).
+        :taps_index: np.ndarray. Indices of the physical slices averaged into each output slice, with shape (n_nu, n_taps).
+        :taps_weight: np.ndarray. Weights of the physical slices averaged into each output slice, with shape (n_nu, n_taps).
+        :operators: np.ndarray. Angular regridding matrices, with shape (n_operators, n_theta, n_cells).
+        :slice_operator: np.ndarray. Index of the angular regridding matrix of each output slice, with shape (n_nu,).
+    """
+
+    def __init__(self, freqs, taps_index, taps_weight, operators, slice_operator):
+        self.freqs = freqs
+        self.taps_index = taps_index
+        self.taps_weight = taps_weight
+        self.operators = operators
+        self.slice_operator = slice_operator
+        self.n_cells = operators.shape[2]
+        self.n_theta = operators.shape[1]
+
+    def save(self, path):
+        """
+        Save the regridder to a npz file, the file is written atomically so that concurrent workers never read a partial file.
+
+        Args:
+            :path: str. Path of the npz file.
+        """
+        tmp_path = f'{path}.tmp{uuid.uuid4().hex}.npz'
+        np.savez(tmp_path, freqs=self.freqs, taps_index=self.taps_index, taps_weight=self.taps_weight,
+                 operators=self.operators, slice_operator=self.slice_operator)
+        os.replace(tmp_path, path)
+
+    @instrument
+    def apply(self, lightcones, dtype=None, out=None):
+        """
+        Regrid one or a batch of physical lightcones to observational coordinates.
+
+        Args:
+            :lightcones: np.ndarray. Physical lightcone(s) with shape (n_cells, n_cells, n_los) or (n_lc, n_cells, n_cells, n_los), can be a memmap.
+            :dtype: np.dtype. Float precision of the regridding. Default is pipe21cm.config.dtype.
+            :out: np.ndarray. Preallocated output with shape (..., n_theta, n_theta, n_nu). If None, it is allocated in memory.
+
+        Returns:
+            :obs_lc: np.ndarray. The observational lightcone(s) with shape (..., n_theta, n_theta, n_nu).
+        """
+        assert lightcones.shape[-3:-1] == (self.n_cells, self.n_cells), f'lightcones must have {self.n_cells} cells on the sky, got {lightcones.shape}'
+        dtype = resolve_dtype(dtype)
+        batch_shape = lightcones.shape[:-3]
+        obs_shape = batch_shape + (self.n_theta, self.n_theta, len(self.freqs))
+        if out is None:
+            out = np.zeros(obs_shape, dtype=dtype)
+        assert out.shape == obs_shape, f'out must have shape {obs_shape}, got {out.shape}'
+
+        # line of sight binning, only the physical slices used by some output slice are read
+        weights = self.taps_weight.astype(dtype)
+        binned = np.zeros(batch_shape + (self.n_cells, self.n_cells, len(self.freqs)), dtype=dtype)
+        for tap in range(self.taps_index.shape[1]):
+            binned += np.take(lightcones, self.taps_index[:, tap], axis=-1).astype(dtype, copy=False)*weights[:, tap]
+
+        # angular regridding, the slices sharing a matrix are transformed together
+        binned = np.moveaxis(binned, -1, -3)
+        for op in np.unique(self.slice_operator):
+            pos = np.flatnonzero(self.slice_operator == op)
+            operator = self.operators[op].astype(dtype, copy=False)
+            out[..., pos] = np.moveaxis(operator @ binned[..., pos, :, :] @ operator.T, -3, -1)
+
+        return out
+
+
+def load_observational_regridder(path):
+    """
+    Load an ObservationalRegridder saved with ObservationalRegridder.save.
+
+    Args:
+        :path: str. Path of the npz file.
+
+    Returns:
+        :regridder: ObservationalRegridder.
+    """
+    with np.load(path) as data:
+        return ObservationalRegridder(data['freqs'], data['taps_index'], data['taps_weight'],
+                                      data['operators'], data['slice_operator'])
+
+
+@instrument
+def get_observational_regridder(n_cells, n_los, box_size, z_low, dnu, dtheta, cache_dir=None):
+    """
+    Get the (cached) ObservationalRegridder of a physical lightcone geometry.
+    The regridder is cached in memory and, if cache_dir is given, on disk so that other processes and runs reuse it.
+
+    Args:
+        :n_cells: int. The number of cells of the physical lightcone on the sky.
+        :n_los: int. The number of cells of the physical lightcone along the line of sight.
+        :box_size: float. The size of the box in Mpc.
+        :z_low: float. The redshift of the first slice of the physical lightcone.
+        :dnu: float. The frequency interval in MHz.
+        :dtheta: float. The angular resolution in arcmin.
+        :cache_dir: str. Directory caching the regridders on disk. If None, the regridder is only cached in memory.
+
+    Returns:
+        :regridder: ObservationalRegridder.
+    """
+    return _get_observational_regridder(int(n_cells), int(n_los), float(box_size), float(z_low), float(dnu), float(dtheta), cache_dir)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_observational_regridder(n_cells, n_los, box_size, z_low, dnu, dtheta, cache_dir):
+    if cache_dir is None:
+        return _build_observational_regridder(n_cells, n_los, box_size, z_low, dnu, dtheta)
+
+    key = f'obs_regridder_N{n_cells}_M{n_los}_L{box_size}_z{z_low}_dnu{dnu}_dtheta{dtheta}.npz'
+    path = os.path.join(cache_dir, key)
+    if os.path.isfile(path):
+        return load_observational_regridder(path)
+
+    regridder = _build_observational_regridder(n_cells, n_los, box_size, z_low, dnu, dtheta)
+    os.makedirs(cache_dir, exist_ok=True)
+    regridder.save(path)
+    return regridder
+
+
+def _build_observational_regridder(n_cells, n_los, box_size, z_low, dnu, dtheta):
+    """
+    mapping of tools21cm.physical_lightcone_to_observational for a (n_cells, n_cells, n_los) lightcone starting at z_low
+    """
+    import tools21cm as t2c
+
+    fov_deg = t2c.angular_size_comoving(box_size, z_low)
+    n_theta = int(fov_deg*60./dtheta)
+
+    # same frequency grid as tools21cm.bin_lightcone_in_frequency
+    cell_size = box_size/n_cells
+    distances = t2c.z_to_cdist(z_low) + np.arange(n_los)*cell_size
+    input_freqs = t2c.z_to_nu(t2c.cdist_to_z(distances))
+    freqs = np.arange(input_freqs[0], input_freqs[-1], -dnu)
+
+    # the 'full' tophat convolution along the line of sight averages each picked slice with the width-1 slices before it
+    max_cell_size = t2c.nu_to_cdist(freqs[-1]) - t2c.nu_to_cdist(freqs[-2])
+    width = int(max(np.round(max_cell_size/cell_size), 1))
+    picked = np.array([int(t2c.find_idx(input_freqs, nu)) for nu in freqs])
+    taps_index = picked[:, np.newaxis] - np.arange(width)
+    taps_weight = np.where(taps_index >= 0, 1./width, 0.)
+    taps_index = np.clip(taps_index, 0, None)
+
+    # number of cells each slice is resampled to before the padding (tools21cm.physical_slice_to_angular)
+    fov_mpc = t2c.deg_to_cdist(fov_deg, t2c.nu_to_z(freqs))
+    n_resampled = (box_size/(fov_mpc/(fov_deg*60./dtheta))).astype(int)
+    n_resampled -= (n_resampled % 2 == 0)
+    assert n_resampled.max() <= n_theta, 'the resampled slices are larger than the field of view'
+
+    sizes, slice_operator = np.unique(n_resampled, return_inverse=True)
+    operators = np.stack([_angular_operator(n_cells, n, n_theta) for n in sizes])
+
+    return ObservationalRegridder(freqs, taps_index, taps_weight, operators, slice_operator.ravel())
+
+
+def _angular_operator(n_cells, n_resampled, n_theta):
+    """
+    (n_theta, n_cells) matrix of the separable smoothing, resampling and padding of tools21cm.physical_slice_to_angular
+    """
+    # tophat smoothing of tools21cm.smooth_tophat: even slices get one periodic extra cell, then a circular convolution
+    width = max(np.round(n_cells/n_resampled), 1)
+    size = n_cells + 1 if n_cells % 2 == 0 else n_cells
+    kernel = np.zeros(size)
+    kernel[int(size/2-np.floor(width/2.)):int(size/2+np.ceil(width/2.))] = 1.
+    kernel /= kernel.sum()
+
+    cells = np.eye(n_cells)[np.arange(size) % n_cells]
+    smoothing = np.fft.irfft(np.fft.rfft(cells, axis=0)*np.fft.rfft(kernel)[:, np.newaxis], n=size, axis=0)
+    smoothing = np.roll(smoothing, -size//2, axis=0)[:n_cells]
+
+    # order 2 spline interpolation on an even grid spanning the smoothed slice
+    n_smoothed = len(smoothing)
+    coords = [np.linspace(0, n_smoothed-1, n_resampled)]
+    resampling = np.stack([ndimage.map_coordinates(cell, coords, order=2, mode='wrap', prefilter=True)
+                           for cell in np.eye(n_smoothed)], axis=1)
+
+    # periodic padding to the field of view
+    rows = np.concatenate([np.arange(n_resampled), np.arange(n_theta-n_resampled)])
+
+    return (resampling @ smoothing)[rows]
+
+
+@instrument
 def build_observational_lightcone(file_list, 
                                   redshifts, 
                                   box_size,
                                   dnu=0.1,
                                   physical_lightcone=None,
-                                  n_output_cell=None):
+                                  n_output_cell=None,
+                                  dtype=None,
+                                  regridder_cache_dir=None):
     """
-    Build a observational lightcone from a list of 21cm brightness temperature boxs using tools21cm.
+    Build a observational lightcone from a list of 21cm brightness temperature boxs.
     Slices along the line of sight are constructed wit uniform frequency intervals.
+    The result is the same as tools21cm.physical_lightcone_to_observational, the regridding is precomputed once per geometry (see ObservationalRegridder).
 
     Args:
         :file_list: list of str. The list of file paths to the brightness temperature maps in npy files.
@@ -60,13 +307,17 @@ def build_observational_lightcone(file_list,
         :n_output_cell: int. The number of output cells in the observational lightcone. Default is set to the same as the input lightcone.
                             tools21cm will pad the slice whose angular size is smaller than the maximum angular size to match the maximum angular size.
                             Then the slices are interpolated to the same number of cells.
+        :dtype: np.dtype. Float precision of the physical and observational lightcones. Default is pipe21cm.config.dtype.
+        :regridder_cache_dir: str. Directory caching the regridders on disk. If None, the regridder is only cached in memory.
 
     Returns:
         :obs_lc: np.ndarray. The observational lightcone.
         :obs_freq: np.ndarray. The frequency axis of the observational lightcone.
     """
+    import tools21cm as t2c
+
     if physical_lightcone is None:
-        lc, zs_lc = build_physical_lightcone(file_list, redshifts, box_size)  
+        lc, zs_lc = build_physical_lightcone(file_list, redshifts, box_size, dtype=dtype)
     else:
         lc = physical_lightcone
         zs_lc = redshifts  
@@ -76,20 +327,152 @@ def build_observational_lightcone(file_list,
     max_deg = np.max(angular_size_deg)
 
     if n_output_cell is None:
-        n_output_cell = lc.shape[0]
+        n_output_cell = lc.shape[-3]
 
     input_z_low   = np.min(redshifts)
     output_dnu    =  dnu
     output_dtheta = (max_deg/(n_output_cell))*60 #arcmins
     input_box_size_mpc = box_size
 
-    obs_lc, obs_freq = t2c.physical_lightcone_to_observational(lc,
-                                                                input_z_low,
-                                                                output_dnu,
-                                                                output_dtheta,
-                                                                input_box_size_mpc=input_box_size_mpc,
-                                                                verbose=False)
+    regridder = get_observational_regridder(lc.shape[-3], lc.shape[-1], input_box_size_mpc, input_z_low, output_dnu, output_dtheta,
+                                            cache_dir=regridder_cache_dir)
+    obs_lc = regridder.apply(lc, dtype=dtype)
+    obs_freq = regridder.freqs
 
     return obs_lc, obs_freq
-    
-    
+
+
+@instrument
+def build_image_cube(physical_lightcone,
+                     redshifts,
+                     box_size,
+                     out=None,
+                     header=None,
+                     pad_width=120,
+                     n_output_cell=512,
+                     zoom_factor=4,
+                     freq_range=(151, 196),
+                     dnu=0.1,
+                     scale=1e-3,
+                     dtype=None,
+                     regridder_cache_dir=None):
+    """
+    Post-process a physical lightcone into an SDC image cube in one pass: reflect padding of the field of view,
+    observational lightcone, zoom, frequency cut, flip to increasing frequencies, axis order (freq, x, y) and scaling
+    (mK to K), i.e. the steps of sdc/01_forward_modeling.ipynb:
+
+        padded = np.pad(lc, ((pad_width, pad_width), (pad_width, pad_width), (0, 0)), mode='reflect')
+        obs_lc, obs_freq = build_observational_lightcone(None, redshifts, box_size/n_cells*(n_cells+2*pad_width), n_output_cell=n_output_cell, physical_lightcone=padded)
+        zoomed = zoom(obs_lc, (zoom_factor, zoom_factor, 1), order=1)
+        cube = zoomed[..., (obs_freq > freq_range[0]) & (obs_freq < freq_range[1])][..., ::-1].transpose(2, 0, 1)*scale
+
+    The channels outside freq_range are never computed, the padding is folded into the angular regridding matrices, and
+    each channel is zoomed and written to the output on its own, so the memory is one output cube (or none with a file output).
+
+    Args:
+        :physical_lightcone: np.ndarray. The physical lightcone with shape (n_cells, n_cells, n_los), can be a memmap.
+        :redshifts: list of float. The redshifts of the brightness temperature boxes of the lightcone.
+        :box_size: float. The size of the box in Mpc, without padding.
+        :out: np.ndarray or str. Preallocated output array, or the path of a FITS file (.fits) or npy file the cube is
+              memory mapped to. The file is written atomically. If None, the cube is allocated in memory.
+        :header: fits.Header or str. The header of the FITS file, or the path of a FITS file to copy it from
+                 (e.g. the SDC header_only.fits). The data keywords are set from the cube.
+        :pad_width: int. The number of cells reflected on each side of the field of view.
+        :n_output_cell: int. The number of cells of the observational lightcone before the zoom.
+        :zoom_factor: int. The angular upsampling (linear interpolation).
+        :freq_range: tuple. The frequencies in MHz kept (exclusive).
+        :dnu: float. The frequency interval in MHz.
+        :scale: float. The factor applied to the cube, mK to K by default.
+        :dtype: np.dtype. Float precision of the cube. Default is pipe21cm.config.dtype.
+        :regridder_cache_dir: str. Directory caching the regridders on disk. If None, the regridder is only cached in memory.
+
+    Returns:
+        :cube: np.ndarray. The image cube with shape (n_freq, n_pixel, n_pixel), a read-only memmap for a file output.
+        :freqs: np.ndarray. The frequencies of the cube in MHz, increasing.
+    """
+    import tools21cm as t2c
+
+    dtype = resolve_dtype(dtype)
+    redshifts = np.asarray(redshifts, dtype=np.float64)
+    n_cells = physical_lightcone.shape[0]
+    padded_box_size = box_size/n_cells*(n_cells+2*pad_width)
+
+    max_deg = np.max(t2c.angular_size_comoving(padded_box_size, redshifts))
+    output_dtheta = (max_deg/n_output_cell)*60
+    regridder = get_observational_regridder(n_cells+2*pad_width, physical_lightcone.shape[-1], padded_box_size, np.min(redshifts),
+                                            dnu, output_dtheta, cache_dir=regridder_cache_dir)
+
+    # reflect padding as a (n_cells+2*pad_width, n_cells) matrix, folded into the angular regridding
+    padding = np.pad(np.eye(n_cells), ((pad_width, pad_width), (0, 0)), mode='reflect')
+    operators = (regridder.operators @ padding).astype(dtype)
+
+    channels = np.flatnonzero((regridder.freqs > freq_range[0]) & (regridder.freqs < freq_range[1]))[::-1]
+    n_pixel = int(round(regridder.n_theta*zoom_factor))
+    cube_shape = (len(channels), n_pixel, n_pixel)
+
+    path = out if isinstance(out, str) else None
+    if out is None:
+        cube = np.zeros(cube_shape, dtype=dtype)
+    elif path is not None:
+        tmp_path = f'{path}.tmp{uuid.uuid4().hex}'
+        if path.endswith('.fits'):
+            cube = _open_fits_memmap(tmp_path, cube_shape, dtype, header)
+        else:
+            cube = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype, shape=cube_shape)
+    else:
+        assert out.shape == cube_shape, f'out must have shape {cube_shape}, got {out.shape}'
+        cube = out
+
+    weights = regridder.taps_weight.astype(dtype)
+    for idx, channel in enumerate(channels):
+        binned = sum(physical_lightcone[:, :, regridder.taps_index[channel, tap]].astype(dtype, copy=False)*weights[channel, tap]
+                     for tap in range(regridder.taps_index.shape[1]))
+        operator = operators[regridder.slice_operator[channel]]
+        image = ndimage.zoom(operator @ binned @ operator.T, zoom_factor, order=1)
+        image *= scale
+        cube[idx] = image
+
+    if path is not None:
+        cube.flush()
+        offset = cube.offset
+        del cube
+        os.replace(tmp_path, path)
+        cube = np.memmap(path, mode='r', dtype=_fits_dtype(dtype) if path.endswith('.fits') else dtype, offset=offset, shape=cube_shape)
+
+    return cube, regridder.freqs[channels]
+
+
+def _fits_dtype(dtype):
+    """
+    big endian dtype of the FITS data
+    """
+    return np.dtype(dtype).newbyteorder('>')
+
+
+def _open_fits_memmap(path, shape, dtype, header):
+    """
+    create a FITS file with the header and an empty (big endian) data array of the given shape, and memory map its data
+    """
+    from astropy.io import fits
+
+    if isinstance(header, str):
+        header = fits.getheader(header)
+    header = fits.Header() if header is None else header.copy()
+
+    # data keywords of the cube, in the order required by the FITS standard
+    header.set('SIMPLE', True, before=0)
+    header.set('BITPIX', -8*np.dtype(dtype).itemsize, after='SIMPLE')
+    header.set('NAXIS', len(shape), after='BITPIX')
+    for axis in range(len(shape), 0, -1):
+        header.set(f'NAXIS{axis}', shape[len(shape)-axis], after='NAXIS')
+    for key in ['BSCALE', 'BZERO']:
+        header.remove(key, ignore_missing=True)
+
+    header_bytes = header.tostring().encode('ascii')
+    data_size = int(np.prod(shape))*np.dtype(dtype).itemsize
+    with open(path, 'wb') as f:
+        f.write(header_bytes)
+        # the data are padded to a multiple of 2880 bytes
+        f.truncate(len(header_bytes) + -(-data_size//2880)*2880)
+
+    return np.memmap(path, mode='r+', dtype=_fits_dtype(dtype), offset=len(header_bytes), shape=shape)
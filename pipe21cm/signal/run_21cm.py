@@ -1,8 +1,14 @@
-import py21cmfast as p21c
-from py21cmfast import cache_tools
 import numpy as np
 import os
+import json
+import uuid
+import shutil
+import logging
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pipe21cm.profiling import instrument
 
+@instrument
 def run_coeval_bt(
     redshift=12,
     box_size=128,
@@ -28,29 +34,265 @@ def run_coeval_bt(
 
     Returns:
         :results: list of np.ndarray. The brightness temperature map(s) at the specified redshift(s).
+
+    The initial conditions and perturbed fields only depend on the random seed, the box and the redshifts, they are
+    computed once and reused by the following calls that only change hii_eff_factor and ion_tvir_min
+    (e.g. a sweep over astrophysical parameters with a fixed random_seed), see clear_initial_fields.
     """
-    # Define user and astro parameters based on individual arguments
-    user_params = {"HII_DIM": cell_dim, "BOX_LEN": box_size, "N_THREADS":N_THREADS}
+    cos = _run_coevals(redshift, box_size, cell_dim, hii_eff_factor, ion_tvir_min, random_seed, N_THREADS)
+    redshift = np.atleast_1d(redshift)
+    results = [co.brightness_temp for co in cos]
+
+    
+    if save_dir is not None:
+        for idx, res in enumerate(results):
+            np.save(os.path.join(save_dir, f"brightness_temp_{redshift[idx]:.2f}.npy"), res)
+    
+    return results
+
+
+def _run_coevals(redshift, box_size, cell_dim, hii_eff_factor, ion_tvir_min, random_seed, N_THREADS):
+    """
+    run 21cmFAST coeval boxes and return them as a list, also for a scalar redshift
+    """
+    import py21cmfast as p21c
+
+    init_box, perturbed_fields = _initial_fields(tuple(np.atleast_1d(redshift).tolist()), box_size, cell_dim, random_seed, N_THREADS)
     astro_params = p21c.AstroParams({"HII_EFF_FACTOR": hii_eff_factor, "ION_Tvir_MIN": ion_tvir_min})
 
-    # Run the coeval simulation
+    # Only the ionization and brightness temperature boxes are computed for these astro parameters
     cos = p21c.run_coeval(
-        redshift=redshift,
-        user_params=user_params,
         astro_params=astro_params,
-        random_seed=random_seed
+        init_box=init_box,
+        perturb=list(perturbed_fields)
     )
 
-    if len(redshift) > 1:
-        results = [co.brightness_temp for co in cos]
+    return cos
+
+
+@functools.lru_cache(maxsize=1)
+def _initial_fields(redshifts, box_size, cell_dim, random_seed, N_THREADS):
+    """
+    initial conditions and perturbed fields at the redshifts, shared by every astro parameter point of the same seed and box.
+    Only the last ones are kept, they hold a few boxes on the high resolution grid.
+    """
+    import py21cmfast as p21c
+
+    user_params = {"HII_DIM": cell_dim, "BOX_LEN": box_size, "N_THREADS":N_THREADS}
+
+    init_box = p21c.initial_conditions(user_params=user_params, random_seed=random_seed)
+    perturbed_fields = tuple(p21c.perturb_field(redshift=z, init_boxes=init_box) for z in redshifts)
+
+    return init_box, perturbed_fields
+
+
+def clear_initial_fields():
+    """
+    Free the initial conditions and perturbed fields kept by run_coeval_bt for the next astro parameter point.
+    """
+    _initial_fields.cache_clear()
+
+
+def estimate_coeval_memory(cell_dim, dim_ratio=3):
+    """
+    Rough peak memory of one 21cmFAST coeval run in bytes: a few float32 boxes on the high resolution grid
+    (DIM = dim_ratio*HII_DIM, the 21cmFAST default) for the initial conditions plus about twenty low resolution boxes.
+
+    Args:
+        :cell_dim: int. The number of cells along one dimension (HII_DIM).
+        :dim_ratio: int. The ratio between the high and low resolution grids.
+
+    Returns:
+        :memory: float. The memory in bytes.
+    """
+    return 4.*(4*(dim_ratio*cell_dim)**3 + 20*cell_dim**3)
+
+
+def plan_campaign_resources(cell_dim, n_points, n_cores=None, memory_budget=None, N_THREADS=None):
+    """
+    Choose the number of simulations run at once and the N_THREADS of each, so that workers*N_THREADS fits the cores
+    and workers simulations fit the memory budget.
+
+    Args:
+        :cell_dim: int. The number of cells along one dimension.
+        :n_points: int. The number of simulations left to run.
+        :n_cores: int. The number of cores to use. If None, all the cores available to this process.
+        :memory_budget: float. The memory to use in bytes. If None, the memory currently available.
+        :N_THREADS: int. The number of threads of each simulation. If None, the cores are split between the workers.
+
+    Returns:
+        :workers: int. The number of simulations run at once.
+        :N_THREADS: int. The number of threads of each simulation.
+    """
+    if n_cores is None:
+        n_cores = len(os.sched_getaffinity(0))
+    if memory_budget is None:
+        memory_budget = os.sysconf('SC_PAGE_SIZE')*os.sysconf('SC_AVPHYS_PAGES')
+
+    max_workers = max(1, int(memory_budget//estimate_coeval_memory(cell_dim)))
+    if N_THREADS is None:
+        workers = max(1, min(max_workers, n_points, n_cores))
+        N_THREADS = max(1, n_cores//workers)
     else:
-        results = [cos.brightness_temp]
-        redshift = [redshift]
+        workers = max(1, min(max_workers, n_points, n_cores//N_THREADS))
+
+    return workers, N_THREADS
+
+
+@instrument
+def run_campaign(params,
+                 redshift,
+                 out_dir,
+                 box_size=128,
+                 cell_dim=128,
+                 random_seed=42,
+                 seeds=None,
+                 n_cores=None,
+                 memory_budget=None,
+                 N_THREADS=None):
+    """
+    Run 21cmFAST coeval simulations for every point of a parameter table, in parallel and resumable.
+
+    Each point is written to out_dir/point_{index:05d} with brightness_temp_{z:.2f}.npy and xH_{z:.2f}.npy files and a
+    point.json of its parameters, seed and files, and is moved there only once complete, so a point whose directory exists
+    is skipped when the campaign is run again.
+    out_dir/manifest.json records the settings of the campaign and the parameters, seed and files of every finished point,
+    the points missing from it (e.g. after a kill) are recovered from their point.json when the campaign is run again.
+    A point that fails is recorded in manifest['failed'] while the other points go on, and a RuntimeError is raised at the end.
+
+    Args:
+        :params: np.ndarray or str. Table of (hii_eff_factor, ion_tvir_min) with shape (n_points, 2), or the path of a
+                 comma separated file with one header line (e.g. hii_vir_params.txt).
+        :redshift: float or list of floats. The redshift(s) of the coeval boxes.
+        :out_dir: str. The directory of the campaign.
+        :box_size: float. The size of the box in Mpc.
+        :cell_dim: int. The number of cells along one dimension.
+        :random_seed: int. The random seed of every point if seeds is None.
+        :seeds: list of int. The random seed of each point.
+        :n_cores: int. The number of cores to use. If None, all the cores available to this process.
+        :memory_budget: float. The memory to use in bytes. If None, the memory currently available.
+        :N_THREADS: int. The number of threads of each simulation. If None, it is chosen with plan_campaign_resources.
+
+    Returns:
+        :manifest: dict. The manifest of the campaign.
+    """
+    if isinstance(params, str):
+        params = np.loadtxt(params, delimiter=',', skiprows=1)
+    params = np.atleast_2d(params)
+    if seeds is None:
+        seeds = [random_seed]*len(params)
+    redshift_list = np.atleast_1d(redshift).tolist()
+
+    os.makedirs(out_dir, exist_ok=True)
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    if os.path.isfile(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    else:
+        manifest = {'redshift': redshift_list, 'box_size': box_size, 'cell_dim': cell_dim,
+                    'columns': ['hii_eff_factor', 'ion_tvir_min'], 'points': {}}
+    assert manifest['redshift'] == redshift_list and manifest['box_size'] == box_size and manifest['cell_dim'] == cell_dim, \
+        f'the campaign in {out_dir} was run with other settings, use another out_dir.'
+    # the failed points have no directory, they are run again
+    manifest['failed'] = {}
+
+    # points finished after the last manifest update, e.g. when the previous run was killed or a point failed
+    for idx in range(len(params)):
+        name = f'point_{idx:05d}'
+        if name not in manifest['points'] and os.path.isdir(os.path.join(out_dir, name)):
+            manifest['points'][name] = _read_point(out_dir, idx, params, seeds)
+
+    for name, point in manifest['points'].items():
+        idx = point['index']
+        assert idx < len(params) and point == _point_entry(idx, params, seeds, point['files']), \
+            f'{name} of the campaign in {out_dir} was run with other parameters or seed, use another out_dir.'
+    _write_manifest(manifest, manifest_path)
+
+    # points of the same seed are run one after the other, so that each worker reuses its initial conditions and perturbed fields
+    pending = [idx for idx in range(len(params)) if not os.path.isdir(os.path.join(out_dir, f'point_{idx:05d}'))]
+    pending.sort(key=lambda idx: int(seeds[idx]))
+    if len(pending) == 0:
+        return manifest
+
+    workers, N_THREADS = plan_campaign_resources(cell_dim, len(pending), n_cores=n_cores, memory_budget=memory_budget, N_THREADS=N_THREADS)
+
+    with ProcessPoolExecutor(workers) as executor:
+        futures = {executor.submit(_run_campaign_point, out_dir, idx, redshift, box_size, cell_dim,
+                                   float(params[idx, 0]), float(params[idx, 1]), int(seeds[idx]), N_THREADS): idx
+                   for idx in pending}
+        for future in as_completed(futures):
+            idx = futures[future]
+            name = f'point_{idx:05d}'
+            try:
+                manifest['points'][name] = _point_entry(idx, params, seeds, future.result())
+            except Exception as e:
+                # the other points go on, the failed one is run again with the campaign
+                logging.error(f'{name} of the campaign in {out_dir} failed: {e!r}')
+                manifest['failed'][name] = dict(_point_entry(idx, params, seeds, []), error=repr(e))
+            _write_manifest(manifest, manifest_path)
+
+    if manifest['failed']:
+        raise RuntimeError(f"{len(manifest['failed'])} point(s) of the campaign in {out_dir} failed: "
+                           f"{', '.join(sorted(manifest['failed']))}, see {manifest_path}")
+
+    return manifest
+
+
+def _point_entry(idx, params, seeds, files):
+    """
+    manifest entry of one point of run_campaign
+    """
+    return {'index': idx,
+            'hii_eff_factor': float(params[idx, 0]),
+            'ion_tvir_min': float(params[idx, 1]),
+            'random_seed': int(seeds[idx]),
+            'files': files}
+
+
+def _read_point(out_dir, idx, params, seeds):
+    """
+    manifest entry of a finished point from its point.json, or from the parameter table and its files for the points
+    written before point.json existed
+    """
+    point_dir = os.path.join(out_dir, f'point_{idx:05d}')
+    point_path = os.path.join(point_dir, 'point.json')
+    if os.path.isfile(point_path):
+        with open(point_path) as f:
+            return json.load(f)
+
+    return _point_entry(idx, params, seeds, sorted(file for file in os.listdir(point_dir) if file.endswith('.npy')))
+
+
+def _run_campaign_point(out_dir, idx, redshift, box_size, cell_dim, hii_eff_factor, ion_tvir_min, random_seed, N_THREADS):
+    """
+    run one point of run_campaign and move its fields to out_dir/point_{idx:05d} once complete
+    """
+    cos = _run_coevals(redshift, box_size, cell_dim, hii_eff_factor, ion_tvir_min, random_seed, N_THREADS)
+
+    point_dir = os.path.join(out_dir, f'point_{idx:05d}')
+    tmp_dir = f'{point_dir}.tmp{uuid.uuid4().hex}'
+    os.makedirs(tmp_dir)
+    files = []
+    for z, co in zip(np.atleast_1d(redshift), cos):
+        for name, field in [('brightness_temp', co.brightness_temp), ('xH', co.xH_box)]:
+            files.append(f'{name}_{z:.2f}.npy')
+            np.save(os.path.join(tmp_dir, files[-1]), field)
+
+    point = {'index': idx, 'hii_eff_factor': hii_eff_factor, 'ion_tvir_min': ion_tvir_min, 'random_seed': random_seed, 'files': files}
+    with open(os.path.join(tmp_dir, 'point.json'), 'w') as f:
+        json.dump(point, f, indent=1)
+
+    try:
+        os.rename(tmp_dir, point_dir)
+    except OSError:
+        # the point was written by another campaign in the meantime
+        shutil.rmtree(tmp_dir)
+
+    return files
 
-    
-    if save_dir is not None:
-        for idx, res in enumerate(results):
-            np.save(os.path.join(save_dir, f"brightness_temp_{redshift[idx]:.2f}.npy"), res)
-    
-    return results
 
+def _write_manifest(manifest, path):
+    tmp_path = f'{path}.tmp{uuid.uuid4().hex}'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, path)
@@ -1,24 +1,159 @@
 
-import Pk_library as PKL
-import contextlib
-import numpy as np  
+import functools
 
+import numpy as np
+from scipy import fft as sp_fft
+from pipe21cm.profiling import instrument
+from pipe21cm.config import resolve_dtype, complex_dtype
 
-def caculate_icoBk(cube,box_size,kbins=None,thetas=None,norm=True,threads=1):
+
+class BispectrumPlan:
     '''
-    calculate bispectrum from 3D cubes using Pylians3
-    maybe we should implement a pure numpy version
+    FFT bispectrum estimator (Scoccimarro 2015, same estimator as Pylians3 Bk) for cubes of a given geometry.
+    The modes of every shell (within kF of each k), the mode counts of each shell and triangle (the normalisation)
+    are computed once, so a training set of cubes only pays for the FFTs and the field products.
+    As in Pylians3, the k of a shell in the normalisation is the mean |k| of its modes (plan.ks_mean), not the nominal k.
 
     Args:
-        :cube(np.array): 3D cube
+        :dims(int): number of cells along each axis of the cubes
+        :box_size(float): size of the cube
+        :k1(np.array): k1 of the triangles
+        :k2(np.array): k2 of the triangles
+        :k3(np.array): k3 of the triangles
+        :norm(bool): normalize the bispectrum following Watkinson et al 2019 or not
+        :dtype(np.dtype): float precision of the FFTs and of the bispectrum, Pylians3 works in np.float32. Default is pipe21cm.config.dtype
+        :threads(int): number of threads of the scipy.fft worker pool
+        :max_shells(int): maximum number of shell fields kept in memory, each holds one cube per cube of the batch
+    '''
+
+    def __init__(self, dims, box_size, k1, k2, k3, norm=True, dtype=None, threads=1, max_shells=8):
+        assert max_shells >= 3, 'at least the 3 shells of a triangle must fit in memory'
+
+        self.dims = dims
+        self.box_size = box_size
+        self.norm = norm
+        self.dtype = resolve_dtype(dtype)
+        self.threads = threads
+        self.max_shells = max_shells
+        self.ks = np.stack(np.broadcast_arrays(k1, k2, k3), axis=-1).astype(np.float64)
+
+        # every distinct k is one shell, stored as the flat indices of its rfftn modes
+        kF = 2*np.pi/box_size
+        kmod = _kmod_grid(dims).ravel()
+        self.shell_k = np.unique(self.ks)
+        self.shell_modes = [np.flatnonzero((kmod >= (k-kF)/kF) & (kmod < (k+kF)/kF)) for k in self.shell_k]
+        self.triangle_shells = np.searchsorted(self.shell_k, self.ks)
+
+        # mean |k| of the modes of each shell over the full FFT grid (BBk.k of Pylians3), the rfftn modes with 0<kz<dims/2
+        # stand for two modes of the full grid
+        weights = _rfft_weights(dims).ravel()
+        self.shell_kmean = np.array([kF*np.sum(weights[modes]*kmod[modes])/np.sum(weights[modes]) if len(modes) > 0 else k
+                                     for k, modes in zip(self.shell_k, self.shell_modes)])
+        self.ks_mean = self.shell_kmean[self.triangle_shells]
+
+        # a shell field is dropped after the last triangle using it
+        self._last_use = {}
+        for idx, tri in enumerate(self.triangle_shells):
+            for shell in tri:
+                self._last_use[shell] = idx
+
+        # mode counts from the products of the shell indicator fields
+        ones = np.ones((1, len(kmod)), dtype=complex_dtype(self.dtype))
+        pairs, triangles = self._shell_sums(ones)
+        self.pairs, self.triangles = pairs[0], triangles[0]
+
+    def _shell_sums(self, modes_k):
+        '''
+        sums of the squared shell fields and of the triple products of the shell fields of each triangle
+
+        Args:
+            :modes_k(np.array): flattened rfftn of a batch of cubes, with shape (n_cubes, n_modes)
+
+        Returns:
+            :squares(np.array): sum of each squared shell field, with shape (n_cubes, n_shells)
+            :products(np.array): sum of the product of the 3 shell fields of each triangle, with shape (n_cubes, n_triangles)
+        '''
+        n_cubes = len(modes_k)
+        shape = (self.dims,)*3
+        squares = np.zeros((n_cubes, len(self.shell_k)))
+        products = np.zeros((n_cubes, len(self.triangle_shells)))
+
+        # least recently used shell fields are evicted when more than max_shells are held
+        fields = {}
+        for idx, tri in enumerate(self.triangle_shells):
+            for shell in tri:
+                if shell in fields:
+                    fields[shell] = fields.pop(shell)
+                    continue
+                shell_k = np.zeros_like(modes_k)
+                shell_k[:, self.shell_modes[shell]] = modes_k[:, self.shell_modes[shell]]
+                field = sp_fft.irfftn(shell_k.reshape((n_cubes,)+shape[:2]+(self.dims//2+1,)), s=shape, axes=(1, 2, 3), workers=self.threads)
+                squares[:, shell] = np.sum((field**2).reshape(n_cubes, -1), axis=1, dtype=np.float64)
+                fields[shell] = field
+                if len(fields) > self.max_shells:
+                    fields.pop(next(shell for shell in fields if shell not in tri))
+
+            product = fields[tri[0]]*fields[tri[1]]*fields[tri[2]]
+            products[:, idx] = np.sum(product.reshape(n_cubes, -1), axis=1, dtype=np.float64)
+
+            for shell in set(tri):
+                if self._last_use[shell] == idx:
+                    del fields[shell]
+
+        return squares, products
+
+    @instrument
+    def compute(self, cubes, batch_size=1):
+        '''
+        calculate the bispectrum of every triangle for a batch of cubes
+
+        Args:
+            :cubes(np.array): cubes with shape (n_cubes, dims, dims, dims), can be a memmap
+            :batch_size(int): number of cubes transformed together, the memory grows with batch_size*max_shells cubes
+
+        Returns:
+            :bs(np.array): bispectrum with shape (n_cubes, n_triangles)
+        '''
+        cubes = np.asanyarray(cubes)
+        assert cubes.shape[-3:] == (self.dims,)*3, f'cubes must have shape (n_cubes, {self.dims}, {self.dims}, {self.dims}), got {cubes.shape}'
+        cubes = cubes.reshape((-1,)+(self.dims,)*3)
+
+        bs = np.zeros((len(cubes), len(self.triangle_shells)), dtype=self.dtype)
+        for start in range(0, len(cubes), batch_size):
+            batch = np.asarray(cubes[start:start+batch_size], dtype=self.dtype)
+            modes_k = sp_fft.rfftn(batch, axes=(1, 2, 3), workers=self.threads).reshape(len(batch), -1)
+            squares, products = self._shell_sums(modes_k)
+
+            # fields full of zeros (for example completely ionized 21cm field) give 0 instead of nan
+            with np.errstate(divide='ignore', invalid='ignore'):
+                batch_bs = np.where(self.triangles > 0, products/self.triangles, 0)*(self.box_size**2/self.dims**3)**3
+
+                if self.norm:
+                    pk = squares/self.pairs*(self.box_size/self.dims**2)**3
+                    normal_fac = np.sqrt(np.prod(pk[:, self.triangle_shells], axis=-1)/np.prod(self.ks_mean, axis=-1))
+                    batch_bs = np.where(normal_fac > 0, batch_bs/normal_fac, 0)
+
+            bs[start:start+batch_size] = batch_bs
+
+        return bs
+
+
+def get_icoBk_plan(dims,box_size,kbins=None,thetas=None,norm=True,threads=1,dtype=None):
+    '''
+    get the (cached) plan of the isosceles triangles used by caculate_icoBk, only triangles passing get_k_filter are kept
+
+    Args:
+        :dims(int): number of cells along each axis of the cubes
         :boxsize(float): size of the cube
         :kbins(np.array): array of k bins
         :thetas(np.array): array of angles
         :norm(bool): normalize the bispectrum or not
         :threads(int): number of threads
+        :dtype(np.dtype): float precision of the FFTs and of the bispectrum. Default is pipe21cm.config.dtype
 
     Returns:
-        :bs_cube(np.array): bispectrum array
+        :plan(BispectrumPlan): bispectrum plan, plan.ks[:, 0] and plan.ks[:, 2] are the nominal k1(=k2) and k3 of the triangles,
+                               plan.ks_mean the mean |k| of the modes of their shells
     '''
 
     if kbins is None:
@@ -31,36 +166,94 @@ def caculate_icoBk(cube,box_size,kbins=None,thetas=None,norm=True,threads=1):
     if thetas is None:
         thetas = np.array([0.05, 0.1, 0.2, 0.33, 0.4, 0.5, 0.6, 0.7, 0.85, 0.95])*np.pi
 
-    cube=np.array(cube,dtype=np.float32)
+    return _get_icoBk_plan(dims, box_size, tuple(np.asarray(kbins, dtype=np.float64)), tuple(np.asarray(thetas, dtype=np.float64)), norm, threads, resolve_dtype(dtype))
 
-    bs_cube=np.zeros((len(kbins),len(thetas)))
-    #make a meshgrid of k to store the final k values
-    k3_all,k1_all = np.meshgrid(thetas,kbins)
 
-    for idx, k_to_cal in enumerate(kbins):
+@functools.lru_cache(maxsize=8)
+def _get_icoBk_plan(dims, box_size, kbins, thetas, norm, threads, dtype):
+    kbins = np.array(kbins)
+    thetas = np.array(thetas)
 
-        # we only consider isoceles triangles, k1=k2 is determine by the input bins, k3 is determined by the angle
-        k1 = k_to_cal    
-        k2 = k_to_cal  
+    # we only consider isoceles triangles, k1=k2 is determine by the input bins, k3 is determined by the angle
+    k3_all = np.sqrt((kbins[:, np.newaxis]*np.sin(thetas))**2 + (kbins[:, np.newaxis]*np.cos(thetas)+kbins[:, np.newaxis])**2)
+    k1_all = np.broadcast_to(kbins[:, np.newaxis], k3_all.shape)
 
-        # compute bispectrum
-        try:
-            with contextlib.redirect_stdout(None):
-                BBk = PKL.Bk(cube,box_size, k1, k2, thetas, None, threads)
-            
-            k3_all[idx]=BBk.k[2:]
-            if norm:
-                bs_cube[idx]=normalized_BS(BBk)
-            else:
-                bs_cube[idx]=BBk.B
+    # excluded triangles are never computed
+    selection=get_k_filter(box_size,kbins,thetas)
 
-        except ZeroDivisionError:
-            #handle the ZeroDivisionError which may occur when the field is full of zeros (for example completely ionized 21cm field)
-            bs_cube[idx]=0
+    return BispectrumPlan(dims, box_size, k1_all[selection], k1_all[selection], k3_all[selection], norm=norm, dtype=dtype, threads=threads)
 
-    selection=get_k_filter(box_size,kbins,thetas)
 
-    return k1_all[selection],k3_all[selection],bs_cube[selection]
+@instrument
+def caculate_icoBk(cube,box_size,kbins=None,thetas=None,norm=True,threads=1,dtype=None):
+    '''
+    calculate bispectrum of isosceles triangles from 3D cubes with the numpy FFT estimator (same estimator as Pylians3 Bk)
+    only triangles passing get_k_filter are computed, the plan is cached across calls with the same configuration
+
+    Args:
+        :cube(np.array): 3D cube
+        :boxsize(float): size of the cube
+        :kbins(np.array): array of k bins
+        :thetas(np.array): array of angles
+        :norm(bool): normalize the bispectrum or not
+        :threads(int): number of threads
+        :dtype(np.dtype): float precision of the FFTs and of the bispectrum. Default is pipe21cm.config.dtype
+
+    Returns:
+        :k1(np.array): k1(=k2) of the selected triangles, the k bins
+        :k3(np.array): k3 of the selected triangles, the mean |k| of the modes of the k3 shell as BBk.k of Pylians3
+        :bs(np.array): bispectrum of the selected triangles
+    '''
+
+    cube = np.asarray(cube)
+    plan = get_icoBk_plan(cube.shape[0], box_size, kbins=kbins, thetas=thetas, norm=norm, threads=threads, dtype=dtype)
+
+    return plan.ks[:, 0], plan.ks_mean[:, 2], plan.compute(cube[np.newaxis])[0]
+
+
+@instrument
+def fft_bispectrum(cube, box_size, k1, k2, k3, norm=True, dtype=None, threads=1):
+    '''
+    calculate bispectrum of general triangles (k1, k2, k3) using FFTs, see BispectrumPlan
+
+    Args:
+        :cube(np.array): 3D cube with the same number of cells along each axis
+        :box_size(float): size of the cube
+        :k1(np.array): k1 of the triangles
+        :k2(np.array): k2 of the triangles
+        :k3(np.array): k3 of the triangles
+        :norm(bool): normalize the bispectrum following Watkinson et al 2019 or not
+        :dtype(np.dtype): float precision of the FFTs and of the bispectrum, Pylians3 works in np.float32. Default is pipe21cm.config.dtype
+        :threads(int): number of threads of the scipy.fft worker pool
+
+    Returns:
+        :bs(np.array): bispectrum of each triangle
+    '''
+
+    cube = np.asarray(cube)
+    plan = BispectrumPlan(cube.shape[0], box_size, k1, k2, k3, norm=norm, dtype=dtype, threads=threads)
+
+    return plan.compute(cube[np.newaxis])[0]
+
+
+def _kmod_grid(dims):
+    '''
+    |k| of the rfftn grid modes of a (dims, dims, dims) cube in units of the fundamental frequency
+    '''
+    k = np.fft.fftfreq(dims, 1./dims)
+    kx, ky, kz = np.meshgrid(k, k, np.abs(k[:dims//2+1]), indexing='ij', sparse=True)
+    return np.sqrt(kx**2 + ky**2 + kz**2)
+
+
+def _rfft_weights(dims):
+    '''
+    number of modes of the full FFT grid each rfftn mode of a (dims, dims, dims) cube stands for
+    '''
+    weights = np.full(dims//2+1, 2.)
+    weights[0] = 1.
+    if dims % 2 == 0:
+        weights[-1] = 1.
+    return np.broadcast_to(weights, (dims, dims, dims//2+1))
 
 
 def get_k_filter(boxsize,kbins,thetas):
@@ -90,16 +283,17 @@ def get_k_filter(boxsize,kbins,thetas):
 def normalized_BS(BBk):
     '''
     normalize bs following Watkinson et al 2019
+    BBk is any object with the B, Pk and k attributes of a Pylians3 Bk result
     '''
     bs=BBk.B
     ps=BBk.Pk
     ks=BBk.k
-    
+
     k1,Pk1=ks[0],ps[0]
     k2,Pk2=ks[1],ps[1]
     k3s,Pk3s=ks[2:],ps[2:]
-    
+
     normal_fac=np.sqrt((Pk1*Pk2*Pk3s)/(k1*k2*k3s))
     bs_norm=bs/normal_fac
-    
+
     return bs_norm
@@ -1,50 +1,394 @@
+import functools
+
 import numpy as np
+from scipy import fft as sp_fft
+from scipy.ndimage import distance_transform_edt
+from pipe21cm.profiling import instrument
+from pipe21cm.config import resolve_dtype
+
+# number of planes along the first axis reduced per np.bincount call, bounds the temporaries
+_CHUNK_PLANES = 16
+
+
+class PowerSpectrumPlan:
+    '''
+    Precomputed k binning of the rfftn grid for cubes of a given geometry.
+    The bin index of every Fourier mode is computed once, so each cube only costs one rfftn
+    and a chunked np.bincount. Binning follows tools21cm (power_spectrum_1d/2d with default settings).
+    Use get_1dpk_plan/get_2dpk_plan to get cached instances.
+
+    Args:
+        :shape(tuple): shape of the input cubes
+        :box_dims(tuple): size of the cube along each axis in Mpc
+        :bin_index(np.array): flat bin index of each rfftn mode, n_bins for modes outside the bins
+        :bin_shape(tuple): shape of the binned power spectrum
+        :k_mid(tuple): k values of the bin centers along each binned dimension
+    '''
+
+    def __init__(self, shape, box_dims, bin_index, bin_shape, k_mid):
+        self.shape = tuple(shape)
+        self.box_dims = tuple(box_dims)
+        self.bin_index = bin_index
+        self.bin_shape = tuple(bin_shape)
+        self.n_bins = int(np.prod(bin_shape))
+        self.k_mid = k_mid
+
+        boxvol = np.prod(self.box_dims)
+        pixelsize = boxvol/np.prod(self.shape)
+        self.norm = pixelsize**2/boxvol
+
+        # the rfftn grid stores half of the last axis, every mode except k=0 and the Nyquist mode stands for its conjugate too
+        n_last = self.shape[-1]
+        self.mode_weight = np.full(n_last//2+1, 2.)
+        self.mode_weight[0] = 1.
+        if n_last % 2 == 0:
+            self.mode_weight[-1] = 1.
+
+        self.n_modes = self._reduce(lambda start, stop: np.broadcast_to(self.mode_weight, self.bin_index[start:stop].shape), 1)[0]
+        self.fill_index = _empty_bin_fill_index(self.n_modes.reshape(self.bin_shape) == 0)
+
+    def _reduce(self, values, n_cubes):
+        '''
+        sum values(start, stop), the (n_cubes, ...) rfftn grid planes [start, stop), into the bins of each cube
+        '''
+        # offset the bin index of each cube so that a single bincount reduces the whole batch
+        offsets = (np.arange(n_cubes)*(self.n_bins+1)).reshape((-1,)+(1,)*len(self.shape))
+        sums = np.zeros(n_cubes*(self.n_bins+1))
+        for start in range(0, self.bin_index.shape[0], _CHUNK_PLANES):
+            stop = start + _CHUNK_PLANES
+            sums += np.bincount((self.bin_index[start:stop] + offsets).ravel(),
+                                weights=np.ravel(values(start, stop)),
+                                minlength=n_cubes*(self.n_bins+1))
+        return sums.reshape(n_cubes, self.n_bins+1)[:, :-1]
+
+    @instrument
+    def bin_power(self, cube, dtype=None, workers=None):
+        '''
+        compute the binned power spectrum of a cube or a batch of cubes
+
+        Args:
+            :cube(np.array): cube with the plan's shape, optionally with leading batch dimensions
+            :dtype(np.dtype): float precision of the FFT, np.float32 halves the memory traffic. Default is pipe21cm.config.dtype
+            :workers(int): number of threads of the scipy.fft worker pool
+
+        Returns:
+            :pk(np.array): binned power spectrum with shape batch_shape+bin_shape
+        '''
+        dtype = resolve_dtype(dtype)
+        cube = np.asarray(cube, dtype=dtype)
+        batch_shape = cube.shape[:cube.ndim-len(self.shape)]
+        assert cube.shape[len(batch_shape):] == self.shape, f'cube shape {cube.shape} does not match the plan shape {self.shape}'
+
+        cube = cube.reshape((-1,)+self.shape)
+        ft = sp_fft.rfftn(cube, axes=tuple(range(1, cube.ndim)), workers=workers)
+        mode_weight = self.mode_weight.astype(cube.dtype)
+
+        def power(start, stop):
+            f = ft[:, start:stop]
+            p = f.real**2 + f.imag**2
+            p *= mode_weight
+            return p
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pk = self._reduce(power, len(cube))*self.norm/self.n_modes
+        pk = pk[:, self.fill_index]
+
+        return pk.reshape(batch_shape+self.bin_shape).astype(dtype, copy=False)
+
+
+def _empty_bin_fill_index(empty):
+    '''
+    flat gather index filling bins without modes with their nearest non-empty neighbour in index space (as tools21cm does)
+    '''
+    fill_index = np.arange(empty.size)
+    if not empty.any() or empty.all():
+        return fill_index
+
+    if empty.ndim == 1:
+        non_empty = np.where(~empty)[0]
+        for ni in np.where(empty)[0]:
+            fill_index[ni] = non_empty[np.argmin(np.abs(non_empty - ni))]
+    else:
+        _, (ri, ci) = distance_transform_edt(empty, return_indices=True)
+        fill_index = np.ravel_multi_index((ri.ravel(), ci.ravel()), empty.shape)
+
+    return fill_index
+
+
+def _get_dims(box_size, shape):
+    '''
+    box size along each axis, a scalar box_size means a cubic box
+    '''
+    if np.ndim(box_size) == 0:
+        return (float(box_size),)*len(shape)
+    return tuple(float(b) for b in box_size)
+
+
+def _kbins_key(kbins):
+    '''
+    hashable version of kbins for the plan cache
+    '''
+    if np.ndim(kbins) == 0:
+        return int(kbins) if isinstance(kbins, (int, np.integer)) else float(kbins)
+    return tuple(_kbins_key(kb) for kb in kbins)
+
+
+def _rfft_k_components(shape, box_dims):
+    '''
+    k components (in Mpc^-1) of the rfftn grid along each axis, shaped to broadcast against each other
+    '''
+    ndim = len(shape)
+    k_comp = []
+    for axis, (n, length) in enumerate(zip(shape, box_dims)):
+        if axis == ndim-1:
+            m = np.arange(n//2+1, dtype=np.float64)
+        else:
+            m = np.fft.ifftshift(np.arange(n) - n//2).astype(np.float64)
+        k_shape = [1]*ndim
+        k_shape[axis] = len(m)
+        k_comp.append((2.*np.pi*m/length).reshape(k_shape))
+    return k_comp
+
+
+def _compact_index(idx, n_bins):
+    '''
+    map out-of-range bins to n_bins and store the index with the smallest integer type
+    '''
+    idx = np.where((idx >= 0) & (idx < n_bins), idx, n_bins)
+    return idx.astype(np.min_scalar_type(n_bins))
+
+
+def get_1dpk_plan(shape, box_size, kbins):
+    '''
+    get the (cached) binning plan for spherically averaged power spectra
+
+    Args:
+        :shape(tuple): shape of the 3D cube
+        :box_size(float or list): size of the cube in Mpc
+        :kbins(np.array or int): array of k egdes or number of log bins
 
-import tools21cm as t2c
+    Returns:
+        :plan(PowerSpectrumPlan): binning plan
+    '''
+    return _get_1dpk_plan(tuple(shape), _get_dims(box_size, shape), _kbins_key(kbins))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_1dpk_plan(shape, box_dims, kbins):
+    k_comp = _rfft_k_components(shape, box_dims)
+
+    if isinstance(kbins, int):
+        kmin = 2.*np.pi/min(box_dims)
+        # the largest |k| is reached where every component is largest
+        kmax = np.sqrt(sum(np.max(kc**2) for kc in k_comp))
+        edges = 10**np.linspace(np.log10(kmin), np.log10(kmax), kbins+1)
+    else:
+        edges = np.array(kbins)
+    n_bins = len(edges)-1
+
+    grid_shape = tuple(len(kc.ravel()) for kc in k_comp)
+    bin_index = np.empty(grid_shape, dtype=np.min_scalar_type(n_bins))
+    for start in range(0, grid_shape[0], _CHUNK_PLANES):
+        stop = start + _CHUNK_PLANES
+        k2 = k_comp[0][start:stop]**2
+        for kc in k_comp[1:]:
+            k2 = k2 + kc**2
+        k = np.sqrt(k2)
+        idx = np.digitize(k, edges) - 1
+        # np.histogram includes the right edge in the last bin
+        idx[k == edges[-1]] = n_bins - 1
+        bin_index[start:stop] = _compact_index(idx, n_bins)
+
+    dk = (edges[1:] - edges[:-1])/2.
+    k_mid = (edges[:-1] + dk,)
+
+    return PowerSpectrumPlan(shape, box_dims, bin_index, (n_bins,), k_mid)
+
+
+def get_2dpk_plan(shape, box_size, kbins, nu_axis=2):
+    '''
+    get the (cached) binning plan for cylindrical (kper, kpar) power spectra
+
+    Args:
+        :shape(tuple): shape of the 3D lightcone
+        :box_size(float or list): size of the cube in Mpc
+        :kbins(int, list of int or list of arrays): number of log bins (for kper and kpar), or explicit [kper, kpar] edges
+        :nu_axis(int): line of sight axis
+
+    Returns:
+        :plan(PowerSpectrumPlan): binning plan
+    '''
+    return _get_2dpk_plan(tuple(shape), _get_dims(box_size, shape), _kbins_key(kbins), nu_axis)
+
+
+@functools.lru_cache(maxsize=8)
+def _get_2dpk_plan(shape, box_dims, kbins, nu_axis):
+    k_comp = _rfft_k_components(shape, box_dims)
+    xy_axis = [axis for axis in range(3) if axis != nu_axis]
+    kz = np.abs(k_comp[nu_axis])
+    kp = np.sqrt(k_comp[xy_axis[0]]**2 + k_comp[xy_axis[1]]**2)
+
+    if isinstance(kbins, int):
+        kbins = (kbins, kbins)
+
+    if isinstance(kbins[0], int):
+        # log binning between the smallest non-zero mode and the largest mode
+        edges_per = np.linspace(np.log10(kp[kp != 0].min()), np.log10(kp.max()), kbins[0]+1)
+        edges_par = np.linspace(np.log10(kz[kz != 0].min()), np.log10(kz.max()), kbins[1]+1)
+        with np.errstate(divide='ignore'):
+            kp, kz = np.log10(kp), np.log10(kz)
+        kper_mid = np.power(10, 0.5*(edges_per[:-1] + edges_per[1:]))
+        kpar_mid = np.power(10, 0.5*(edges_par[:-1] + edges_par[1:]))
+    else:
+        edges_per, edges_par = np.array(kbins[0]), np.array(kbins[1])
+        kper_mid = (edges_per[:-1] + edges_per[1:])/2.
+        kpar_mid = (edges_par[:-1] + edges_par[1:])/2.
+
+    n_per, n_par = len(edges_per)-1, len(edges_par)-1
+    ip = _digitize_inclusive(kp, edges_per)
+    iz = _digitize_inclusive(kz, edges_par)
+    valid = (ip >= 0) & (ip < n_per) & (iz >= 0) & (iz < n_par)
+    idx = np.where(valid, ip*n_par + iz, -1)
+
+    bin_index = _compact_index(idx, n_per*n_par)
+
+    return PowerSpectrumPlan(shape, box_dims, bin_index, (n_per, n_par), (kper_mid, kpar_mid))
 
 
-def calculate_1dpk(dT,box_size,kbins,norm=True):
+def _digitize_inclusive(x, edges):
     '''
-    calculate power spectrum using tools21cm
-    we should implement a our own version to reduce the dependency
+    bin index of x following scipy.stats.binned_statistic: values on the rightmost edge go to the last bin
+    '''
+    idx = np.digitize(x, edges) - 1
+    decimal = int(-np.log10(np.diff(edges).min())) + 6
+    on_edge = (x >= edges[-1]) & (np.around(x, decimal) == np.around(edges[-1], decimal))
+    return idx - on_edge
+
+
+def _band_slices(n_los, freqs, freq_windows):
+    '''
+    slices along the line of sight selecting each (fmin, fmax) frequency window, the whole axis if no window is given
+    '''
+    if freq_windows is None:
+        return [slice(0, n_los)]
+
+    assert freqs is not None, 'freqs must be provided to select frequency windows'
+    freqs = np.asarray(freqs)
+    assert len(freqs) == n_los, f'got {len(freqs)} frequencies for {n_los} slices along the line of sight'
+
+    slices = []
+    for fmin, fmax in freq_windows:
+        sel = np.flatnonzero((freqs >= fmin) & (freqs <= fmax))
+        assert len(sel) > 0, f'no slices in the frequency window ({fmin}, {fmax})'
+        slices.append(slice(sel[0], sel[-1]+1))
+    return slices
+
+
+def _batched_power(cubes, box_size, get_plan, nu_axis, freqs, freq_windows, dtype, threads, batch_size):
+    '''
+    binned power spectra of a stack of cubes in every frequency window, sharing one plan per window
+
+    Returns:
+        :pk(np.array): power spectra with shape (n_cubes, n_bands)+bin_shape
+        :k_mid(list): k values of the bin centers of each band
+        :batch_shape(tuple): leading batch dimensions of the input
+    '''
+    dtype = resolve_dtype(dtype)
+    cubes = np.asanyarray(cubes)
+    batch_shape = cubes.shape[:-3]
+    shape = cubes.shape[-3:]
+    cubes = cubes.reshape((-1,)+shape)
+    box_dims = _get_dims(box_size, shape)
+
+    pk, k_mid = [], []
+    for band in _band_slices(shape[nu_axis], freqs, freq_windows):
+        # cells are assumed uniform along the line of sight, the band covers a proportional part of the box
+        band_shape = list(shape)
+        band_shape[nu_axis] = band.stop - band.start
+        band_dims = list(box_dims)
+        band_dims[nu_axis] = box_dims[nu_axis]*band_shape[nu_axis]/shape[nu_axis]
+        plan = get_plan(band_shape, band_dims)
+
+        band_index = [slice(None)]*4
+        band_index[1+nu_axis] = band
+        band_pk = np.empty((len(cubes),)+plan.bin_shape, dtype=dtype)
+        for start in range(0, len(cubes), batch_size):
+            band_pk[start:start+batch_size] = plan.bin_power(cubes[start:start+batch_size][tuple(band_index)], dtype=dtype, workers=threads)
+
+        pk.append(band_pk)
+        k_mid.append(plan.k_mid)
+
+    return np.stack(pk, axis=1), k_mid, batch_shape
+
+
+@instrument
+def calculate_1dpk(dT,box_size,kbins,norm=True,dtype=None,nu_axis=2,freqs=None,freq_windows=None,threads=1,batch_size=16):
+    '''
+    calculate spherically averaged power spectrum with a cached k binning plan (same binning as tools21cm.power_spectrum_1d)
+    A stack of cubes and several frequency windows are computed in one pass sharing the plan of each window.
 
     Args:
-        :dT(np.array): 3D cube
+        :dT(np.array): 3D cube, or a stack of cubes with leading batch dimensions (can be a memmap)
         :box_size(float): size of the cube
         :kbins(np.array or int): array of k egdes or number of bins
         :norm(bool): normalize the power spectrum or not
+        :dtype(np.dtype): float precision of the FFT, np.float64 or np.float32. Default is pipe21cm.config.dtype
+        :nu_axis(int): line of sight axis, only used with freq_windows
+        :freqs(np.array): frequency of each slice along nu_axis in MHz, only used with freq_windows
+        :freq_windows(list): list of (fmin, fmax) in MHz, e.g. [(151, 166), (166, 181), (181, 196)]. Cells are assumed uniform along nu_axis.
+        :threads(int): number of threads of the scipy.fft worker pool
+        :batch_size(int): number of cubes transformed together
 
     Returns:
-        :ks(np.array): k values
-        :pk(np.array): power spectrum values
+        :ks(np.array): k values, with shape (n_bands, n_k) if freq_windows is given
+        :pk(np.array): power spectrum values, with shape batch_shape+(n_bands, n_k) if freq_windows is given
     '''
-    
-    pk, ks = t2c.power_spectrum_1d(dT, kbins=kbins, box_dims=box_size)
+
+    get_plan = lambda shape, box_dims: get_1dpk_plan(shape, box_dims, kbins)
+    pk, k_mid, batch_shape = _batched_power(dT, box_size, get_plan, nu_axis, freqs, freq_windows, dtype, threads, batch_size)
+    ks = np.array([k[0] for k in k_mid])
 
     if norm:
-        pk = pk*ks**3/2/np.pi**2
-    
-    return  ks,pk
+        pk = pk*(ks**3/2/np.pi**2).astype(pk.dtype)
 
-def calculate_2dpk(lc, box_size, kbins, nu_axis=2, norm=True):
+    if freq_windows is None:
+        ks, pk = ks[0], pk[:, 0]
+
+    return  ks,pk.reshape(batch_shape+pk.shape[1:])
+
+@instrument
+def calculate_2dpk(lc, box_size, kbins, nu_axis=2, norm=True, dtype=None, freqs=None, freq_windows=None, threads=1, batch_size=16):
     '''
-    calculate 2d Cylinder power spectrum using tools21cm
+    calculate 2d Cylinder power spectrum with a cached k binning plan (same log binning as tools21cm.power_spectrum_2d)
+    A stack of lightcones and several frequency windows are computed in one pass sharing the plan of each window.
 
     Args:
-        :lc(np.array): 3D lightcone
+        :lc(np.array): 3D lightcone, or a stack of lightcones with leading batch dimensions (can be a memmap)
         :box_size(float or list): size of the cube in Mpc
         :kbins(int): number of bins for kper and kpar
+        :nu_axis(int): line of sight axis
         :norm(bool): normalize the power spectrum or not
+        :dtype(np.dtype): float precision of the FFT, np.float64 or np.float32. Default is pipe21cm.config.dtype
+        :freqs(np.array): frequency of each slice along nu_axis in MHz, only used with freq_windows
+        :freq_windows(list): list of (fmin, fmax) in MHz, e.g. [(151, 166), (166, 181), (181, 196)]. Cells are assumed uniform along nu_axis.
+        :threads(int): number of threads of the scipy.fft worker pool
+        :batch_size(int): number of lightcones transformed together
 
     Returns:
-        :kper_mid(np.array): kper values
-        :kpar_mid(np.array): kpar values
-        :p2d(np.array): 2D power spectrum
+        :kper_mid(np.array): kper values, with shape (n_bands, n_kper) if freq_windows is given
+        :kpar_mid(np.array): kpar values, with shape (n_bands, n_kpar) if freq_windows is given
+        :p2d(np.array): 2D power spectrum, with shape batch_shape+(n_bands, n_kper, n_kpar) if freq_windows is given
     '''
 
-    p2d, kper_mid, kpar_mid = t2c.power_spectrum_2d(lc, kbins=kbins, box_dims=box_size, binning='log', nu_axis=2)
+    get_plan = lambda shape, box_dims: get_2dpk_plan(shape, box_dims, kbins, nu_axis=nu_axis)
+    p2d, k_mid, batch_shape = _batched_power(lc, box_size, get_plan, nu_axis, freqs, freq_windows, dtype, threads, batch_size)
+    kper_mid = np.array([k[0] for k in k_mid])
+    kpar_mid = np.array([k[1] for k in k_mid])
 
     if norm:
         pass
 
-    return kper_mid, kpar_mid, p2d
\ No newline at end of file
+    if freq_windows is None:
+        kper_mid, kpar_mid, p2d = kper_mid[0], kpar_mid[0], p2d[:, 0]
+
+    return kper_mid, kpar_mid, p2d.reshape(batch_shape+p2d.shape[1:])
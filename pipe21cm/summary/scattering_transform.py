@@ -1,12 +1,91 @@
 
-import torch
+import os
+import uuid
+import shutil
+import functools
+import contextlib
+import collections
 import numpy as np
 import logging
-from kymatio.numpy import HarmonicScattering3D
-from kymatio.torch import HarmonicScattering3D as HarmonicScattering3D_torch
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from pipe21cm.profiling import instrument
+from pipe21cm.config import resolve_dtype
+
+
+class _FilterCacheMixin:
+    '''
+    Load the solid harmonic and gaussian filter banks of kymatio's HarmonicScattering3D from a disk cache
+    instead of rebuilding them, the cache is written the first time a configuration is used.
+    '''
+
+    def __init__(self, *args, filter_cache_dir=None, **kwargs):
+        self.filter_cache_dir = filter_cache_dir
+        super().__init__(*args, **kwargs)
+
+    def build(self):
+        from kymatio.scattering3d.frontend.base_frontend import ScatteringBase3D
+
+        # same steps as the kymatio frontends, which call ScatteringBase3D.create_filters directly
+        ScatteringBase3D._instantiate_backend(self, 'kymatio.scattering3d.backend.')
+        ScatteringBase3D.build(self)
+        self.create_filters()
+        if hasattr(self, 'register_filters'):
+            self.register_filters()
+
+    def create_filters(self):
+        if self.filter_cache_dir is None:
+            return super().create_filters()
+
+        key = 'J{}_L{}_shape{}_sigma{}_powers{}'.format(self.J, self.L, 'x'.join(str(n) for n in self.shape),
+                                                        self.sigma_0, '-'.join(str(p) for p in self.integral_powers))
+        path = os.path.join(self.filter_cache_dir, key)
+
+        if not os.path.isdir(path):
+            super().create_filters()
+
+            # write to a temporary directory first so that concurrent workers never read a partial cache
+            tmp_path = f'{path}.tmp{uuid.uuid4().hex}'
+            os.makedirs(tmp_path)
+            for l, filters_l in enumerate(self.filters):
+                np.save(os.path.join(tmp_path, f'filters_{l}.npy'), filters_l)
+            np.save(os.path.join(tmp_path, 'gaussian_filters.npy'), self.gaussian_filters)
+            try:
+                os.rename(tmp_path, path)
+            except OSError:
+                # another worker wrote the cache in the meantime
+                shutil.rmtree(tmp_path)
+            return
+
+        # the numpy backend only reads the filters, memory mapping shares them between workers through the page cache
+        mmap_mode = 'r' if self.backend.name == 'numpy' else None
+        self.filters = [np.load(os.path.join(path, f'filters_{l}.npy'), mmap_mode=mmap_mode) for l in range(self.L+1)]
+        self.gaussian_filters = np.load(os.path.join(path, 'gaussian_filters.npy'), mmap_mode=mmap_mode)
+
+
+@functools.lru_cache(maxsize=None)
+def _cached_scattering_class(backend):
+    '''
+    HarmonicScattering3D of the kymatio backend with the filter cache, kymatio (and torch) are only imported when a kernel is built
+    '''
+    if backend == 'torch':
+        from kymatio.torch import HarmonicScattering3D
+    else:
+        from kymatio.numpy import HarmonicScattering3D
+
+    return type(f'_CachedHarmonicScattering3D_{backend}', (_FilterCacheMixin, HarmonicScattering3D), {})
+
+
+def _torch_dtype(dtype):
+    '''
+    torch precision of a numpy float precision
+    '''
+    import torch
+
+    return {np.dtype(np.float32): torch.float32, np.dtype(np.float64): torch.float64}[np.dtype(dtype)]
+
 
 class ScatteringTransformKernel:
-    def __init__(self, J, L, shape, integral_powers=[0.5, 1.0, 2.0], backend='numpy',device='cpu'):
+    def __init__(self, J, L, shape, integral_powers=[0.5, 1.0, 2.0], backend='numpy',device='cpu',filter_cache_dir=None,dtype=None):
         '''
         Class to compute scattering transform of a 3D cube
 
@@ -17,6 +96,9 @@ class ScatteringTransformKernel:
             :integral_powers: list, powers of the modulus of the wavelet transform
             :backend: str, backend to use, 'numpy' or 'torch'
             :device: str, device to use, 'cpu' or 'cuda'
+            :filter_cache_dir: str, directory caching the filter bank on disk. If None, the filters are rebuilt every time.
+            :dtype: np.dtype, float precision of the coefficients (and of the torch filters and inputs). Default is pipe21cm.config.dtype.
+                    The numpy backend of kymatio always convolves in complex128.
 
         '''
 
@@ -26,23 +108,27 @@ class ScatteringTransformKernel:
         self.integral_powers = integral_powers
         self.backend = backend
         self.device = device
+        self.filter_cache_dir = filter_cache_dir
+        self.dtype = resolve_dtype(dtype)
 
         if backend == 'numpy' and device == 'cuda':
             logging.warning('numpy backend does not support cuda device. Switching to cpu device')
 
         if self.backend == 'numpy':
-            self.scattering = HarmonicScattering3D(J=self.J, shape=self.shape, sigma_0=1,
-                                              L=self.L, integral_powers=self.integral_powers)
-            
+            self.scattering = _cached_scattering_class('numpy')(J=self.J, shape=self.shape, sigma_0=1,
+                                              L=self.L, integral_powers=self.integral_powers,
+                                              filter_cache_dir=self.filter_cache_dir)
+
             self.get_compact_coef = self._get_compact_coef_numpy
 
         elif self.backend == 'torch':
-            self.scattering = HarmonicScattering3D_torch(J=self.J, shape=self.shape, sigma_0=1,
-                                                    L=self.L, integral_powers=self.integral_powers)
-            self.scattering.to(device)
-            print('using torch backend')
+            self.scattering = _cached_scattering_class('torch')(J=self.J, shape=self.shape, sigma_0=1,
+                                                    L=self.L, integral_powers=self.integral_powers,
+                                                    filter_cache_dir=self.filter_cache_dir)
+            self.scattering.to(device=device, dtype=_torch_dtype(self.dtype))
             self.get_compact_coef = self._get_compact_coef_torch
 
+    @instrument
     def apply_on(self, cube):
         '''
         Apply scattering transform on the input cube
@@ -55,7 +141,8 @@ class ScatteringTransformKernel:
         '''
 
         return self.scattering(cube)
-    
+
+    @instrument(name='summary.scattering_transform.ScatteringTransformKernel.get_compact_coef')
     def _get_compact_coef_numpy(self, cube):
         '''
         get compact coefficients from the scattering transform following Zhao et al 2024. Numpy version
@@ -79,9 +166,9 @@ class ScatteringTransformKernel:
         dim1 = cube.shape[0]
 
         #calculate 1st and 2rd st coefs
-        sc = self.apply_on(cube)  
+        sc = self.apply_on(cube)
 
-        #average over the angle dimension  
+        #average over the angle dimension
         sc = np.mean(abs_log(sc),axis=-2)
 
         #calculate 0th coefs
@@ -94,8 +181,9 @@ class ScatteringTransformKernel:
         elif ndim == 4:
             total_sc = np.hstack((sc0.T, sc.reshape(dim1,-1)))
 
-        return total_sc
-    
+        return total_sc.astype(self.dtype, copy=False)
+
+    @instrument(name='summary.scattering_transform.ScatteringTransformKernel.get_compact_coef')
     def _get_compact_coef_torch(self, cube):
         '''
         get compact coefficients from the scattering transform following Zhao et al 2024. Torch version, works better on GPU
@@ -109,34 +197,143 @@ class ScatteringTransformKernel:
             :total_sc: numpy array, compact coefficients
         '''
 
+        import torch
+
         def abs_log(x):
             re=(torch.sign(x))*torch.log2(torch.abs(x))
             re[torch.isnan(re)]=0
             return re
-        
+
         #check if cube is numpy
         if isinstance(cube, np.ndarray):
-            cube = torch.tensor(cube, device=self.device).float()
+            cube = torch.as_tensor(cube, dtype=_torch_dtype(self.dtype), device=self.device)
 
         ndim = len(cube.shape)
         dim1 = cube.shape[0]
 
-        print(cube.dtype)
         #calculate 1st and 2rd st coefs
-        sc = self.apply_on(cube)  
+        sc = self.apply_on(cube)
 
-        #average over the angle dimension  
+        #average over the angle dimension
         sc = torch.mean(abs_log(sc),dim=-2)
 
         #calculate 0th coefs
         sc0=torch.cat([(torch.sum(cube**i,dim=(-1,-2,-3))).unsqueeze(-1) for i in [2,3,4]],dim=-1)
-        sc0= abs_log(torch.tensor(sc0))
+        sc0= abs_log(sc0)
 
-        #combine all coefs 
+        #combine all coefs
         # check if the input is batched or not (should probably include more batch dims
         if ndim == 3:
-            total_sc = torch.cat((sc0, sc.flat))
+            total_sc = torch.cat((sc0, sc.flatten()))
         elif ndim == 4:
             total_sc = torch.cat((sc0, sc.reshape(dim1,-1)),dim=1)
 
         return total_sc
+
+    @instrument
+    def extract(self, cubes, batch_size=8, out=None, workers=1, pool='thread'):
+        '''
+        Stream cubes through get_compact_coef in fixed-size batches and write the compact coefficients into one output array
+
+        Args:
+            :cubes: numpy array or memmap with shape (n_cubes,)+shape, or an iterator of cubes with shape shape
+            :batch_size: int, number of cubes per call of get_compact_coef
+            :out: numpy array, preallocated (n_cubes, n_coefs) output. If None, it is allocated from the first batch.
+            :workers: int, number of batches computed in parallel (numpy backend only)
+            :pool: str, 'thread' or 'process'. Process workers rebuild the kernel, use filter_cache_dir to make it fast.
+
+        Returns:
+            :out: numpy array, compact coefficients with shape (n_cubes, n_coefs)
+        '''
+
+        assert pool in ['thread', 'process'], f'pool must be thread or process, got {pool}'
+        if workers > 1 and self.backend != 'numpy':
+            logging.warning('parallel workers are only supported by the numpy backend. Using a single worker')
+            workers = 1
+
+        batches = _iter_batches(cubes, batch_size)
+
+        with contextlib.ExitStack() as stack:
+            if workers == 1:
+                results = map(self._compact_coef_batch, batches)
+            elif pool == 'thread':
+                executor = stack.enter_context(ThreadPoolExecutor(workers))
+                results = stack.enter_context(contextlib.closing(_bounded_map(executor, self._compact_coef_batch, batches, 2*workers)))
+            else:
+                kernel_args = dict(J=self.J, L=self.L, shape=self.shape, integral_powers=self.integral_powers,
+                                   filter_cache_dir=self.filter_cache_dir, dtype=self.dtype)
+                executor = stack.enter_context(ProcessPoolExecutor(workers, initializer=_init_worker_kernel, initargs=(kernel_args,)))
+                results = stack.enter_context(contextlib.closing(_bounded_map(executor, _worker_compact_coef, batches, 2*workers)))
+
+            collected = []
+            start = 0
+            for coef in results:
+                if out is None and hasattr(cubes, '__len__'):
+                    out = np.empty((len(cubes), coef.shape[1]), dtype=coef.dtype)
+                if out is None:
+                    collected.append(coef)
+                else:
+                    out[start:start+len(coef)] = coef
+                start += len(coef)
+
+        if out is None:
+            out = np.concatenate(collected)
+
+        return out
+
+    def _compact_coef_batch(self, batch):
+        '''
+        compact coefficients of a (batch_size,)+shape numpy batch as a numpy array
+        '''
+        coef = self.get_compact_coef(batch)
+        if self.backend == 'torch':
+            coef = coef.cpu().numpy()
+        return coef
+
+
+def _iter_batches(cubes, batch_size):
+    '''
+    yield (batch_size,)+shape numpy batches from an array/memmap of cubes or an iterator of cubes
+    '''
+    if hasattr(cubes, '__getitem__') and hasattr(cubes, 'shape'):
+        for start in range(0, len(cubes), batch_size):
+            yield np.asarray(cubes[start:start+batch_size])
+        return
+
+    batch = []
+    for cube in cubes:
+        batch.append(cube)
+        if len(batch) == batch_size:
+            yield np.stack(batch)
+            batch = []
+    if batch:
+        yield np.stack(batch)
+
+
+def _bounded_map(executor, func, iterable, window):
+    '''
+    executor.map(func, iterable) with at most window tasks in flight, the results are yielded in order and the iterable
+    is only consumed as the results are collected, so the memory stays bounded for an arbitrarily long iterator
+    '''
+    futures = collections.deque()
+    try:
+        for item in iterable:
+            futures.append(executor.submit(func, item))
+            if len(futures) >= window:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+# kernel of each process of ScatteringTransformKernel.extract
+_worker_kernel = None
+
+def _init_worker_kernel(kernel_args):
+    global _worker_kernel
+    _worker_kernel = ScatteringTransformKernel(backend='numpy', **kernel_args)
+
+def _worker_compact_coef(batch):
+    return _worker_kernel._compact_coef_batch(batch)
@@ -0,0 +1,220 @@
+import os
+import functools
+
+import numpy as np
+from scipy import fft as sp_fft
+from pipe21cm.profiling import instrument
+from pipe21cm.config import resolve_dtype, complex_dtype
+from pipe21cm.summary.power_spectrum import _band_slices, _compact_index
+
+# frequency sub-bands (MHz) of the SDC3a power spectra PS1 and PS2
+SDC3A_BANDS = ((151., 165.9), (166., 180.9), (181., 195.9))
+
+
+class DelaySpectrumPlan:
+    '''
+    Precomputed delay transform and (kper, kpar) binning of image cubes in one frequency band, following the SDC3a
+    instructions (ps_eor PowerSpectraBuilder with the binning of get_ps_gen_square, hann taper, nudft, boxcar field window).
+    The taper and the Fourier phases of the kpar modes are folded into one (n_chan, n_kpar) matrix and the uv bin of every
+    mode of the image grid is computed once, so each cube costs one matrix product, n_kpar 2D FFTs and a np.bincount.
+    Use get_delay_spectrum_plan to get cached instances.
+
+    Args:
+        :shape(tuple): angular shape (nx, ny) of the image cubes
+        :window(tuple): slices of the field window along the two angular axes
+        :delay_matrix(np.array): taper and delay transform of the band channels with shape (n_chan, n_kpar)
+        :bin_index(np.array): kper bin index of each mode of the (nx, ny) FFT grid, n_kper for modes outside the bins
+        :kper_edges(np.array): kper bin edges in h/Mpc
+        :kpar_edges(np.array): kpar bin edges in h/Mpc, centered on the delay modes
+        :norm(float): conversion of |T(u, delay)|^2 (K^2 sr^2 Hz^2) to a power spectrum in K^2 Mpc^3/h^3
+    '''
+
+    def __init__(self, shape, window, delay_matrix, bin_index, kper_edges, kpar_edges, norm):
+        self.shape = tuple(shape)
+        self.window = window
+        self.delay_matrix = delay_matrix
+        self.bin_index = bin_index
+        self.kper_edges = kper_edges
+        self.kpar_edges = kpar_edges
+        self.kper_mid = (kper_edges[:-1] + kper_edges[1:])/2.
+        self.kpar_mid = (kpar_edges[:-1] + kpar_edges[1:])/2.
+        self.n_kper = len(self.kper_mid)
+        self.n_kpar = len(self.kpar_mid)
+        self.norm = norm
+        self.n_modes = np.bincount(bin_index.ravel(), minlength=self.n_kper+1)[:-1]
+
+    @instrument
+    def bin_power(self, band_cube, dtype=None, workers=None):
+        '''
+        compute the cylindrical power spectrum of the band channels of an image cube or a batch of cubes
+
+        Args:
+            :band_cube(np.array): cube with shape (..., nx, ny, n_chan), in K
+            :dtype(np.dtype): float precision of the transforms. Default is pipe21cm.config.dtype
+            :workers(int): number of threads of the scipy.fft worker pool
+
+        Returns:
+            :pk(np.array): power spectrum in K^2 Mpc^3/h^3 with shape batch_shape+(n_kpar, n_kper)
+        '''
+        dtype = resolve_dtype(dtype)
+        band_cube = np.asarray(band_cube)
+        batch_shape = band_cube.shape[:-3]
+        assert band_cube.shape[-3:-1] == self.shape, f'cube shape {band_cube.shape} does not match the plan shape {self.shape}'
+        assert band_cube.shape[-1] == len(self.delay_matrix), f'got {band_cube.shape[-1]} channels for a plan of {len(self.delay_matrix)}'
+
+        band_cube = band_cube.reshape((-1,)+band_cube.shape[-3:])
+        delay_matrix = self.delay_matrix.astype(complex_dtype(dtype))
+        n_groups = self.n_kpar*(self.n_kper+1)
+        offsets = (np.arange(self.n_kpar)*(self.n_kper+1)).reshape(-1, 1, 1)
+
+        pk = np.empty((len(band_cube), self.n_kpar, self.n_kper))
+        for idx, cube in enumerate(band_cube):
+            # the delay transform only runs over the field window, the pixels outside are zero
+            field = np.asarray(cube[self.window], dtype=dtype)
+            ft = np.moveaxis(field @ delay_matrix, -1, 0)
+            ft = sp_fft.fft2(ft, s=self.shape, axes=(1, 2), overwrite_x=True, workers=workers)
+            power = ft.real**2 + ft.imag**2
+            sums = np.bincount((self.bin_index + offsets).ravel(), weights=power.ravel(), minlength=n_groups)
+            pk[idx] = sums.reshape(self.n_kpar, self.n_kper+1)[:, :-1]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            pk *= self.norm/self.n_modes
+
+        return pk.reshape(batch_shape+(self.n_kpar, self.n_kper)).astype(dtype, copy=False)
+
+
+def get_delay_spectrum_plan(shape, freqs, pixel_size, fov=4., kper_width=0.05, kpar_width=0.05, n_kper=10, n_kpar=10):
+    '''
+    get the (cached) delay transform and binning plan of one frequency band
+
+    Args:
+        :shape(tuple): angular shape (nx, ny) of the image cubes
+        :freqs(np.array): frequencies of the band channels in MHz
+        :pixel_size(float): angular size of a pixel in degrees
+        :fov(float): side of the square boxcar field window in degrees, centered on the image
+        :kper_width(float): width of the kper bins in h/Mpc, the first bin is centered on kper_width
+        :kpar_width(float): kpar resolution in h/Mpc, sets the delay spacing of the transform
+        :n_kper(int): number of kper bins
+        :n_kpar(int): number of kpar modes, from the first non-zero delay
+
+    Returns:
+        :plan(DelaySpectrumPlan): delay transform and binning plan
+    '''
+    return _get_delay_spectrum_plan(tuple(int(n) for n in shape), tuple(float(nu) for nu in freqs), float(pixel_size),
+                                    float(fov), float(kper_width), float(kpar_width), int(n_kper), int(n_kpar))
+
+
+@functools.lru_cache(maxsize=8)
+def _get_delay_spectrum_plan(shape, freqs, pixel_size, fov, kper_width, kpar_width, n_kper, n_kpar):
+    import tools21cm as t2c
+
+    freqs = np.array(freqs)
+    z = t2c.nu_to_z(freqs.mean())
+    h = t2c.const.h
+    # comoving distance per radian and per Hz at the band center, in Mpc/h
+    dist_rad = t2c.z_to_cdist(z)*h
+    dist_hz = abs(t2c.nu_to_cdist(freqs.mean()-0.05) - t2c.nu_to_cdist(freqs.mean()+0.05))/0.1e6*h
+
+    # kpar modes: the delay spacing 1/(M df) of ps_eor with M = int(1/(delay of kpar_width)/df)
+    df = np.median(np.abs(np.diff(freqs)))*1e6
+    n_delays = int(1/(kpar_width*dist_hz/(2*np.pi))/df)
+    delays = np.arange(1, n_kpar+1)/(n_delays*df)
+    kpar_step = 2*np.pi/(n_delays*df*dist_hz)
+    kpar_edges = kpar_step*(np.arange(n_kpar+1)+0.5)
+
+    taper = np.hanning(len(freqs))
+    phases = np.exp(-2j*np.pi*np.outer((freqs-freqs[0])*1e6, delays))
+    delay_matrix = (taper*df)[:, None]*phases
+
+    # uv modes of the image grid binned in |u| between (i+1/2)*du, du being kper_width in wavelengths
+    pixel_rad = np.radians(pixel_size)
+    u = np.sqrt(np.fft.fftfreq(shape[0], pixel_rad)[:, None]**2 + np.fft.fftfreq(shape[1], pixel_rad)[None, :]**2)
+    du = kper_width*dist_rad/(2*np.pi)
+    idx = np.floor(u/du - 0.5).astype(np.int64)
+    bin_index = _compact_index(idx, n_kper)
+    kper_edges = kper_width*(np.arange(n_kper+1)+0.5)
+
+    n_window = [min(n, int(round(fov/pixel_size))) for n in shape]
+    window = tuple(slice((n-nw)//2, (n-nw)//2+nw) for n, nw in zip(shape, n_window))
+
+    # |T(u, delay)|^2 of the pixel-area weighted FFTs, normalised by the field area and the effective bandwidth of the taper
+    field_area = np.prod(n_window)*pixel_rad**2
+    bandwidth = df*np.sum(taper**2)
+    norm = pixel_rad**4*dist_rad**2*dist_hz/(field_area*bandwidth)
+
+    return DelaySpectrumPlan(shape, window, delay_matrix, bin_index, kper_edges, kpar_edges, norm)
+
+
+@instrument
+def calculate_sdc3a_ps(lc, freqs, pixel_size, bands=SDC3A_BANDS, fov=4., scale=1e-3, kper_width=0.05, kpar_width=0.05,
+                       n_kper=10, n_kpar=10, dtype=None, threads=None):
+    '''
+    calculate the SDC3a cylindrical power spectra (binning of the PS1 and PS2 data) of observational lightcones
+    in every frequency sub-band, without ps_eor. The plan of each band is cached and shared by all the cubes.
+    k are converted with the tools21cm cosmology, the one of the lightcones.
+
+    Args:
+        :lc(np.array): observational lightcone(s) with shape (..., nx, ny, nfreq), in mK
+        :freqs(np.array): frequencies of the lightcone in MHz
+        :pixel_size(float): angular size of a pixel in degrees
+        :bands(list): (fmin, fmax) sub-bands in MHz, inclusive, default is the three SDC3a bands
+        :fov(float): side of the square boxcar field window in degrees
+        :scale(float): conversion of the lightcone to the units of the reference spectra, mK to K by default
+        :kper_width, kpar_width(float): kper bin width and kpar resolution in h/Mpc
+        :n_kper, n_kpar(int): number of kper and kpar bins
+        :dtype(np.dtype): float precision of the transforms. Default is pipe21cm.config.dtype
+        :threads(int): number of threads of the scipy.fft worker pool
+
+    Returns:
+        :pk(np.array): power spectra in K^2 Mpc^3/h^3 with shape batch_shape+(n_bands, n_kpar, n_kper),
+                       each band as in the Pk_PS1_{fmin}_{fmax}.txt files
+        :kper_edges(np.array): kper bin edges in h/Mpc
+        :kpar_edges(list): kpar bin edges in h/Mpc of each band
+    '''
+    assert len(bands) > 0, 'at least one frequency band must be given'
+    lc = np.asanyarray(lc)
+    freqs = np.asarray(freqs)
+    batch_shape = lc.shape[:-3]
+    lc = lc.reshape((-1,)+lc.shape[-3:])
+
+    pk, kpar_edges = [], []
+    for band in _band_slices(lc.shape[-1], freqs, bands):
+        plan = get_delay_spectrum_plan(lc.shape[1:3], freqs[band], pixel_size, fov=fov, kper_width=kper_width,
+                                       kpar_width=kpar_width, n_kper=n_kper, n_kpar=n_kpar)
+        pk.append(plan.bin_power(lc[..., band], dtype=dtype, workers=threads)*scale**2)
+        kpar_edges.append(plan.kpar_edges)
+
+    pk = np.stack(pk, axis=1)
+
+    return pk.reshape(batch_shape+pk.shape[1:]), plan.kper_edges, kpar_edges
+
+
+def save_sdc3a_ps(out_dir, pk, kper_edges, kpar_edges, bands=SDC3A_BANDS, prefix='Pk'):
+    '''
+    write the power spectra of one lightcone in the format of the SDC3a reference data:
+    {prefix}_{fmin:.1f}_{fmax:.1f}.txt for each band with kpar along the rows and bins_kper.txt.
+    The kpar edges depend on the distance of the band center, they are written to bins_kpar_{fmin:.1f}_{fmax:.1f}.txt for each band
+
+    Args:
+        :out_dir(str): output directory
+        :pk(np.array): power spectra with shape (n_bands, n_kpar, n_kper), from calculate_sdc3a_ps
+        :kper_edges(np.array): kper bin edges in h/Mpc
+        :kpar_edges(list): kpar bin edges in h/Mpc of each band
+        :bands(list): (fmin, fmax) sub-bands in MHz
+        :prefix(str): file prefix, e.g. 'Pk_PS1'
+
+    Returns:
+        :files(list): the written power spectrum files
+    '''
+    assert len(pk) == len(bands), f'got {len(pk)} power spectra for {len(bands)} bands'
+    assert len(kpar_edges) == len(bands), f'got {len(kpar_edges)} kpar bin edges for {len(bands)} bands'
+    os.makedirs(out_dir, exist_ok=True)
+
+    files = []
+    for band_pk, band_kpar_edges, (fmin, fmax) in zip(pk, kpar_edges, bands):
+        files.append(os.path.join(out_dir, f'{prefix}_{fmin:.1f}_{fmax:.1f}.txt'))
+        np.savetxt(files[-1], band_pk)
+        np.savetxt(os.path.join(out_dir, f'bins_kpar_{fmin:.1f}_{fmax:.1f}.txt'), band_kpar_edges)
+    np.savetxt(os.path.join(out_dir, 'bins_kper.txt'), kper_edges)
+
+    return files
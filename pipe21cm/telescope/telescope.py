@@ -1,7 +1,11 @@
 import numpy as np
 import os
 import sys
-import tools21cm as t2c
+import uuid
+import hashlib
+from scipy import fft as sp_fft
+from pipe21cm.profiling import instrument
+from pipe21cm.config import resolve_dtype, complex_dtype
 
 
 class Telescope:
@@ -49,7 +53,24 @@ class Telescope:
         self.declination = declination
         self.n_jobs = n_jobs
 
-    def build_lightcone_uv_map(self, save_uvmap_path):
+    def uv_cache_key(self):
+        """
+        Content hash of the telescope setup the UV maps depend on.
+
+        returns
+        -------
+        key : str
+            sha1 hex digest of (subarray_type, ncells, boxsize, zs, int_time, total_int_time, declination).
+        """
+
+        setup = repr((self.subarray_type, int(self.ncells), float(self.boxsize), float(self.int_time), float(self.total_int_time), float(self.declination)))
+        digest = hashlib.sha1(setup.encode())
+        digest.update(np.asarray(self.zs, dtype=np.float64).tobytes())
+
+        return digest.hexdigest()
+
+    @instrument
+    def build_lightcone_uv_map(self, save_uvmap_path=None, cache_dir=None):
         """
         Build the UV map for the lightcone based on the telescope configuration.
         This has to be called before applying the UV response on the lightcone signal or generating noise lightcones.
@@ -58,37 +79,68 @@ class Telescope:
         ----------
         save_uvmap_path : str, optional
             Path to save the UV map. 
+        cache_dir : str, optional
+            Directory of the UV map cache. The UV maps are stored as one (ncells, ncells, len(zs)) npy file named after
+            uv_cache_key() and memory mapped on load, so a setup is only computed once across runs and processes.
+            The cached npy file is then the UV map path used by get_noise_lightcone.
         
         returns
         -------
         None
         """
+        import tools21cm as t2c
 
+        path = None if cache_dir is None else os.path.join(cache_dir, f'uvmap_{self.uv_cache_key()}.npy')
 
-        uvmap = t2c.get_uv_map_lightcone(ncells=self.ncells,
-                                            zs=self.zs,
-                                            total_int_time=self.total_int_time,
-                                            int_time=self.int_time,
-                                            declination=self.declination,
-                                            n_jobs=self.n_jobs,
-                                            save_uvmap=save_uvmap_path,
-                                            subarray_type=self.subarray_type)
+        if path is None or not os.path.isfile(path):
+            uvmap = t2c.get_uv_map_lightcone(ncells=self.ncells,
+                                                zs=self.zs,
+                                                boxsize=self.boxsize,
+                                                total_int_time=self.total_int_time,
+                                                int_time=self.int_time,
+                                                declination=self.declination,
+                                                n_jobs=self.n_jobs,
+                                                save_uvmap=save_uvmap_path,
+                                                subarray_type=self.subarray_type)
 
-        self.uv_path = save_uvmap_path
-        self.uv_map = uvmap
+            # same layout as the lightcones, so the maps broadcast over them
+            uv_map = np.stack([uvmap['{:.3f}'.format(zi)] for zi in self.zs], axis=-1)
+
+            if path is not None:
+                # write to a temporary file first so that concurrent workers never read a partial cache
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp_path = f'{path}.tmp{uuid.uuid4().hex}.npy'
+                np.save(tmp_path, uv_map)
+                os.replace(tmp_path, path)
+
+        if path is not None:
+            uv_map = np.load(path, mmap_mode='r')
+
+        # the cached stack is used by get_noise_lightcone, so it never recomputes the maps found in cache_dir
+        self.uv_path = save_uvmap_path if path is None else path
+        self.uv_map = uv_map
+        self.uv_mask = uv_map != 0
+        self.noise_filter = None
                             
         return
     
-    def apply_uv_response_on_lightcone(self, lc_signal):
+    @instrument
+    def apply_uv_response_on_lightcone(self, lc_signal, batch_size=1, dtype=None):
         """
         apply the UV response on the lightcone signal.
+        The signal is transformed with one 2D FFT over all the slices and the stack of UV masks is broadcast over it.
 
         Parameters
         ----------
         lc_signal : np.ndarray
             The lightcone signal to which the UV response will be applied.
             It should be a 3D array with shape (ncells, ncells, len(zs)) where ncells is the number of cells in one dimension and zs is the list of
-            redshifts for which the lightcone is generated.
+            redshifts for which the lightcone is generated. Several lightcones can be given as a (n_lc, ncells, ncells, len(zs)) array or memmap.
+        batch_size : int, optional
+            Number of lightcones transformed together. Default is 1.
+        dtype : np.dtype, optional
+            Float precision of the FFTs and of the output (complex64 FFTs in float32). Default is pipe21cm.config.dtype.
+
         Returns
         -------
         lc_uv_applied : np.ndarray
@@ -97,16 +149,30 @@ class Telescope:
         """
 
         assert hasattr(self, 'uv_map'), "UV map not built. Call build_lightcone_uv_map() first."
+        assert lc_signal.shape[-3:] == self.uv_mask.shape, f"lightcones must have shape (..., {self.ncells}, {self.ncells}, {len(self.zs)}), got {lc_signal.shape}."
 
-        lc_uv_applied = np.zeros_like(lc_signal)
-        for i in range(len(self.zs)):
-            zi = self.zs[i]
-            uv_zi = self.uv_map['{:.3f}'.format(zi)]
-            lc_uv_applied[...,i] = t2c.apply_uv_response_on_image(lc_signal[...,i], uv_zi)
-        
+        dtype = resolve_dtype(dtype)
+        lc_uv_applied = np.zeros(lc_signal.shape, dtype=dtype)
+        if lc_signal.ndim == 3:
+            lc_uv_applied[...] = self._apply_uv_mask(lc_signal, dtype)
+            return lc_uv_applied
+
+        for start in range(0, len(lc_signal), batch_size):
+            lc_uv_applied[start:start+batch_size] = self._apply_uv_mask(lc_signal[start:start+batch_size], dtype)
 
         return lc_uv_applied
+
+    def _apply_uv_mask(self, lc_signal, dtype):
+        """
+        same as t2c.apply_uv_response_on_image applied on every slice of (..., ncells, ncells, len(zs)) lightcones
+        """
+
+        lc_uv = sp_fft.fft2(np.asarray(lc_signal, dtype=dtype), axes=(-3, -2))
+        lc_uv *= self.uv_mask
+
+        return np.real(sp_fft.ifft2(lc_uv, axes=(-3, -2), overwrite_x=True))
     
+    @instrument
     def get_noise_lightcone(self):
         """
         Generate a noise lightcone based on the telescope configuration.
@@ -118,9 +184,13 @@ class Telescope:
             It will be a 3D array with shape (ncells, ncells, len(zs)) where ncells is the number of cells in one dimension and zs is the list of
             redshifts for which the lightcone is generated.
         """
+        import tools21cm as t2c
 
         assert hasattr(self, 'uv_path'), "UV map path not set. Call build_lightcone_uv_map() first."
 
+        if self.uv_path is not None and self.uv_path.endswith('.npy'):
+            return self._noise_lightcone_from_uv_map()
+
         noise_lc = t2c.noise_lightcone(ncells=self.ncells,
                                     zs=self.zs,
                                     obs_time=self.obs_time,
@@ -134,3 +204,116 @@ class Telescope:
         
         return noise_lc
 
+    def _noise_lightcone_from_uv_map(self):
+        """
+        same as t2c.noise_lightcone with the UV maps of the cache, which t2c cannot read from the stacked npy file
+        """
+        import tools21cm as t2c
+
+        zs = np.asarray(self.zs, dtype=np.float64)
+        noise_lc = np.zeros((self.ncells, self.ncells, len(zs)))
+        for k, zi in enumerate(zs):
+            # channel width of each slice, the last slice uses the previous interval
+            depth_mhz = np.abs(t2c.z_to_nu(zs[k+1]) - t2c.z_to_nu(zi)) if k + 1 < len(zs) else np.abs(t2c.z_to_nu(zi) - t2c.z_to_nu(zs[k-1]))
+            noise_map = t2c.noise_map(self.ncells, zi, depth_mhz, obs_time=self.obs_time, subarray_type=self.subarray_type,
+                                      boxsize=self.boxsize, total_int_time=self.total_int_time, int_time=self.int_time,
+                                      declination=self.declination, uv_map=np.asarray(self.uv_map[..., k]), verbose=False)
+            noise_lc[..., k] = t2c.jansky_2_kelvin(noise_map, zi, boxsize=self.boxsize)
+
+        return noise_lc
+
+    @instrument
+    def build_noise_filter(self, uv_map_min=0.01):
+        """
+        Precompute the uv space filter turning white complex noise into the thermal noise lightcone in mK.
+        It folds the visibility rms of each redshift, the natural weighting by the UV map, the Blackman-Harris window,
+        the observation time and the Jansky to Kelvin conversion of t2c.noise_lightcone into one (ncells, ncells, len(zs)) array.
+
+        Parameters
+        ----------
+        uv_map_min : float, optional
+            UV cells observed less than this are not sampled. Default is 0.01 as in tools21cm.
+
+        returns
+        -------
+        None
+        """
+        import tools21cm as t2c
+
+        assert hasattr(self, 'uv_map'), "UV map not built. Call build_lightcone_uv_map() first."
+
+        zs = np.asarray(self.zs, dtype=np.float64)
+        _, n_ant = t2c.subarray_type_to_antxyz(self.subarray_type, verbose=False)
+        window = np.fft.fftshift(t2c.signal_window(self.ncells, 'blackmanharris', ndim=2))
+
+        # channel width of each slice, the last slice uses the previous interval
+        depth_mhz = np.abs(np.diff(t2c.z_to_nu(zs)))
+        depth_mhz = np.append(depth_mhz, depth_mhz[-1])
+
+        noise_filter = np.zeros((self.ncells, self.ncells, len(zs)))
+        for k, zi in enumerate(zs):
+            _, rms_noise = t2c.sigma_noise_radio(zi, depth_mhz[k], self.obs_time, self.int_time, N_ant=n_ant, verbose=False)
+            uv_map = np.asarray(self.uv_map[..., k])
+            sampled = uv_map >= uv_map_min
+            noise_filter[sampled, k] = rms_noise/np.sqrt(uv_map[sampled])
+            noise_filter[..., k] *= window*np.sqrt(self.int_time/3600./self.obs_time)/t2c.kelvin_jansky_conversion(self.ncells, zi, boxsize=self.boxsize)
+
+        self.noise_filter = noise_filter
+
+        return
+
+    @instrument
+    def noise_realizations(self, n, seed=0, start=0, out=None, batch_size=8, dtype=None):
+        """
+        Generate independent thermal noise lightcones with the statistics of t2c.noise_lightcone.
+        The noise filter is computed once, the complex noise of a batch is drawn at once and inverse transformed with one 2D FFT.
+        Realisation i is drawn from a Philox generator keyed by (seed, i), so it does not depend on the batch size
+        or on which process generates it: n realisations can be split into chunks with start and generated in parallel.
+
+        Parameters
+        ----------
+        n : int
+            Number of noise realisations.
+        seed : int, optional
+            Seed of the realisations. Default is 0.
+        start : int, optional
+            Index of the first realisation. Default is 0.
+        out : np.ndarray or str, optional
+            Preallocated (n, ncells, ncells, len(zs)) output array, or the path of a npy file the realisations are memory mapped to.
+            If None, the realisations are allocated in memory.
+        batch_size : int, optional
+            Number of realisations transformed together. Default is 8.
+        dtype : np.dtype, optional
+            Float precision of the noise. Default is pipe21cm.config.dtype. The float32 draws are a different random stream.
+
+        Returns
+        -------
+        noise_lcs : np.ndarray
+            The noise lightcones in mK with shape (n, ncells, ncells, len(zs)).
+        """
+
+        if getattr(self, 'noise_filter', None) is None:
+            self.build_noise_filter()
+
+        dtype = resolve_dtype(dtype)
+        shape = (n,) + self.noise_filter.shape
+        if out is None:
+            noise_lcs = np.zeros(shape, dtype=dtype)
+        elif isinstance(out, str):
+            noise_lcs = np.lib.format.open_memmap(out, mode='w+', dtype=dtype, shape=shape)
+        else:
+            assert out.shape == shape, f"out must have shape {shape}, got {out.shape}."
+            noise_lcs = out
+
+        noise_filter = self.noise_filter.astype(dtype, copy=False)
+        for batch_start in range(0, n, batch_size):
+            batch = range(start+batch_start, start+min(batch_start+batch_size, n))
+            noise_uv = np.empty((len(batch),)+self.noise_filter.shape, dtype=complex_dtype(dtype))
+            for i, index in enumerate(batch):
+                rng = np.random.Generator(np.random.Philox(key=[index, seed]))
+                noise_uv[i].real = rng.standard_normal(self.noise_filter.shape, dtype=dtype)
+                noise_uv[i].imag = rng.standard_normal(self.noise_filter.shape, dtype=dtype)
+            noise_uv *= noise_filter
+            noise_lcs[batch_start:batch_start+len(batch)] = np.real(sp_fft.ifft2(noise_uv, axes=(-3, -2), overwrite_x=True))
+
+        return noise_lcs
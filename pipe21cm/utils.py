@@ -1,5 +1,4 @@
 import numpy as np
-from matplotlib import pyplot as plt
 
 def plot_lightcone(lc, los_cor, box_size, type='physical',cmap=None):
     """
@@ -11,6 +10,8 @@ def plot_lightcone(lc, los_cor, box_size, type='physical',cmap=None):
         :box_size: float. The size of the box(in Mpc or degrees).
         :type: str. The type of the lightcone. Either 'physical' or 'observational'.
     """
+    from matplotlib import pyplot as plt
+
     assert type in ['physical', 'observational'], 'type must be physical or observational'
 
     xi = np.array([los_cor for i in range(lc.shape[1])])
@@ -0,0 +1,37 @@
+'''
+The lightweight core of pipe21cm imports with NumPy and SciPy only, the optional dependencies are imported by the
+functions and backends that use them.
+'''
+import os
+import sys
+import subprocess
+
+import pytest
+
+# modules of the lightweight core
+CORE_MODULES = ['pipe21cm', 'pipe21cm.config', 'pipe21cm.profiling', 'pipe21cm.io', 'pipe21cm.signal.lightcone',
+                'pipe21cm.summary.power_spectrum', 'pipe21cm.summary.bispectrum', 'pipe21cm.summary.sdc_power_spectrum',
+                'pipe21cm.summary.scattering_transform', 'pipe21cm.foreground.removal', 'pipe21cm.telescope',
+                'pipe21cm.pipeline', 'pipe21cm.batch']
+
+# optional dependencies
+OPTIONAL_DEPENDENCIES = ['tools21cm', 'py21cmfast', 'astropy', 'sklearn', 'torch', 'kymatio', 'healpy', 'pygdsm',
+                         'matplotlib', 'zarr']
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def loaded_optional_dependencies(module):
+    '''
+    import the module in a fresh interpreter and return the optional dependencies it loaded
+    '''
+    code = (f"import sys\nimport {module}\n"
+            f"print(' '.join(name for name in {OPTIONAL_DEPENDENCIES!r} if name in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True, cwd=REPO_DIR).stdout
+    return output.split()
+
+
+@pytest.mark.parametrize('module', CORE_MODULES)
+def test_core_module_imports_no_optional_dependency(module):
+    loaded = loaded_optional_dependencies(module)
+    assert not loaded, f'{module} imports {loaded}, import them in the functions that use them'
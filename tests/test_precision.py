@@ -0,0 +1,142 @@
+'''
+float32 path of the pipeline (pipe21cm.config.precision) against the float64 path, with the tolerances of pipe21cm.config:
+the largest difference relative to the largest value of the float64 output, and no silent upcast of the outputs.
+'''
+import os
+
+import numpy as np
+import pytest
+
+from pipe21cm.config import precision
+from pipe21cm.summary.power_spectrum import calculate_1dpk, calculate_2dpk
+from pipe21cm.summary.bispectrum import caculate_icoBk, fft_bispectrum
+from pipe21cm.signal.lightcone import build_physical_lightcone, get_observational_regridder, physical_lightcone_redshifts
+from pipe21cm.foreground.removal import pca_removal
+from pipe21cm.telescope import Telescope
+
+N_CELLS = 32
+BOX_SIZE = 64.
+# largest float32 error relative to the largest float64 value (about 2e-7 measured), and relative to the foregrounds
+TOLERANCE = 5e-7
+FOREGROUND_TOLERANCE = 1e-6
+
+
+def bubble_cube(n, seed=0, x_ion=0.5):
+    '''
+    brightness temperature cube in mK, the regions where a smooth Gaussian field is above its x_ion quantile are neutral
+    '''
+    rng = np.random.default_rng(seed)
+    k = np.sqrt(np.fft.fftfreq(n)[:, None, None]**2 + np.fft.fftfreq(n)[None, :, None]**2 + np.fft.rfftfreq(n)[None, None, :]**2)
+    k[0, 0, 0] = np.inf
+    delta = np.fft.irfftn(np.fft.rfftn(rng.standard_normal((n, n, n)))*k**-1, s=(n, n, n), axes=(0, 1, 2))
+    bubbles = np.fft.irfftn(np.fft.rfftn(rng.standard_normal((n, n, n)))*k**-2, s=(n, n, n), axes=(0, 1, 2))
+    x_neutral = bubbles > np.quantile(bubbles, x_ion)
+
+    return 27*(1+0.1*delta/delta.std())*x_neutral
+
+
+def relative_error(value, reference):
+    # empty bins are nan in both paths
+    assert np.array_equal(np.isnan(value), np.isnan(reference))
+    return np.nanmax(np.abs(value.astype(np.float64) - reference))/np.nanmax(np.abs(reference))
+
+
+def run_both(func):
+    '''
+    run func under the float64 and the float32 precision policy
+    '''
+    with precision(np.float64):
+        reference = func()
+    with precision(np.float32):
+        value = func()
+
+    return reference, value
+
+
+def check(reference, value, tolerance):
+    assert reference.dtype == np.float64, f'the float64 path returned {reference.dtype}'
+    assert value.dtype == np.float32, f'the float32 path returned {value.dtype}'
+    assert relative_error(value, reference) < tolerance
+
+
+@pytest.fixture(scope='module')
+def cube():
+    return bubble_cube(N_CELLS)
+
+
+def test_calculate_1dpk(cube):
+    reference, value = run_both(lambda: calculate_1dpk(cube, BOX_SIZE, 10)[1])
+    check(reference, value, TOLERANCE)
+
+
+def test_calculate_2dpk(cube):
+    reference, value = run_both(lambda: calculate_2dpk(cube, BOX_SIZE, 10)[2])
+    check(reference, value, TOLERANCE)
+
+
+def test_caculate_icoBk(cube):
+    reference, value = run_both(lambda: caculate_icoBk(cube, BOX_SIZE)[2])
+    check(reference, value, TOLERANCE)
+
+
+def test_fft_bispectrum(cube):
+    kF = 2*np.pi/BOX_SIZE
+    k1, k2, k3 = kF*np.array([2., 3., 4.]), kF*np.array([2., 3., 3.]), kF*np.array([3., 4., 6.])
+    reference, value = run_both(lambda: fft_bispectrum(cube, BOX_SIZE, k1, k2, k3))
+    check(reference, value, TOLERANCE)
+
+
+def test_build_physical_lightcone(tmp_path):
+    redshifts = [7.0, 7.2, 7.4]
+    file_list = []
+    for i, z in enumerate(redshifts):
+        file_list.append(os.path.join(tmp_path, f'brightness_temp_{z:.2f}.npy'))
+        np.save(file_list[-1], bubble_cube(N_CELLS, seed=i).astype(np.float32))
+
+    reference, value = run_both(lambda: build_physical_lightcone(file_list, redshifts, BOX_SIZE)[0])
+    check(reference, value, TOLERANCE)
+
+
+def test_observational_regridder(cube):
+    redshifts = physical_lightcone_redshifts([7.0, 9.0], BOX_SIZE, N_CELLS)[:N_CELLS]
+    regridder = get_observational_regridder(N_CELLS, N_CELLS, BOX_SIZE, redshifts[0], 0.1, 1.)
+
+    reference, value = run_both(lambda: regridder.apply(cube))
+    check(reference, value, TOLERANCE)
+
+
+def test_pca_removal(cube):
+    # power law foregrounds 1e4 times brighter than the signal, the tolerance is relative to the foregrounds
+    freqs = np.linspace(150., 180., N_CELLS)
+    amplitude = 1 + 0.1*bubble_cube(N_CELLS, seed=1)[..., :1]/27
+    foregrounds = 27e4*amplitude*(freqs/150.)**-2.6
+    data = cube + foregrounds
+
+    reference, value = run_both(lambda: pca_removal(data, n_components=3))
+    assert reference.dtype == np.float64 and value.dtype == np.float32
+    assert np.max(np.abs(value - reference))/np.max(np.abs(foregrounds)) < FOREGROUND_TOLERANCE
+
+
+def test_apply_uv_response_on_lightcone(cube):
+    telescope = Telescope(N_CELLS, BOX_SIZE, np.linspace(7., 8., N_CELLS))
+
+    # number of baselines falling with the uv distance, zero outside the core
+    u = np.fft.fftfreq(N_CELLS)
+    uv_distance = np.sqrt(u[:, None]**2 + u[None, :]**2)
+    uv_map = np.where(uv_distance < 0.3, 1e3*np.exp(-uv_distance/0.05), 0.)
+    telescope.uv_map = np.repeat(uv_map[..., None], N_CELLS, axis=-1)
+    telescope.uv_mask = telescope.uv_map != 0
+
+    reference, value = run_both(lambda: telescope.apply_uv_response_on_lightcone(cube))
+    check(reference, value, TOLERANCE)
+
+
+def test_calculate_sdc3a_ps():
+    pytest.importorskip('tools21cm')
+    from pipe21cm.summary.sdc_power_spectrum import calculate_sdc3a_ps
+
+    freqs = np.arange(151., 196., 0.5)
+    lc = np.concatenate([bubble_cube(N_CELLS, seed=seed) for seed in range(3)], axis=-1)[..., :len(freqs)]
+
+    reference, value = run_both(lambda: calculate_sdc3a_ps(lc, freqs, pixel_size=0.1, fov=2.)[0])
+    check(reference, value, TOLERANCE)